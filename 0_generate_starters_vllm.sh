@@ -19,9 +19,17 @@ generate() {
 
 process_batch() {
     local input_file=$1
-    python agents/vllm_batch.py \
-        --input_file ${input_file} \
-        --tensor_parallel_size ${tensor_parallel_size}
+    if [ -n "${VLLM_SPOOL}" ]; then
+        # resident worker started by generate_dialogues_vllm.sh; keeps the model loaded between steps
+        python agents/vllm_batch.py \
+            --submit \
+            --spool_dir ${VLLM_SPOOL} \
+            --input_file ${input_file}
+    else
+        python agents/vllm_batch.py \
+            --input_file ${input_file} \
+            --tensor_parallel_size ${tensor_parallel_size}
+    fi
 }
 
 upload() {
@@ -54,38 +62,51 @@ process() {
         --dataset ${dataset_path}
 }
 
-# First generation
-generate
-process_batch batches_to_process/${run_id}/${original_dataset}_${lang}_turn0_${model}.jsonl
-echo "Retrieved generations"
-
-evaluate
-upload batches_to_process/${run_id}/${original_dataset}_${lang}_turn0_${model}_eval.jsonl google ${GEMENI_KEY}
-echo "Retrieved evaluations"
-
-# Iterative generation until return 0
-process
-status=$?
-
-echo "Retrieved processed generations."
-echo "Regenerating $status examples."
-
-iteration=0
-max_iterations=10  # Safety limit to avoid infinite loops
+if [ -n "${VLLM_URL}" ]; then
+    # pipeline mode: each starter is generated (by vllm serve at VLLM_URL), evaluated and regenerated on its own
+    python tasks/narrative_generation/generate_narratives.py \
+        --lang ${lang} \
+        --model ${full_model} \
+        --type pipeline \
+        --run-id ${run_id} \
+        --dataset ${dataset_path} \
+        --gen-url ${VLLM_URL} \
+        --eval-api-key ${GEMENI_KEY}
+    echo "Generated and validated starters."
+else
+    # First generation
+    generate
+    process_batch batches_to_process/${run_id}/${original_dataset}_${lang}_turn0_${model}.jsonl
+    echo "Retrieved generations"
 
-while [ $status -ne 0 ] && [ $iteration -lt $max_iterations ]; do
-    process_batch batches_to_process/${run_id}/${original_dataset}_${lang}_turn0_${model}_regen.jsonl
     evaluate
     upload batches_to_process/${run_id}/${original_dataset}_${lang}_turn0_${model}_eval.jsonl google ${GEMENI_KEY}
+    echo "Retrieved evaluations"
+
+    # Iterative generation until return 0
     process
     status=$?
-    
+
+    echo "Retrieved processed generations."
     echo "Regenerating $status examples."
-    iteration=$((iteration + 1))
-done
 
-if [ $iteration -ge $max_iterations ]; then
-    echo "Warning: Reached maximum iterations without completion."
+    iteration=0
+    max_iterations=10  # Safety limit to avoid infinite loops
+
+    while [ $status -ne 0 ] && [ $iteration -lt $max_iterations ]; do
+        process_batch batches_to_process/${run_id}/${original_dataset}_${lang}_turn0_${model}_regen.jsonl
+        evaluate
+        upload batches_to_process/${run_id}/${original_dataset}_${lang}_turn0_${model}_eval.jsonl google ${GEMENI_KEY}
+        process
+        status=$?
+    
+        echo "Regenerating $status examples."
+        iteration=$((iteration + 1))
+    done
+
+    if [ $iteration -ge $max_iterations ]; then
+        echo "Warning: Reached maximum iterations without completion."
+    fi
 fi
 
 python dialogues/process_batch.py \
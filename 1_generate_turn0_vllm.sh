@@ -19,10 +19,17 @@ python tasks/dialogue_generation/generate_turn.py \
     --lang ${lang} \
     --type generate
 
-#run the batch
- python agents/vllm_batch.py \
-    --input_file batches_to_process/${lang}/${user}_${model}/${model}/turn-0_${model}.jsonl \
-    --tensor_parallel_size ${tensor_parallel_size}
+#run the batch (on the resident worker if there is one)
+if [ -n "${VLLM_SPOOL}" ]; then
+    python agents/vllm_batch.py \
+        --submit \
+        --spool_dir ${VLLM_SPOOL} \
+        --input_file batches_to_process/${lang}/${user}_${model}/${model}/turn-0_${model}.jsonl
+else
+    python agents/vllm_batch.py \
+        --input_file batches_to_process/${lang}/${user}_${model}/${model}/turn-0_${model}.jsonl \
+        --tensor_parallel_size ${tensor_parallel_size}
+fi
 
 #process the batch
 python dialogues/process_batch.py \
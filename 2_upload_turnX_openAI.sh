@@ -57,6 +57,22 @@ process() {
         --lang ${lang}
 }
 
+if [ "$batched" = "pipeline" ]; then
+    # each response is generated, evaluated and regenerated on its own, with no barrier between rounds
+    python tasks/dialogue_generation/generate_turn.py \
+        --service openai \
+        --model ${user} \
+        --context ${run_context} \
+        --role user \
+        --run_id ${user}_${model} \
+        --type pipeline \
+        --turn ${next_turn} \
+        --lang ${lang} \
+        --gen_api_key ${OPENAI_KEY} \
+        --eval_api_key ${GEMENI_KEY}
+    exit 0
+fi
+
 # First generation
 generate
 
@@ -93,7 +109,9 @@ if [ "$batched" = "False" ]; then
 
     
 else
-    # If batched, just upload the initial generation
+    # If batched (True, or auto to route between the Batch API and online requests), just run the initial
+    # generation through the Batch API (waits for it and merges the results);
+    # 3_download_turnX_openAI.sh picks it up from the submitted_batches stub, even after an interruption
     upload ${output_dir}/turn-${next_turn}_${user}.jsonl openai $OPENAI_KEY
-    echo "Uploaded initial responses for batch processing"
+    echo "Retrieved initial responses from batch processing"
 fi
\ No newline at end of file
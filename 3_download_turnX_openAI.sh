@@ -9,10 +9,14 @@ output_dir=batches_to_process/${lang}/${user}_${model}/${user}
 run_context=dialogues/${lang}/${user}_${model}/${model}/turn-$((turn-1))_${model}
 
 download() {
-    python agents/gpt.py \
-        --batch_id submitted_batches/${lang}/${user}_${model}/${user}/turn-${turn}_${user}.json \
-        --type download \
-        --api_key ${OPENAI_KEY}
+    local stub=submitted_batches/${lang}/${user}_${model}/${user}/turn-${turn}_${user}.json
+    # with batched=auto, small files are sent online and have no stub
+    if [ -f ${stub} ]; then
+        python agents/gpt.py \
+            --batch_id ${stub} \
+            --type download \
+            --api_key ${OPENAI_KEY}
+    fi
 }
 
 upload() {
@@ -48,18 +52,17 @@ process() {
         --lang ${lang}
 }
 
-# Download the batch if we're in batched mode
-if [ "$batched" = "True" ]; then
+# Download the batch if we're in batched mode (waits for it if it is still running);
+# in pipeline mode, 2_upload_turnX_openAI.sh already validated the responses
+if [ "$batched" != "False" ] && [ "$batched" != "pipeline" ]; then
     download
     echo "Downloaded initial responses"
     
     # Run validation cycle for batched processing
+    # batched uploads wait for their batches and merge the results into completed_batches
     evaluate
     upload ${output_dir}/turn-${turn}_${user}_eval.jsonl
-    echo "Uploaded evaluation requests"
-    
-    download
-    echo "Downloaded evaluations"
+    echo "Retrieved evaluations"
     
     process
     status=$?
@@ -70,11 +73,9 @@ if [ "$batched" = "True" ]; then
     
     while [ $status -ne 0 ] && [ $iteration -lt $max_iterations ]; do
         upload ${output_dir}/turn-${turn}_${user}_regen.jsonl
-        download
         
         evaluate
         upload ${output_dir}/turn-${turn}_${user}_eval.jsonl
-        download
         
         process
         status=$?
@@ -22,9 +22,17 @@ generate() {
 
 process_batch() {
     local input_file=$1
-    python agents/vllm_batch.py \
-        --input_file ${input_file} \
-        --tensor_parallel_size ${tensor_parallel_size}
+    if [ -n "${VLLM_SPOOL}" ]; then
+        # resident worker started by generate_dialogues_vllm.sh; keeps the model loaded between steps
+        python agents/vllm_batch.py \
+            --submit \
+            --spool_dir ${VLLM_SPOOL} \
+            --input_file ${input_file}
+    else
+        python agents/vllm_batch.py \
+            --input_file ${input_file} \
+            --tensor_parallel_size ${tensor_parallel_size}
+    fi
 }
 
 upload() {
@@ -77,13 +85,29 @@ else
     dialogue_file=dialogues/${lang}/${user}_${model}/${user}/turn-${turn}_${user}
     input_batch=completed_batches/${lang}/${user}_${model}/${model}/turn-${turn}_${model}.jsonl
 fi
-# Generate initial responses
-generate
-process_batch ${output_dir}/turn-${turn}_${model}.jsonl
-echo "Generated initial responses"
+if [ -n "${VLLM_URL}" ]; then
+    # pipeline mode: each response is generated (by vllm serve at VLLM_URL), evaluated and regenerated on its own
+    python tasks/dialogue_generation/generate_turn.py \
+        --service vllm \
+        --model ${model_owner}/${model} \
+        --context ${context} \
+        --role ${role} \
+        --run_id ${run_id} \
+        --type pipeline \
+        --turn ${turn} \
+        --lang ${lang} \
+        --gen_url ${VLLM_URL} \
+        --eval_api_key ${GEMENI_KEY}
+    echo "Generated and validated responses"
+else
+    # Generate initial responses
+    generate
+    process_batch ${output_dir}/turn-${turn}_${model}.jsonl
+    echo "Generated initial responses"
+fi
 
 # Only validate user role responses
-if [ "$role" = "user" ]; then
+if [ "$role" = "user" ] && [ -z "${VLLM_URL}" ]; then
     # Evaluate responses
     evaluate
     upload ${output_dir}/turn-${turn}_${model}_eval.jsonl google $GEMENI_KEY
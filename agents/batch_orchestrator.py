@@ -0,0 +1,570 @@
+"""
+BATCH ORCHESTRATOR
+
+Runs request files through the OpenAI Batch API from upload to merged results, so the pipeline does not need
+someone to come back and download a batch by hand.
+
+Features:
+- Splits request files over the per-batch limits (50,000 requests, 200 MB) into shards
+- Uploads and submits the shards of many files concurrently
+- Polls every batch with exponential backoff, and downloads its output and error files as soon as it ends
+- Streams downloads to disk in chunks, resuming interrupted ones with Range requests; each download is checked
+  against the size the Files API reports, and its sha256 is recorded so it is verified again before a later
+  run merges it
+- Merges the shards of each file into one results file, in the order of the requests file, in the format of
+  OpenAI batch outputs; requests without an answer (in the error file, or in a batch that failed or expired)
+  get an "error" key and a null body, like failed requests of the online dispatcher
+- Optionally converts answers into the canonical {"custom_id": ..., "response": {"body": ...}} records of the
+  online dispatcher while merging, dropping the provider's request ids and status codes
+- Records the shards of each file in its submitted_batches stub as they are submitted and finish, so a later
+  run (e.g. after an interruption, or from 3_download_turnX_openAI.sh) reattaches to them instead of
+  submitting again; the stub also records the sha256 of the requests file, so a new file uploaded under the
+  same name (e.g. the next regeneration round) is submitted anew rather than given the old round's results
+- Cancels batches still running at a job's {cancel_at} time, if few enough of their requests are unanswered,
+  so that the rest can be sent online in time (see batch_router.py); cancelled batches keep the answers they have
+- Runs a command, e.g. the next pipeline step, once every file is merged
+
+Talks to the Files and Batches endpoints under {base_url} with aiohttp, so it also runs against
+mock_openai_server.py.
+
+Example command (through agents/gpt.py):
+```
+python agents/gpt.py --type upload --batched True --input_file batches_to_process/a.jsonl batches_to_process/b.jsonl \
+  --on_complete "./3_download_turnX_openAI.sh ..."
+```
+
+The script is structured as follows:
+    - Imports
+    - Define dataclasses
+        - BatchShard (one uploaded file and its batch)
+        - BatchJob (a requests file, its stub and its results file)
+    - Define main function
+        - Split and submit the shards of each job
+        - Wait for each shard, download its output and error files
+        - Merge the shards of each job
+        - Run the next step
+    - Define functions
+        - shard_requests_file
+        - merge_shards
+        - HTTP calls with retries
+"""
+
+# imports
+import asyncio  # for running API calls concurrently
+import logging  # for logging progress
+import os  # for paths and atomic file replacement
+import random  # for jittering poll intervals
+import time  # for timestamps in the stubs
+from dataclasses import asdict, dataclass, field  # for storing jobs and shards
+
+import aiohttp  # for making API calls concurrently
+import orjson  # for reading and writing jsonl files
+
+from process_api_requests_from_file import (
+    classify_error,
+    file_fingerprint,
+    retry_after_from_response,
+)
+
+# provider limits of a single batch
+MAX_REQUESTS_PER_BATCH = 50_000
+MAX_BYTES_PER_BATCH = 200 * 1000**2
+# statuses after which a batch will not change anymore
+TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+# dataclasses
+
+
+@dataclass
+class BatchShard:
+    """A part of a requests file that is submitted as one batch."""
+
+    shard_filepath: str  # the requests file itself if it fits in one batch
+    num_requests: int = None
+    input_file_id: str = None
+    id: str = None  # batch id
+    status: str = None
+    output_file_id: str = None
+    error_file_id: str = None
+    errors: list = None  # reasons a batch failed, if it did
+    output_filepath: str = None  # downloaded output file
+    error_filepath: str = None  # downloaded error file
+    output_sha256: str = None
+    error_sha256: str = None
+
+    def downloads_verified(self) -> bool:
+        """Whether both files were downloaded and are still what was downloaded."""
+        for kind in ("output", "error"):
+            filepath, sha256 = getattr(self, f"{kind}_filepath"), getattr(self, f"{kind}_sha256")
+            if filepath is None or not os.path.exists(filepath):
+                return False
+            if sha256 is not None and file_fingerprint(filepath) != sha256:
+                logging.warning(f"{filepath} does not match its recorded sha256, downloading it again")
+                return False
+        return True
+
+
+@dataclass
+class BatchJob:
+    """A requests file sent through the Batch API: its stub under submitted_batches and its merged results file."""
+
+    requests_filepath: str
+    stub_filepath: str
+    save_filepath: str
+    shards: list = field(default_factory=list)
+    created_at: int = None
+    merged: bool = False
+    requests_sha256: str = None  # fingerprint of the requests file the shards were made from
+    cancel_at: float = None  # unix time after which running batches are cancelled
+    max_requests_to_cancel: int = 0  # unanswered requests cancelling may leave, over all shards
+
+    @classmethod
+    def from_stub(cls, stub_filepath: str, save_filepath: str = None):
+        """Reattach to submitted batches; stubs of a single unsharded batch (written before sharding) work too."""
+        with open(stub_filepath, "rb") as f:
+            stub = orjson.loads(f.read())
+        if "shards" in stub:
+            shards = [BatchShard(**shard) for shard in stub["shards"]]
+        else:
+            shards = [
+                BatchShard(
+                    shard_filepath=stub["input_file_local"],
+                    input_file_id=stub.get("input_file_id_openai"),
+                    id=stub["id"],
+                )
+            ]
+        return cls(
+            requests_filepath=stub["input_file_local"],
+            stub_filepath=stub_filepath,
+            save_filepath=save_filepath or stub.get("save_filepath"),
+            shards=shards,
+            created_at=stub.get("created_at"),
+            merged=stub.get("merged", False),
+            requests_sha256=stub.get("input_file_sha256"),
+        )
+
+    @classmethod
+    def for_requests_file(cls, requests_filepath: str, stub_filepath: str, save_filepath: str):
+        """Reattach to the batches of an existing stub if they were made from this very requests file and are not
+        merged yet; otherwise start a new job, whose stub replaces the old one (e.g. the next regeneration round
+        of a file with the same name)."""
+        if os.path.exists(stub_filepath):
+            job = cls.from_stub(stub_filepath, save_filepath)
+            if (
+                not job.merged
+                and job.requests_sha256 is not None
+                and job.requests_sha256 == file_fingerprint(requests_filepath)
+            ):
+                return job
+            logging.warning(
+                f"{stub_filepath} is {'already merged' if job.merged else 'for other requests'}, not reattaching {requests_filepath} to its batches"
+            )
+        return cls(requests_filepath=requests_filepath, stub_filepath=stub_filepath, save_filepath=save_filepath)
+
+    @property
+    def shard_directory(self) -> str:
+        return os.path.splitext(self.stub_filepath)[0] + ".shards"
+
+    def write_stub(self):
+        """Save the state of the job atomically; "id" and "input_file_id_openai" name the first batch, as before."""
+        stub = {
+            "id": self.shards[0].id if self.shards else None,
+            "input_file_id_openai": self.shards[0].input_file_id if self.shards else None,
+            "input_file_local": self.requests_filepath,
+            "input_file_sha256": self.requests_sha256,
+            "created_at": self.created_at,
+            "save_filepath": self.save_filepath,
+            "merged": self.merged,
+            "shards": [asdict(shard) for shard in self.shards],
+        }
+        os.makedirs(os.path.dirname(self.stub_filepath) or ".", exist_ok=True)
+        with open(f"{self.stub_filepath}.tmp", "wb") as f:
+            f.write(orjson.dumps(stub, option=orjson.OPT_INDENT_2))
+        os.replace(f"{self.stub_filepath}.tmp", self.stub_filepath)
+
+
+# main function
+
+
+async def run_batches(
+    jobs: list,
+    api_key: str,
+    base_url: str = "https://api.openai.com/v1",
+    endpoint: str = "/v1/chat/completions",
+    completion_window: str = "24h",
+    wait: bool = True,
+    poll_interval: float = 30.0,
+    max_poll_interval: float = 600.0,
+    max_concurrent_uploads: int = 4,
+    max_requests_per_batch: int = MAX_REQUESTS_PER_BATCH,
+    max_bytes_per_batch: int = MAX_BYTES_PER_BATCH,
+    canonical_format: bool = False,
+    on_complete: str = None,
+):
+    """Submit (or reattach to) the batches of every job, then download and merge them.
+
+    Without `wait`, every batch is submitted and checked once; jobs whose batches have all ended are merged, and
+    the others are left for a later run. With `canonical_format`, answers are written as
+    {"custom_id": ..., "response": {"body": ...}} records instead of the provider's. `on_complete` is a shell command run once every job is merged; its exit
+    status is returned (None if it did not run).
+    """
+    base_url = base_url.rstrip("/")
+    upload_semaphore = asyncio.Semaphore(max_concurrent_uploads)
+    async with aiohttp.ClientSession(
+        headers={"Authorization": f"Bearer {api_key}"},
+        timeout=aiohttp.ClientTimeout(total=None, sock_connect=60, sock_read=600),
+    ) as session:
+
+        async def run_shard(job: BatchJob, shard: BatchShard):
+            if shard.id is None:
+                async with upload_semaphore:
+                    await submit_shard(session, base_url, shard, endpoint, completion_window)
+                job.write_stub()
+            await wait_for_shard(
+                session, base_url, job, shard, wait, poll_interval, max_poll_interval
+            )
+            if shard.status in TERMINAL_STATUSES and not await asyncio.to_thread(
+                shard.downloads_verified
+            ):
+                await download_shard(session, base_url, job, shard)
+                job.write_stub()
+
+        async def run_job(job: BatchJob):
+            if job.merged:
+                logging.info(f"{job.requests_filepath} already merged into {job.save_filepath}")
+                return True
+            if not job.shards:
+                job.created_at = int(time.time())
+                job.requests_sha256 = await asyncio.to_thread(file_fingerprint, job.requests_filepath)
+                job.shards = await asyncio.to_thread(
+                    shard_requests_file,
+                    job.requests_filepath,
+                    job.shard_directory,
+                    max_requests_per_batch,
+                    max_bytes_per_batch,
+                )
+                job.write_stub()
+            await asyncio.gather(*(run_shard(job, shard) for shard in job.shards))
+            if any(shard.status not in TERMINAL_STATUSES for shard in job.shards):
+                logging.warning(
+                    f"{job.requests_filepath}: batches not finished yet "
+                    f"({', '.join(f'{shard.id} {shard.status}' for shard in job.shards)})"
+                )
+                return False
+            num_failed = await asyncio.to_thread(merge_shards, job, canonical_format)
+            job.merged = True
+            job.write_stub()
+            logging.warning(
+                f"{job.requests_filepath}: merged {len(job.shards)} batch(es) into {job.save_filepath}, "
+                f"{num_failed} request(s) without an answer"
+            )
+            return True
+
+        finished = await asyncio.gather(*(run_job(job) for job in jobs))
+
+    if on_complete and all(finished):
+        logging.warning(f"All batches merged, running {on_complete}")
+        process = await asyncio.create_subprocess_shell(on_complete)
+        return await process.wait()
+    return None
+
+
+async def submit_shard(
+    session: aiohttp.ClientSession,
+    base_url: str,
+    shard: BatchShard,
+    endpoint: str,
+    completion_window: str,
+):
+    """Upload a shard (streamed from disk) and create its batch."""
+    if shard.input_file_id is None:
+
+        def form():
+            data = aiohttp.FormData()
+            data.add_field("purpose", "batch")
+            data.add_field(
+                "file",
+                open(shard.shard_filepath, "rb"),
+                filename=os.path.basename(shard.shard_filepath),
+            )
+            return data
+
+        uploaded = await call_json(session, "POST", f"{base_url}/files", data=form)
+        shard.input_file_id = uploaded["id"]
+    batch = await call_json(
+        session,
+        "POST",
+        f"{base_url}/batches",
+        json={
+            "input_file_id": shard.input_file_id,
+            "endpoint": endpoint,
+            "completion_window": completion_window,
+        },
+    )
+    shard.id = batch["id"]
+    shard.status = batch["status"]
+    logging.warning(f"batch {shard.id} created for {shard.shard_filepath}")
+
+
+async def wait_for_shard(
+    session: aiohttp.ClientSession,
+    base_url: str,
+    job: BatchJob,
+    shard: BatchShard,
+    wait: bool,
+    poll_interval: float,
+    max_poll_interval: float,
+):
+    """Poll a batch until it ends, backing off while its status does not change. Only once without `wait`."""
+    seconds_to_wait = poll_interval
+    while shard.status not in TERMINAL_STATUSES:
+        batch = await call_json(session, "GET", f"{base_url}/batches/{shard.id}")
+        status_changed = batch["status"] != shard.status
+        shard.status = batch["status"]
+        shard.output_file_id = batch.get("output_file_id")
+        shard.error_file_id = batch.get("error_file_id")
+        if batch.get("errors"):
+            shard.errors = batch["errors"].get("data")
+        if status_changed:
+            logging.info(f"batch {shard.id}: {shard.status} {batch.get('request_counts')}")
+            job.write_stub()
+            seconds_to_wait = poll_interval
+        if job.cancel_at is not None and time.time() >= job.cancel_at:
+            await maybe_cancel_shard(session, base_url, job, shard, batch.get("request_counts") or {})
+        if not wait or shard.status in TERMINAL_STATUSES:
+            break
+        seconds_to_sleep = seconds_to_wait * random.uniform(0.8, 1.2)
+        if job.cancel_at is not None and time.time() < job.cancel_at:
+            seconds_to_sleep = min(seconds_to_sleep, job.cancel_at - time.time() + 1)
+        await asyncio.sleep(seconds_to_sleep)
+        seconds_to_wait = min(seconds_to_wait * 1.5, max_poll_interval)
+
+
+async def maybe_cancel_shard(
+    session: aiohttp.ClientSession, base_url: str, job: BatchJob, shard: BatchShard, request_counts: dict
+):
+    """Cancel a running batch if its unanswered requests fit in what the job may leave unanswered."""
+    if shard.status not in ("validating", "in_progress"):
+        return
+    num_unanswered = (
+        (request_counts.get("total") or shard.num_requests or 0)
+        - request_counts.get("completed", 0)
+        - request_counts.get("failed", 0)
+    )
+    if num_unanswered > job.max_requests_to_cancel:
+        logging.info(f"batch {shard.id}: {num_unanswered} requests unanswered, too many to cancel")
+        return
+    job.max_requests_to_cancel -= num_unanswered
+    batch = await call_json(session, "POST", f"{base_url}/batches/{shard.id}/cancel")
+    shard.status = batch["status"]
+    job.write_stub()
+    logging.warning(f"batch {shard.id} cancelled at the deadline with {num_unanswered} requests unanswered")
+
+
+async def download_shard(
+    session: aiohttp.ClientSession, base_url: str, job: BatchJob, shard: BatchShard
+):
+    """Download the output and error files of an ended batch next to the stub."""
+    os.makedirs(job.shard_directory, exist_ok=True)
+    name = os.path.splitext(os.path.basename(shard.shard_filepath))[0]
+    for file_id, kind in ((shard.error_file_id, "error"), (shard.output_file_id, "output")):
+        filepath = os.path.join(job.shard_directory, f"{name}_{kind}.jsonl")
+        sha256 = None
+        if file_id is not None:
+            sha256 = await download_file(session, base_url, file_id, filepath)
+        else:
+            open(filepath, "wb").close()
+        setattr(shard, f"{kind}_filepath", filepath)
+        setattr(shard, f"{kind}_sha256", sha256)
+
+
+async def download_file(
+    session: aiohttp.ClientSession, base_url: str, file_id: str, filepath: str, max_attempts: int = 8
+) -> str:
+    """Stream a file to disk in chunks and return its sha256.
+
+    Bytes arrive in {filepath}.part, which survives failed attempts and interrupted runs: the next attempt asks
+    only for the rest with a Range request. The file appears under its name once it has the size the Files API
+    reports.
+    """
+    expected_bytes = (await call_json(session, "GET", f"{base_url}/files/{file_id}")).get("bytes")
+    partial_filepath = f"{filepath}.part"
+    for attempt in range(max_attempts):
+        offset = os.path.getsize(partial_filepath) if os.path.exists(partial_filepath) else 0
+        if expected_bytes is not None and offset > expected_bytes:
+            offset = 0  # not a prefix of this file
+        try:
+            if expected_bytes is None or offset < expected_bytes:
+                headers = {"Range": f"bytes={offset}-"} if offset else {}
+                async with session.get(
+                    f"{base_url}/files/{file_id}/content", headers=headers
+                ) as response:
+                    response.raise_for_status()
+                    # a server that ignores the range sends the whole file again
+                    with open(partial_filepath, "ab" if response.status == 206 else "wb") as f:
+                        async for chunk in response.content.iter_chunked(1 << 20):
+                            f.write(chunk)
+            num_bytes = os.path.getsize(partial_filepath)
+            if expected_bytes is None or num_bytes == expected_bytes:
+                break
+            if num_bytes > expected_bytes:
+                os.remove(partial_filepath)
+            raise aiohttp.ClientPayloadError(f"got {num_bytes} of {expected_bytes} bytes")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if attempt == max_attempts - 1:
+                raise
+            logging.warning(f"download of {file_id} failed ({e}), resuming")
+            await asyncio.sleep(min(2**attempt, 60) * random.uniform(0.5, 1.0))
+    sha256 = await asyncio.to_thread(file_fingerprint, partial_filepath)
+    os.replace(partial_filepath, filepath)
+    return sha256
+
+
+async def call_json(
+    session: aiohttp.ClientSession, method: str, url: str, max_attempts: int = 8, data=None, **kwargs
+):
+    """Call the Files or Batches API, retrying rate limits, server errors and connection errors with backoff.
+
+    `data` may be a function returning the request body, so a streamed upload can be rebuilt for each attempt.
+    """
+    for attempt in range(max_attempts):
+        seconds_to_wait = min(2**attempt, 60) * random.uniform(0.5, 1.0)
+        try:
+            async with session.request(
+                method, url, data=data() if callable(data) else data, **kwargs
+            ) as response:
+                response_json = await response.json(content_type=None)
+                if response.status < 400:
+                    return response_json
+                error_class = classify_error(response.status, response_json)
+                if error_class == "non_retriable" or attempt == max_attempts - 1:
+                    raise RuntimeError(f"{method} {url} failed with {response.status}: {response_json}")
+                seconds_to_wait = (
+                    retry_after_from_response(response.headers, response_json) or seconds_to_wait
+                )
+                logging.warning(f"{method} {url} failed with {response.status}, retrying")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if attempt == max_attempts - 1:
+                raise
+            logging.warning(f"{method} {url} failed ({e}), retrying")
+        await asyncio.sleep(seconds_to_wait)
+
+
+# functions
+
+
+def shard_requests_file(
+    requests_filepath: str,
+    shard_directory: str,
+    max_requests: int = MAX_REQUESTS_PER_BATCH,
+    max_bytes: int = MAX_BYTES_PER_BATCH,
+) -> list:
+    """Split a requests file into consecutive shards that each fit in one batch."""
+    num_requests = 0
+    with open(requests_filepath, "rb") as f:
+        for line in f:
+            num_requests += bool(line.strip())
+    if num_requests <= max_requests and os.path.getsize(requests_filepath) <= max_bytes:
+        return [BatchShard(shard_filepath=requests_filepath, num_requests=num_requests)]
+
+    os.makedirs(shard_directory, exist_ok=True)
+    name = os.path.splitext(os.path.basename(requests_filepath))[0]
+    shards = []
+    shard_file = None
+    with open(requests_filepath, "rb") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            if not line.endswith(b"\n"):
+                line += b"\n"
+            if (
+                shard_file is None
+                or shards[-1].num_requests >= max_requests
+                or shard_file.tell() + len(line) > max_bytes
+            ):
+                if shard_file is not None:
+                    shard_file.close()
+                shards.append(
+                    BatchShard(
+                        shard_filepath=os.path.join(shard_directory, f"{name}-{len(shards):03d}.jsonl"),
+                        num_requests=0,
+                    )
+                )
+                shard_file = open(shards[-1].shard_filepath, "wb")
+            shard_file.write(line)
+            shards[-1].num_requests += 1
+    if shard_file is not None:
+        shard_file.close()
+    logging.warning(f"split {requests_filepath} ({num_requests} requests) into {len(shards)} batches")
+    return shards
+
+
+def failure_record(custom_id: str, error) -> dict:
+    return {"custom_id": custom_id, "response": {"body": None}, "error": error}
+
+
+def merge_shards(job: BatchJob, canonical_format: bool = False) -> int:
+    """Write the results of every shard, in the order of the requests file. Returns the number of failed requests.
+
+    Only the answers of one shard are held in memory at a time.
+    """
+    num_failed = 0
+    os.makedirs(os.path.dirname(job.save_filepath) or ".", exist_ok=True)
+    with open(f"{job.save_filepath}.tmp", "wb") as f_out:
+        for shard in job.shards:
+            answers = {}  # custom_id -> (line, whether the request failed)
+            # successful answers take precedence over error records of the same request
+            for filepath in (shard.error_filepath, shard.output_filepath):
+                with open(filepath, "rb") as f:
+                    for line in f:
+                        if not line.strip():
+                            continue
+                        record = orjson.loads(line)
+                        response = record.get("response")
+                        if record.get("error") or response is None:
+                            error = record.get("error")
+                        elif response.get("status_code", 200) >= 400:
+                            error = (response.get("body") or {}).get("error")
+                        else:
+                            if canonical_format:
+                                line = orjson.dumps(
+                                    {"custom_id": record["custom_id"], "response": {"body": response.get("body")}}
+                                )
+                            answers[record["custom_id"]] = (line.rstrip(b"\n") + b"\n", False)
+                            continue
+                        answers[record["custom_id"]] = (
+                            orjson.dumps(
+                                failure_record(record["custom_id"], error),
+                                option=orjson.OPT_APPEND_NEWLINE,
+                            ),
+                            True,
+                        )
+            missing = {
+                "message": f"batch {shard.id} ended as {shard.status} without answering",
+                "errors": shard.errors,
+            }
+            with open(shard.shard_filepath, "rb") as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    custom_id = orjson.loads(line)["custom_id"]
+                    answer, failed = answers.get(custom_id, (None, True))
+                    if answer is None:
+                        answer = orjson.dumps(
+                            failure_record(custom_id, missing), option=orjson.OPT_APPEND_NEWLINE
+                        )
+                    num_failed += failed
+                    f_out.write(answer)
+    os.replace(f"{job.save_filepath}.tmp", job.save_filepath)
+
+    # the split requests and the downloads are in the merged file now
+    for shard in job.shards:
+        for filepath in (shard.output_filepath, shard.error_filepath):
+            if filepath and os.path.exists(filepath):
+                os.remove(filepath)
+        if shard.shard_filepath != job.requests_filepath and os.path.exists(shard.shard_filepath):
+            os.remove(shard.shard_filepath)
+    if os.path.isdir(job.shard_directory) and not os.listdir(job.shard_directory):
+        os.rmdir(job.shard_directory)
+    return num_failed
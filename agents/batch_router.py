@@ -0,0 +1,246 @@
+"""
+BATCH ROUTER
+
+Splits requests files between the Batch API (half the price, answers within 24 h) and the online dispatcher
+(full price, answers in minutes), given a deadline and a cost target, and merges both into one results file
+per requests file.
+
+Routing:
+- Files with fewer than {min_batch_requests} requests, e.g. regeneration rounds, go online: batching saves
+  little on them and would hold the round up for a batch window
+- Files whose submitted_batches stub was made from the same requests and is not merged yet were batched by an
+  interrupted run, and reattach to their batches whatever their size
+- Other files go through the Batch API (batch_orchestrator.py)
+- At most {max_online_share} of the requests of a batched file are sent online, which bounds its cost at
+  (1 + {max_online_share}) times the cost of batching it all
+- With a deadline, batches still running when just enough time is left to send {max_online_share} of the file
+  online are cancelled, if no more than that share is unanswered; the answers the batch has are kept
+- Requests a batch did not answer (cancelled, expired or failed) are then sent online, up to that share, and
+  their answers replace the failure records in the merged file, matched by custom_id
+
+Example command (through agents/gpt.py):
+```
+python agents/gpt.py --type upload --batched auto --deadline 6 --max_online_share 0.1 \
+  --input_file batches_to_process/a.jsonl batches_to_process/a_regen.jsonl
+```
+
+The script is structured as follows:
+    - Imports
+    - Define dataclasses
+        - RoutePlan (size and route of one requests file)
+    - Define main function
+        - Plan each file
+        - Run online files and batched files concurrently
+        - Send the unanswered requests of batched files online and merge their answers
+    - Define functions
+"""
+
+# imports
+import asyncio  # for running the batch and online routes concurrently
+import logging  # for logging routing decisions
+import os  # for paths
+import time  # for the deadline
+from dataclasses import dataclass, field  # for storing routing plans
+
+import orjson  # for reading and writing jsonl files
+
+from batch_orchestrator import BatchJob, run_batches
+from process_api_requests_from_file import process_api_requests_from_files
+
+
+# dataclasses
+
+
+@dataclass
+class RoutePlan:
+    """Size and route of a requests file."""
+
+    requests_filepath: str
+    stub_filepath: str
+    save_filepath: str
+    num_requests: int
+    num_tokens: int  # rough count of prompt and completion tokens
+    route: str = "batch"  # "batch" or "online"
+    batch_job: BatchJob = field(default=None, repr=False)  # set on the batch route
+
+    @property
+    def online_filepath(self) -> str:
+        """Requests of a batched file that are sent online after all."""
+        return os.path.splitext(self.stub_filepath)[0] + ".online.jsonl"
+
+    @property
+    def online_save_filepath(self) -> str:
+        return os.path.splitext(self.stub_filepath)[0] + ".online_results.jsonl"
+
+
+# main function
+
+
+async def route_requests(
+    requests_stub_and_save_filepaths: list,
+    batch_kwargs: dict,
+    online_kwargs: dict,
+    deadline: float = None,
+    max_online_share: float = 0.1,
+    min_batch_requests: int = 1000,
+    cancel_seconds: float = 600.0,
+    on_complete: str = None,
+):
+    """Run (requests, stub, save) filepath triples through the Batch API and the online dispatcher.
+
+    `deadline` is in seconds from now (None waits for batches however long they take). `cancel_seconds` is
+    left for a cancelled batch to wind down. `batch_kwargs` go to run_batches and `online_kwargs` to
+    process_api_requests_from_files, except for the filepaths, the record format and the ordering. Returns the
+    exit status of `on_complete`, if it ran.
+    """
+    start_time = time.time()
+    plans = await asyncio.gather(
+        *(
+            asyncio.to_thread(plan_route, requests_filepath, stub_filepath, save_filepath, min_batch_requests)
+            for requests_filepath, stub_filepath, save_filepath in requests_stub_and_save_filepaths
+        )
+    )
+    online_plans = [plan for plan in plans if plan.route == "online"]
+    batch_jobs = []
+    for plan in plans:
+        if plan.route != "batch":
+            continue
+        max_online_requests = int(plan.num_requests * max_online_share)
+        job = plan.batch_job
+        job.max_requests_to_cancel = max_online_requests
+        if deadline is not None:
+            job.cancel_at = (
+                start_time
+                + deadline
+                - cancel_seconds
+                - online_seconds(
+                    max_online_requests,
+                    plan.num_tokens * max_online_share,
+                    online_kwargs["max_requests_per_minute"],
+                    online_kwargs["max_tokens_per_minute"],
+                )
+            )
+        batch_jobs.append(job)
+    for plan in plans:
+        logging.warning(f"{plan.requests_filepath}: {plan.num_requests} requests, routed to {plan.route}")
+
+    async def run_online(pairs: list):
+        if pairs:
+            for _, save_filepath in pairs:
+                os.makedirs(os.path.dirname(save_filepath) or ".", exist_ok=True)
+            await process_api_requests_from_files(
+                requests_and_save_filepaths=pairs,
+                record_format="batch",
+                ordered_output=True,
+                **online_kwargs,
+            )
+
+    await asyncio.gather(
+        run_online([(plan.requests_filepath, plan.save_filepath) for plan in online_plans]),
+        run_batches(batch_jobs, **batch_kwargs) if batch_jobs else asyncio.sleep(0),
+    )
+
+    # stragglers: requests the batches did not answer, up to the share each file may send online
+    straggler_plans = []
+    for plan, job in zip([plan for plan in plans if plan.route == "batch"], batch_jobs):
+        if not job.merged:
+            continue  # without waiting, batches may not be finished yet
+        max_online_requests = int(plan.num_requests * max_online_share)
+        num_unanswered = await asyncio.to_thread(
+            write_unanswered_requests, plan, max_online_requests
+        )
+        if num_unanswered:
+            logging.warning(f"{plan.requests_filepath}: sending {num_unanswered} unanswered requests online")
+            straggler_plans.append(plan)
+    await run_online(
+        [(plan.online_filepath, plan.online_save_filepath) for plan in straggler_plans]
+    )
+    for plan in straggler_plans:
+        num_replaced = await asyncio.to_thread(merge_online_results, plan)
+        logging.warning(f"{plan.requests_filepath}: {num_replaced} answers from online requests merged")
+
+    if on_complete and all(job.merged for job in batch_jobs):
+        logging.warning(f"All requests answered, running {on_complete}")
+        process = await asyncio.create_subprocess_shell(on_complete)
+        return await process.wait()
+    return None
+
+
+# functions
+
+
+def plan_route(requests_filepath: str, stub_filepath: str, save_filepath: str, min_batch_requests: int) -> RoutePlan:
+    """Size a requests file and pick its route."""
+    num_requests = 0
+    num_tokens = 0
+    with open(requests_filepath, "rb") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            body = orjson.loads(line).get("body", {})
+            num_requests += 1
+            # about 4 bytes of JSON per prompt token, plus the completion reserved for the request
+            num_tokens += len(line) // 4 + body.get("n", 1) * body.get("max_tokens", 1024)
+    batch_job = BatchJob.for_requests_file(requests_filepath, stub_filepath, save_filepath)
+    # a file whose batches an interrupted run submitted stays on them, whatever its size
+    route = "online" if num_requests < min_batch_requests and not batch_job.shards else "batch"
+    return RoutePlan(
+        requests_filepath=requests_filepath,
+        stub_filepath=stub_filepath,
+        save_filepath=save_filepath,
+        num_requests=num_requests,
+        num_tokens=num_tokens,
+        route=route,
+        batch_job=batch_job if route == "batch" else None,
+    )
+
+
+def online_seconds(num_requests: int, num_tokens: float, max_requests_per_minute: float, max_tokens_per_minute: float) -> float:
+    """Time the online dispatcher needs for a number of requests at the given rate limits."""
+    return 60 * max(num_requests / max_requests_per_minute, num_tokens / max_tokens_per_minute)
+
+
+def write_unanswered_requests(plan: RoutePlan, max_requests: int) -> int:
+    """Write up to `max_requests` requests without an answer in the merged file to plan.online_filepath."""
+    unanswered = set()
+    with open(plan.save_filepath, "rb") as f:
+        for line in f:
+            record = orjson.loads(line)
+            if record.get("error") is not None or not (record.get("response") or {}).get("body"):
+                unanswered.add(record["custom_id"])
+    num_written = 0
+    with open(plan.requests_filepath, "rb") as f_in, open(plan.online_filepath, "wb") as f_out:
+        for line in f_in:
+            if num_written >= max_requests:
+                break
+            if line.strip() and orjson.loads(line)["custom_id"] in unanswered:
+                f_out.write(line if line.endswith(b"\n") else line + b"\n")
+                num_written += 1
+    if num_written < len(unanswered):
+        logging.warning(
+            f"{plan.requests_filepath}: {len(unanswered) - num_written} unanswered requests over the online share are left failed"
+        )
+    return num_written
+
+
+def merge_online_results(plan: RoutePlan) -> int:
+    """Replace failure records in the merged file with successful online answers. Returns the number replaced."""
+    answers = {}
+    with open(plan.online_save_filepath, "rb") as f:
+        for line in f:
+            record = orjson.loads(line)
+            if "error" not in record:
+                answers[record["custom_id"]] = line
+    num_replaced = 0
+    with open(plan.save_filepath, "rb") as f_in, open(f"{plan.save_filepath}.tmp", "wb") as f_out:
+        for line in f_in:
+            custom_id = orjson.loads(line)["custom_id"]
+            if custom_id in answers:
+                line = answers.pop(custom_id)
+                num_replaced += 1
+            f_out.write(line)
+    os.replace(f"{plan.save_filepath}.tmp", plan.save_filepath)
+    for filepath in (plan.online_filepath, plan.online_save_filepath, f"{plan.online_save_filepath}.inprogress"):
+        if os.path.exists(filepath):
+            os.remove(filepath)
+    return num_replaced
@@ -0,0 +1,281 @@
+"""
+DISPATCHER BENCHMARK
+
+Replays synthetic MEDAL evaluation request files against the local mock server (mock_openai_server.py) and
+reports, for each file size:
+- throughput (requests per second, wall clock)
+- p50 / p99 latency of the calls, from the request timings the dispatcher records (sent to done), and the
+  p99 end-to-end time of a request (queued to done, including retries)
+- CPU time and peak RSS of the dispatcher process
+- number of requests that failed after all attempts
+
+The mock server runs in its own process and each dispatcher run in a fresh one, so CPU time and peak RSS
+belong to the dispatcher alone. Synthetic files are generated once per size and reused from --data_dir.
+
+Example command:
+```
+python agents/benchmark_dispatcher.py --num_requests 10000 100000 --latency_mean 0.5 \
+  --max_requests_in_flight 500 --output benchmark_results.jsonl
+```
+"""
+
+import argparse  # for running script from command line
+import asyncio  # for running the dispatcher
+import concurrent.futures  # for running each benchmark in a fresh process
+import logging  # for silencing the dispatcher while it is measured
+import multiprocessing  # for running each benchmark in a fresh process
+import os  # for locating the mock server and the synthetic files
+import random  # for generating synthetic dialogues
+import resource  # for measuring peak memory
+import socket  # for finding a free port
+import subprocess  # for running the mock server
+import sys  # for running the mock server with this interpreter
+import tempfile  # for the default location of the synthetic files
+import time  # for measuring wall and CPU time
+import urllib.request  # for querying the mock server
+
+import orjson  # for writing requests and reading results
+
+from process_api_requests_from_file import process_api_requests_from_file
+
+LANGUAGES = ["chinese", "english", "french", "german", "portuguese", "spanish"]
+WORDS = "the a to of and you I it that is was for on are with they be at one have this from or had by word but what some we can out other were all there when up use your how said an each she which do their time if will way about many then them write would like so these her long make thing see him two has look more day could go come did number sound no most people my over know water than call first who may down side been now find".split()
+
+# stands in for SYS_PROMPT_HUMAN of tasks/dialogue_evaluation/evaluate_dialogue.py (about the same length)
+SYSTEM_PROMPT = " ".join(random.Random(0).choice(WORDS) for _ in range(1200))
+
+
+def synthetic_requests_filepath(data_dir: str, num_requests: int) -> str:
+    """Write (once) a file of num_requests evaluation requests shaped like the ones of evaluate_dialogue.py."""
+    requests_filepath = os.path.join(data_dir, f"synthetic_evaluation_{num_requests}.jsonl")
+    if os.path.exists(requests_filepath):
+        return requests_filepath
+    os.makedirs(data_dir, exist_ok=True)
+    rng = random.Random(num_requests)
+    with open(f"{requests_filepath}.tmp", "wb") as f:
+        for current_idx in range(num_requests):
+            lang = LANGUAGES[current_idx % len(LANGUAGES)]
+            dialogue = [
+                {
+                    "role": "user" if turn % 2 == 0 else "assistant",
+                    "content": " ".join(
+                        rng.choice(WORDS) for _ in range(rng.randint(10, 60))
+                    ),
+                }
+                for turn in range(rng.choice([6, 8, 10]))
+            ]
+            message = [{"role": "system", "content": SYSTEM_PROMPT}]
+            message += [
+                {
+                    "role": "user",
+                    "content": "The Dialogue is as follows:\n"
+                    + "\n".join(f"{x['role']}: {x['content']}" for x in dialogue),
+                }
+            ]
+            call = {
+                "custom_id": f"synthetic/{lang}-{current_idx}",
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": "gpt-4.1",
+                    "messages": message,
+                    "temperature": 0,
+                    "top_p": 1.0,
+                    "max_tokens": 1024,
+                    "response_format": {"type": "json_object"},
+                },
+            }
+            f.write(orjson.dumps(call, option=orjson.OPT_APPEND_NEWLINE))
+    os.replace(f"{requests_filepath}.tmp", requests_filepath)
+    return requests_filepath
+
+
+def run_dispatcher(
+    requests_filepath: str, save_filepath: str, request_url: str, dispatcher_kwargs: dict
+) -> dict:
+    """Run the dispatcher once; meant to be called in a fresh process."""
+    if os.path.exists(save_filepath):
+        os.remove(save_filepath)
+    start_time = time.monotonic()
+    start_cpu_time = time.process_time()
+    asyncio.run(
+        process_api_requests_from_file(
+            requests_filepath=requests_filepath,
+            save_filepath=save_filepath,
+            request_url=request_url,
+            api_key="mock",
+            logging_level=logging.CRITICAL,
+            **dispatcher_kwargs,
+        )
+    )
+    wall_time = time.monotonic() - start_time
+    cpu_time = time.process_time() - start_cpu_time
+    num_failed = 0
+    latencies = []
+    request_times = []
+    with open(save_filepath, "rb") as f:
+        for line in f:
+            record = orjson.loads(line)
+            if isinstance(record, dict):
+                timings = record.get("timings", {})
+                num_failed += "error" in record
+            else:
+                timings = record[3].get("timings", {}) if len(record) > 3 else {}
+            if "sent" in timings:
+                latencies.append(timings["done"] - timings["sent"])
+            if "queued" in timings and "done" in timings:
+                request_times.append(timings["done"] - timings["queued"])
+    return {
+        "latency_p50": percentile(latencies, 50),
+        "latency_p99": percentile(latencies, 99),
+        "request_time_p99": percentile(request_times, 99),
+        "wall_time": wall_time,
+        "cpu_time": cpu_time,
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "num_failed": num_failed,
+    }
+
+
+def percentile(values: list, q: float):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q / 100))]
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def get_json(url: str):
+    with urllib.request.urlopen(url, timeout=10) as response:
+        return orjson.loads(response.read())
+
+
+def start_mock_server(args) -> tuple:
+    port = free_port()
+    command = [
+        sys.executable,
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), "mock_openai_server.py"),
+        "--port", str(port),
+        "--latency_distribution", args.latency_distribution,
+        "--latency_mean", str(args.latency_mean),
+        "--latency_sigma", str(args.latency_sigma),
+        "--error_rate_429", str(args.error_rate_429),
+        "--error_rate_500", str(args.error_rate_500),
+        "--completion_tokens", str(args.completion_tokens),
+        "--seed", "0",
+    ]
+    if args.server_requests_per_minute:
+        command += ["--requests_per_minute", str(args.server_requests_per_minute)]
+    if args.server_tokens_per_minute:
+        command += ["--tokens_per_minute", str(args.server_tokens_per_minute)]
+    server = subprocess.Popen(command)
+    base_url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            get_json(f"{base_url}/stats?reset=1")
+            return server, base_url
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("mock server did not start")
+
+
+def main(args):
+    dispatcher_kwargs = dict(
+        max_requests_per_minute=args.max_requests_per_minute,
+        max_tokens_per_minute=args.max_tokens_per_minute,
+        token_encoding_name=args.token_encoding_name,
+        max_attempts=args.max_attempts,
+        adaptive_rate_limit=args.adaptive_rate_limit,
+        record_format=args.record_format,
+        ordered_output=args.ordered_output,
+        max_requests_in_flight=args.max_requests_in_flight,
+        record_timings=True,
+    )
+    server, base_url = start_mock_server(args)
+    try:
+        for num_requests in args.num_requests:
+            requests_filepath = synthetic_requests_filepath(args.data_dir, num_requests)
+            save_filepath = requests_filepath.replace(".jsonl", "_results.jsonl")
+            get_json(f"{base_url}/stats?reset=1")
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=1, mp_context=multiprocessing.get_context("spawn")
+            ) as executor:
+                run = executor.submit(
+                    run_dispatcher,
+                    requests_filepath,
+                    save_filepath,
+                    f"{base_url}/v1/chat/completions",
+                    dispatcher_kwargs,
+                ).result()
+            server_stats = get_json(f"{base_url}/stats?reset=1")
+            os.remove(save_filepath)
+            result = {
+                "num_requests": num_requests,
+                "throughput": num_requests / run["wall_time"],
+                "latency_p50": run["latency_p50"],
+                "latency_p99": run["latency_p99"],
+                "request_time_p99": run["request_time_p99"],
+                "server_latency_p50": server_stats["latency_p50"],
+                "server_latency_p99": server_stats["latency_p99"],
+                "wall_time": run["wall_time"],
+                "cpu_time": run["cpu_time"],
+                "peak_rss_mb": run["peak_rss_mb"],
+                "num_failed": run["num_failed"],
+                "num_calls": server_stats["num_requests"],
+                "num_responses_by_status": server_stats["num_responses_by_status"],
+                "settings": {**vars(args), "num_requests": num_requests},
+            }
+            print(
+                f"{num_requests:>9} requests: {result['throughput']:8.1f} req/s | "
+                f"p50 {result['latency_p50']:.3f}s p99 {result['latency_p99']:.3f}s "
+                f"(server p99 {result['server_latency_p99']:.3f}s, request p99 {result['request_time_p99']:.3f}s) | "
+                f"cpu {result['cpu_time']:.1f}s | peak rss {result['peak_rss_mb']:.0f} MB | "
+                f"{result['num_failed']} failed, {result['num_calls']} calls"
+            )
+            if args.output:
+                with open(args.output, "ab") as f:
+                    f.write(orjson.dumps(result, option=orjson.OPT_APPEND_NEWLINE))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="load-test the request dispatcher against a local mock server"
+    )
+    parser.add_argument("--num_requests", type=int, nargs="+", default=[10_000])
+    parser.add_argument(
+        "--data_dir", default=os.path.join(tempfile.gettempdir(), "medal_benchmark")
+    )
+    parser.add_argument("--output", default=None, help="jsonl file to append results to")
+    # mock server
+    parser.add_argument(
+        "--latency_distribution",
+        choices=["constant", "uniform", "exponential", "lognormal"],
+        default="lognormal",
+    )
+    parser.add_argument("--latency_mean", type=float, default=0.5)
+    parser.add_argument("--latency_sigma", type=float, default=0.5)
+    parser.add_argument("--error_rate_429", type=float, default=0.0)
+    parser.add_argument("--error_rate_500", type=float, default=0.0)
+    parser.add_argument("--completion_tokens", type=int, default=150)
+    parser.add_argument("--server_requests_per_minute", type=float, default=None)
+    parser.add_argument("--server_tokens_per_minute", type=float, default=None)
+    # dispatcher
+    parser.add_argument("--max_requests_per_minute", type=float, default=1_000_000)
+    parser.add_argument("--max_tokens_per_minute", type=float, default=1_000_000_000)
+    parser.add_argument("--max_requests_in_flight", type=int, default=500)
+    parser.add_argument("--max_attempts", type=int, default=5)
+    parser.add_argument("--token_encoding_name", default="cl100k_base")
+    parser.add_argument("--adaptive_rate_limit", type=lambda x: x == "True", default=True)
+    parser.add_argument("--record_format", choices=["raw", "batch"], default="batch")
+    parser.add_argument("--ordered_output", type=lambda x: x == "True", default=True)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,50 @@
+"""
+CHAT CLIENT
+
+Sends single chat completion requests for the per-item pipelines (the pipeline mode of generate_turn.py and
+generate_narratives.py, and run_pipeline.py), which cannot wait for a whole requests file to go through
+process_api_requests_from_file.py.
+
+Errors are handled like in the dispatcher, with its classify_error and retry_after_from_response:
+- Rate limits, server errors and connection errors are retried with exponential backoff, or after the delay
+  the provider asked for (Retry-After, retry-after-ms, or the retryDelay of a Gemini error)
+- Errors that would fail again (e.g. context_length_exceeded, or any other 4xx) raise at once
+- Answers with status 200 and an "error" body count as failed calls
+- Requests carry the same authentication header as the dispatcher's (api-key for Azure, Bearer otherwise)
+"""
+
+import asyncio  # for waiting between attempts
+import random  # for jittering the backoff
+
+import aiohttp  # for making API calls
+
+from process_api_requests_from_file import classify_error, request_header, retry_after_from_response
+
+
+async def chat_completion(
+    session: aiohttp.ClientSession,
+    url: str,
+    api_key: str,
+    body: dict,
+    max_attempts: int = 8,
+) -> dict:
+    """Send one chat completion request and return the response body; raises RuntimeError if it fails for good."""
+    headers = request_header(url, api_key) if api_key else {}
+    for attempt in range(max_attempts):
+        seconds_to_wait = min(2**attempt, 60) * random.uniform(0.5, 1.0)
+        try:
+            async with session.post(url, json=body, headers=headers) as response:
+                try:
+                    response_json = await response.json(content_type=None)
+                except ValueError:
+                    response_json = None  # e.g. an HTML error page from a proxy
+                if response.status < 400 and isinstance(response_json, dict) and "error" not in response_json:
+                    return response_json
+                error_class = classify_error(response.status, response_json)
+                if error_class == "non_retriable" or attempt == max_attempts - 1:
+                    raise RuntimeError(f"{url} failed with {response.status}: {response_json}")
+                seconds_to_wait = retry_after_from_response(response.headers, response_json) or seconds_to_wait
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if attempt == max_attempts - 1:
+                raise RuntimeError(f"{url} failed: {e!r}") from e
+        await asyncio.sleep(seconds_to_wait)
@@ -0,0 +1,217 @@
+"""
+DISPATCHER METRICS
+
+Counters, gauges and streaming latency histograms for process_api_requests_from_file.py, so a long run can
+be watched while it is going: requests and tokens per minute, requests in flight, retry backlog, and
+latency percentiles per endpoint.
+
+Histograms have fixed log-spaced buckets (about 19% apart, from 1 ms to about an hour), so memory does not
+grow with the number of requests and percentiles are accurate to roughly one bucket.
+
+Snapshots are written every `interval` seconds, atomically:
+- as a Prometheus textfile (e.g. for node_exporter's textfile collector) if the path ends in .prom
+- as JSON otherwise
+"""
+
+import asyncio  # for writing snapshots periodically
+import bisect  # for finding histogram buckets
+import collections  # for counters and rate windows
+import logging  # for logging a summary line per snapshot
+import os  # for replacing snapshot files atomically
+import time  # for rates and uptime
+from dataclasses import dataclass, field  # for storing metrics
+
+import orjson  # for JSON snapshots
+
+PREFIX = "medal_dispatcher_"
+BUCKET_BOUNDS = tuple(0.001 * 2 ** (i / 4) for i in range(88))  # 1 ms to ~67 min
+
+
+@dataclass
+class Histogram:
+    """Streaming histogram of durations in seconds."""
+
+    counts: list = field(default_factory=lambda: [0] * (len(BUCKET_BOUNDS) + 1))
+    count: int = 0
+    total: float = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(BUCKET_BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def quantile(self, q: float):
+        """Estimate of the q-quantile (0 <= q <= 1), interpolated within its bucket; None if empty."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for i, bucket_count in enumerate(self.counts):
+            if bucket_count and cumulative + bucket_count >= rank:
+                lower = BUCKET_BOUNDS[i - 1] if i > 0 else 0.0
+                upper = BUCKET_BOUNDS[i] if i < len(BUCKET_BOUNDS) else lower
+                return lower + (upper - lower) * (rank - cumulative) / bucket_count
+            cumulative += bucket_count
+        return BUCKET_BOUNDS[-1]
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+        }
+
+
+@dataclass
+class RateWindow:
+    """Sum of values added over the last `window_seconds`, e.g. completed requests or tokens."""
+
+    window_seconds: float = 60.0
+    events: collections.deque = field(default_factory=collections.deque)
+    window_sum: float = 0.0
+    start_time: float = field(default_factory=time.monotonic)
+
+    def add(self, value: float = 1.0):
+        self.events.append((time.monotonic(), value))
+        self.window_sum += value
+
+    def per_minute(self) -> float:
+        current_time = time.monotonic()
+        while self.events and self.events[0][0] < current_time - self.window_seconds:
+            self.window_sum -= self.events.popleft()[1]
+        seconds = min(self.window_seconds, max(current_time - self.start_time, 1e-9))
+        return self.window_sum * 60 / seconds
+
+
+def labels_key(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+def prometheus_labels(labels, extra: str = "") -> str:
+    parts = [f'{name}="{value}"' for name, value in labels]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+@dataclass
+class DispatcherMetrics:
+    """Metrics of one dispatcher run. Gauges are functions evaluated when a snapshot is taken."""
+
+    counters: collections.Counter = field(default_factory=collections.Counter)
+    histograms: dict = field(default_factory=dict)
+    gauges: dict = field(default_factory=dict)
+    request_rate: RateWindow = field(default_factory=RateWindow)
+    token_rate: RateWindow = field(default_factory=RateWindow)
+    start_time: float = field(default_factory=time.monotonic)
+
+    def increment(self, name: str, value: float = 1, **labels):
+        self.counters[(name, labels_key(labels))] += value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, labels_key(labels))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    def register_gauge(self, name: str, function):
+        """`function` returns a number, or a list of (labels dict, number) pairs."""
+        self.gauges[name] = function
+
+    def gauge_values(self) -> list:
+        values = []
+        for name, function in self.gauges.items():
+            value = function()
+            if isinstance(value, list):
+                values.extend((name, labels_key(labels), v) for labels, v in value)
+            else:
+                values.append((name, (), value))
+        return values
+
+    def snapshot(self) -> dict:
+        return {
+            "time": time.time(),
+            "uptime_seconds": time.monotonic() - self.start_time,
+            "requests_per_minute": self.request_rate.per_minute(),
+            "tokens_per_minute": self.token_rate.per_minute(),
+            "counters": [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(self.counters.items())
+            ],
+            "gauges": [
+                {"name": name, "labels": dict(labels), "value": value}
+                for name, labels, value in self.gauge_values()
+            ],
+            "histograms": [
+                {"name": name, "labels": dict(labels), **histogram.summary()}
+                for (name, labels), histogram in sorted(self.histograms.items())
+            ],
+        }
+
+    def prometheus_text(self) -> str:
+        lines = [
+            f"{PREFIX}uptime_seconds {time.monotonic() - self.start_time:.3f}",
+            f"{PREFIX}requests_per_minute {self.request_rate.per_minute():.3f}",
+            f"{PREFIX}tokens_per_minute {self.token_rate.per_minute():.3f}",
+        ]
+        typed = set()
+
+        def declare(name: str, metric_type: str):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {PREFIX}{name} {metric_type}")
+
+        for (name, labels), value in sorted(self.counters.items()):
+            declare(name, "counter")
+            lines.append(f"{PREFIX}{name}{prometheus_labels(labels)} {value}")
+        for name, labels, value in self.gauge_values():
+            declare(name, "gauge")
+            lines.append(f"{PREFIX}{name}{prometheus_labels(labels)} {value}")
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            declare(name, "histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(BUCKET_BOUNDS, histogram.counts):
+                cumulative += bucket_count
+                bucket_labels = prometheus_labels(labels, f'le="{bound:.6g}"')
+                lines.append(f"{PREFIX}{name}_bucket{bucket_labels} {cumulative}")
+            bucket_labels = prometheus_labels(labels, 'le="+Inf"')
+            lines.append(f"{PREFIX}{name}_bucket{bucket_labels} {histogram.count}")
+            lines.append(f"{PREFIX}{name}_sum{prometheus_labels(labels)} {histogram.total:.6f}")
+            lines.append(f"{PREFIX}{name}_count{prometheus_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str):
+        """Write a snapshot; readers never see a partial file."""
+        if path.endswith(".prom"):
+            data = self.prometheus_text().encode()
+        else:
+            data = orjson.dumps(self.snapshot())
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f"{path}.tmp", "wb") as f:
+            f.write(data)
+        os.replace(f"{path}.tmp", path)
+
+    def summary(self) -> str:
+        """One line for the log."""
+        gauges = {name: value for name, labels, value in self.gauge_values() if not labels}
+        gauge_text = ", ".join(f"{name} {value:g}" for name, value in gauges.items())
+        return (
+            f"{self.request_rate.per_minute():.0f} requests/min, "
+            f"{self.token_rate.per_minute():.0f} tokens/min, {gauge_text}"
+        )
+
+    async def run(self, path: str = None, interval: float = 15.0):
+        """Log a summary and write a snapshot every `interval` seconds until cancelled."""
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                logging.info(f"Progress: {self.summary()}")
+                if path:
+                    self.write(path)
+        finally:
+            if path:
+                self.write(path)
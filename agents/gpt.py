@@ -1,17 +1,17 @@
 import os
-import openai
-from openai import AzureOpenAI
+import sys
 import orjson
 import argparse
 import logging
-from process_api_requests_from_file import process_api_requests_from_file
+from batch_orchestrator import BatchJob, run_batches
+from batch_router import route_requests
+from process_api_requests_from_file import load_endpoints_file, process_api_requests_from_files
 import asyncio
 
 def main(args):
     
     if args.provider == 'openai':
         url = "https://api.openai.com/v1/chat/completions"
-        client = openai.OpenAI(api_key=args.api_key)
     elif args.provider == "deepseek":
         url = "https://api.deepseek.com/v1/chat/completions"
     elif args.provider =="openrouter":
@@ -21,79 +21,74 @@ def main(args):
     elif args.provider == "azure":
         url = "https://gptreasoners.openai.azure.com/openai/deployments/gpt-4.1/chat/completions?api-version=2025-01-01-preview"
     else:
-        raise NotImplementedError(f"provider {args.provider} not implemented")
+        if args.request_url is None and args.endpoints_file is None:
+            raise NotImplementedError(f"provider {args.provider} not implemented")
+        url = None  # e.g. local vLLM servers, given by --request_url or --endpoints_file
+    if args.request_url:
+        # e.g. agents/mock_openai_server.py, to measure the upload path offline
+        url = args.request_url
     
     if args.type == "upload":
         if args.input_file is None:
             raise ValueError("input file is required")
 
-        input_file_name = os.path.splitext(os.path.basename(args.input_file))[0]
-        previous_directory = os.path.basename(os.path.dirname(args.input_file))
-        two_directories_up = os.path.basename(os.path.dirname(os.path.dirname(args.input_file)))
-        three_directories_up = os.path.basename(os.path.dirname(os.path.dirname(os.path.dirname(args.input_file))))
+        requests_and_save_filepaths = []
+        batch_jobs = []
+        routed_filepaths = []
+        for input_file in args.input_file:
+            input_file_name = os.path.splitext(os.path.basename(input_file))[0]
+            previous_directory = os.path.basename(os.path.dirname(input_file))
+            two_directories_up = os.path.basename(os.path.dirname(os.path.dirname(input_file)))
+            three_directories_up = os.path.basename(os.path.dirname(os.path.dirname(os.path.dirname(input_file))))
 
-        path = f"submitted_batches/{three_directories_up}/{two_directories_up}/{previous_directory}"
+            path = f"submitted_batches/{three_directories_up}/{two_directories_up}/{previous_directory}"
 
-        if args.batched=="True" and args.provider == "openai":
-            batch_file = client.files.create(
-                file=open(args.input_file, "rb"),
-                purpose="batch"
-            )
-            batch_job = client.batches.create(
-                input_file_id=batch_file.id,
-                endpoint="/v1/chat/completions",
-                completion_window="24h"
-            )
-            batch_job = client.batches.retrieve(batch_job.id)
-            print(f"batch job for file {args.input_file} was created with id {batch_job.id}")
-            print(batch_job)
-            
-            #dump information to a file
-            #create a directory if it does not exist
-            if not os.path.exists(path):
-                os.makedirs(path)
+            if args.batched=="auto" and args.provider == "openai":
+                routed_filepaths.append((input_file,
+                                         f"{path}/{input_file_name}.json",
+                                         f"completed_batches/{three_directories_up}/{two_directories_up}/{previous_directory}/{input_file_name}.jsonl"))
 
-            with open(f"{path}/{input_file_name}.json", "w") as f:
-                f.write(orjson.dumps({"id": batch_job.id, "input_file_id_openai":batch_job.input_file_id, "input_file_local": args.input_file, "created_at": batch_job.created_at}).decode('utf-8'))
-        
-        else:
-            path = f"completed_batches/{three_directories_up}/{two_directories_up}/{previous_directory}"
-            if not os.path.exists(path):
-                os.makedirs(path)
+            elif args.batched=="True" and args.provider == "openai":
+                stub_filepath = f"{path}/{input_file_name}.json"
+                save_filepath = f"completed_batches/{three_directories_up}/{two_directories_up}/{previous_directory}/{input_file_name}.jsonl"
+                # reattaches to the batches of an earlier (e.g. interrupted) run on the same requests
+                batch_jobs.append(BatchJob.for_requests_file(input_file, stub_filepath, save_filepath))
             
-            if f"{input_file_name}.jsonl" in os.listdir(path):
-                print(f"Warning: {input_file_name}.jsonl already exists in {path}")
-                os.remove(os.path.join(path, f"{input_file_name}.jsonl"))
-            
-            asyncio.run(
-                process_api_requests_from_file(requests_filepath=args.input_file,
-                                           save_filepath=f"{path}/{input_file_name}.jsonl",
-                                           request_url=url,
-                                           api_key=args.api_key,
-                                           max_requests_per_minute=float(2_000 * 0.5),
-                                           max_tokens_per_minute=float(200_000 * 0.5),
-                                           token_encoding_name="cl100k_base",
-                                           max_attempts=5,
-                                           logging_level=int(logging.ERROR))
+            else:
+                path = f"completed_batches/{three_directories_up}/{two_directories_up}/{previous_directory}"
+                if not os.path.exists(path):
+                    os.makedirs(path)
+                requests_and_save_filepaths.append((input_file, f"{path}/{input_file_name}.jsonl"))
+
+        if routed_filepaths:
+            # the bulk of large files through the Batch API, small files and stragglers online
+            return asyncio.run(
+                route_requests(routed_filepaths,
+                               batch_kwargs={**batch_kwargs(args), "on_complete": None},
+                               online_kwargs=online_kwargs(args, url),
+                               deadline=args.deadline * 3600 if args.deadline else None,
+                               max_online_share=args.max_online_share,
+                               min_batch_requests=args.min_batch_requests,
+                               on_complete=args.on_complete)
             )
-            
-            #sort the responses by id
-            with open(f"{path}/{input_file_name}.jsonl", 'r') as f:
-                lines = [orjson.loads(line) for line in f]
-                lines.sort(key=lambda x: x[0])
-                responses = [line for line in lines]
 
-            with open(f"{path}/{input_file_name}.jsonl", 'w') as f:
-                for response in responses:
-                    res = {"custom_id":response[1]["custom_id"],
-                            "response":{"body":response[2]}
-                            }
-                    f.write(orjson.dumps(res).decode('utf-8') + '\n')
+        if batch_jobs:
+            # shards, submits and (with --wait True) waits for every batch, then merges them into completed_batches
+            return asyncio.run(run_batches(batch_jobs, **batch_kwargs(args)))
+
+        if requests_and_save_filepaths:
+            # all files share one connection pool and one rate budget;
+            # partial results of an interrupted run on the same file are kept; anything else is overwritten
+            asyncio.run(
+                process_api_requests_from_files(requests_and_save_filepaths=requests_and_save_filepaths,
+                                           record_format="batch",
+                                           ordered_output=True,
+                                           **online_kwargs(args, url))
+            )
             
     elif args.type == "download":
 
         data = orjson.loads(open(args.batch_id, 'rb').read())
-        batch_id = data["id"]
         input_file = data["input_file_local"]
         input_file_name = os.path.splitext(os.path.basename(input_file))[0]
         previous_directory = os.path.basename(os.path.dirname(input_file))
@@ -102,22 +97,37 @@ def main(args):
 
         path = f"completed_batches/{three_directories_up}/{two_directories_up}/{previous_directory}"
 
-        batch_job = client.batches.retrieve(batch_id)
-        print(batch_job)
-        
-        if batch_job.status != "completed":
-            print("batch job is not completed yet")
-            return
-        
-        result_file_id = batch_job.output_file_id
-        result = client.files.content(result_file_id).content  
-        
-        if not os.path.exists(path):
-            os.makedirs(path)
-            
-        result_file_name = f"{path}/{input_file_name}.jsonl"
-        with open(result_file_name, 'wb') as file:
-            file.write(result)
+        # reattaches to the submitted batches; with --wait False, returns if they are not completed yet
+        batch_job = BatchJob.from_stub(args.batch_id, save_filepath=f"{path}/{input_file_name}.jsonl")
+        return asyncio.run(run_batches([batch_job], **batch_kwargs(args)))
+
+
+def online_kwargs(args, url):
+    return dict(request_url=url,
+                api_key=args.api_key,
+                max_requests_per_minute=args.max_requests_per_minute,
+                max_tokens_per_minute=args.max_tokens_per_minute,
+                token_encoding_name="cl100k_base",
+                max_attempts=5,
+                logging_level=int(logging.ERROR),
+                adaptive_rate_limit=args.adaptive_rate_limit=="True",
+                resume=True,
+                max_requests_in_flight=args.max_requests_in_flight,
+                endpoints=load_endpoints_file(args.endpoints_file) if args.endpoints_file else None,
+                hedge_percentile=args.hedge_percentile,
+                hedge_budget=args.hedge_budget,
+                record_timings=True,
+                metrics_path=args.metrics_path,
+                cache_path=args.cache_path or None)
+
+
+def batch_kwargs(args):
+    return dict(api_key=args.api_key,
+                base_url=args.base_url,
+                wait=args.wait=="True",
+                poll_interval=args.poll_interval,
+                canonical_format=args.canonical_format=="True",
+                on_complete=args.on_complete)
         
     
 if __name__ == '__main__':
@@ -129,12 +139,21 @@ if __name__ == '__main__':
                         help='openai api key')
     parser.add_argument('--input_file',
                         type=str,
+                        nargs='+',
                         required=False,
-                        help='input file')
+                        help='input file(s); several files are sent in one run under a shared rate limit')
     parser.add_argument('--provider',
                         type=str,
                         default='openai',
                         help='provider')
+    parser.add_argument('--request_url',
+                        type=str,
+                        default=None,
+                        help='override the chat completions URL of the provider (online inference only)')
+    parser.add_argument('--endpoints_file',
+                        type=str,
+                        default=None,
+                        help='json list of endpoints (URL, key, limits, models) to spread online requests over, e.g. several keys or vLLM replicas')
     parser.add_argument('--type',
                         choices=['upload','download'],
                         help='upload or retreive existing batch job')
@@ -145,7 +164,72 @@ if __name__ == '__main__':
     parser.add_argument('--batched',
                         type=str,
                         default="False",
-                        help='Whether to use batch inference or not')
+                        help='Whether to use batch inference or not; "auto" sends large files through the Batch API and small files and stragglers online (see agents/batch_router.py)')
+    parser.add_argument('--deadline',
+                        type=float,
+                        default=None,
+                        help='hours until the results are needed with --batched auto; batches still running near it are cancelled and finished online')
+    parser.add_argument('--max_online_share',
+                        type=float,
+                        default=0.1,
+                        help='cost target with --batched auto: at most this share of the requests of a batched file is sent online')
+    parser.add_argument('--min_batch_requests',
+                        type=int,
+                        default=1000,
+                        help='with --batched auto, files with fewer requests (e.g. regeneration rounds) are sent online')
+    parser.add_argument('--base_url',
+                        type=str,
+                        default="https://api.openai.com/v1",
+                        help='base URL of the Files and Batches endpoints used with --batched True (e.g. of agents/mock_openai_server.py)')
+    parser.add_argument('--wait',
+                        type=str,
+                        default="True",
+                        help='Whether to wait for submitted batches to finish and merge their results, or to return after submitting / checking them once')
+    parser.add_argument('--poll_interval',
+                        type=float,
+                        default=30.0,
+                        help='seconds between the first status checks of a batch (backs off up to 10 minutes)')
+    parser.add_argument('--canonical_format',
+                        type=str,
+                        default="False",
+                        help='Whether to write batch answers as {"custom_id", "response": {"body"}} records, like online inference, instead of the provider records')
+    parser.add_argument('--on_complete',
+                        type=str,
+                        default=None,
+                        help='shell command to run once every batch is merged, e.g. the next pipeline step')
+    parser.add_argument('--max_requests_per_minute',
+                        type=float,
+                        default=2_000 * 0.5,
+                        help='starting request rate for online inference (adapted to the provider while running)')
+    parser.add_argument('--max_tokens_per_minute',
+                        type=float,
+                        default=200_000 * 0.5,
+                        help='starting token rate for online inference (adapted to the provider while running)')
+    parser.add_argument('--max_requests_in_flight',
+                        type=int,
+                        default=500,
+                        help='maximum number of concurrent requests (and open connections) for online inference')
+    parser.add_argument('--hedge_percentile',
+                        type=float,
+                        default=None,
+                        help='send a duplicate of online requests slower than this latency percentile of the run (e.g. 95); off by default')
+    parser.add_argument('--hedge_budget',
+                        type=float,
+                        default=0.05,
+                        help='maximum number of hedged duplicates per online request')
+    parser.add_argument('--metrics_path',
+                        type=str,
+                        default=None,
+                        help='file to write live dispatcher metrics to during online inference (.prom for Prometheus textfile format, JSON otherwise)')
+    parser.add_argument('--cache_path',
+                        type=str,
+                        default=None,
+                        help='response cache for requests with temperature <= 0.1, e.g. cache/api_responses.sqlite (off by default)')
+    parser.add_argument('--adaptive_rate_limit',
+                        type=str,
+                        default="True",
+                        help='Whether to adapt the request and token rates to the provider rate limit headers and errors')
     
     args = parser.parse_args()
-    main(args)
\ No newline at end of file
+    # the exit status of the --on_complete command, if it ran
+    sys.exit(main(args))
\ No newline at end of file
@@ -0,0 +1,500 @@
+"""
+MOCK OPENAI SERVER
+
+Local stand-in for an OpenAI-compatible /v1/chat/completions endpoint, to measure the dispatcher
+(process_api_requests_from_file.py, agents/gpt.py --request_url) without paying a provider.
+
+Features:
+- Configurable latency: constant, uniform, exponential or lognormal around a mean
+- Rate limits in requests and tokens per minute, answered with 429s, Retry-After and x-ratelimit-* headers
+  like the OpenAI API
+- Random 429 and 500 errors, to exercise retries
+- Completions of a configurable length, with a usage field
+- GET /stats returns request counts and the latency percentiles measured by the server (?reset=1 clears them)
+- Files and Batches endpoints (upload, create, retrieve, cancel, download), to run batch_orchestrator.py
+  offline: a batch takes --batch_seconds to complete and answers each request like /v1/chat/completions,
+  with a share of --batch_error_rate going to its error file
+- File downloads honour Range requests; a share of --download_interruption_rate of them is cut off halfway,
+  to exercise resumed downloads
+
+Example command:
+```
+python agents/mock_openai_server.py --port 8000 --latency_distribution lognormal --latency_mean 0.8 \
+  --requests_per_minute 5000 --tokens_per_minute 2000000 --error_rate_500 0.01
+```
+"""
+
+import argparse  # for running script from command line
+import asyncio  # for simulating latency and batch processing
+import itertools  # for numbering files and batches
+import math  # for the lognormal latency distribution
+import random  # for sampling latencies and errors
+import statistics  # for latency percentiles
+import time  # for refilling rate limit buckets
+from dataclasses import dataclass, field  # for storing the server configuration and state
+
+import orjson  # for batch input and output files
+from aiohttp import web  # for serving requests
+
+
+@dataclass
+class MockServerConfig:
+    """Behaviour of the mock server. Rate limits of None are not enforced."""
+
+    latency_distribution: str = "lognormal"  # constant, uniform, exponential or lognormal
+    latency_mean: float = 0.5  # seconds
+    latency_sigma: float = 0.5  # spread of uniform (+/- seconds) and lognormal (sigma of the log)
+    requests_per_minute: float = None
+    tokens_per_minute: float = None
+    error_rate_429: float = 0.0
+    error_rate_500: float = 0.0
+    retry_after: float = 1.0  # seconds, sent with injected 429s
+    completion_tokens: int = 150  # mean length of a completion, capped by max_tokens
+    batch_seconds: float = 5.0  # time from creating a batch to its completion
+    batch_error_rate: float = 0.0  # share of batch requests answered in the error file
+    download_interruption_rate: float = 0.0  # share of file downloads cut off halfway
+    seed: int = None
+
+    def sample_latency(self, rng: random.Random) -> float:
+        if self.latency_distribution == "constant":
+            return self.latency_mean
+        if self.latency_distribution == "uniform":
+            return max(
+                0.0,
+                rng.uniform(
+                    self.latency_mean - self.latency_sigma,
+                    self.latency_mean + self.latency_sigma,
+                ),
+            )
+        if self.latency_distribution == "exponential":
+            return rng.expovariate(1 / self.latency_mean)
+        if self.latency_distribution == "lognormal":
+            # choose mu so that the distribution has the requested mean
+            mu = math.log(self.latency_mean) - self.latency_sigma**2 / 2
+            return rng.lognormvariate(mu, self.latency_sigma)
+        raise ValueError(f"unknown latency distribution {self.latency_distribution}")
+
+
+@dataclass
+class MockServerState:
+    """Rate limit buckets and statistics of a running server."""
+
+    config: MockServerConfig
+    rng: random.Random = field(init=False)
+    available_request_capacity: float = field(init=False)
+    available_token_capacity: float = field(init=False)
+    last_update_time: float = field(init=False)
+    num_requests: int = field(init=False, default=0)
+    num_responses_by_status: dict = field(init=False, default_factory=dict)
+    latencies: list = field(init=False, default_factory=list)
+    files: dict = field(init=False, default_factory=dict)  # file id -> (metadata, contents)
+    batches: dict = field(init=False, default_factory=dict)  # batch id -> batch object
+    batch_tasks: set = field(init=False, default_factory=set)
+    ids: itertools.count = field(init=False, default_factory=itertools.count)
+
+    def __post_init__(self):
+        self.rng = random.Random(self.config.seed)
+        self.available_request_capacity = self.config.requests_per_minute or 0
+        self.available_token_capacity = self.config.tokens_per_minute or 0
+        self.last_update_time = time.monotonic()
+
+    def refill(self):
+        current_time = time.monotonic()
+        seconds_since_update = current_time - self.last_update_time
+        self.last_update_time = current_time
+        if self.config.requests_per_minute:
+            self.available_request_capacity = min(
+                self.available_request_capacity
+                + self.config.requests_per_minute * seconds_since_update / 60,
+                self.config.requests_per_minute,
+            )
+        if self.config.tokens_per_minute:
+            self.available_token_capacity = min(
+                self.available_token_capacity
+                + self.config.tokens_per_minute * seconds_since_update / 60,
+                self.config.tokens_per_minute,
+            )
+
+    def admit(self, num_tokens: int):
+        """Take a request from the buckets. Returns None, or the seconds to wait if a limit is exceeded."""
+        self.refill()
+        seconds_to_wait = 0.0
+        if self.config.requests_per_minute and self.available_request_capacity < 1:
+            seconds_to_wait = max(
+                seconds_to_wait,
+                (1 - self.available_request_capacity)
+                * 60
+                / self.config.requests_per_minute,
+            )
+        if self.config.tokens_per_minute and self.available_token_capacity < num_tokens:
+            seconds_to_wait = max(
+                seconds_to_wait,
+                (num_tokens - self.available_token_capacity)
+                * 60
+                / self.config.tokens_per_minute,
+            )
+        if seconds_to_wait > 0:
+            return seconds_to_wait
+        self.available_request_capacity -= 1
+        self.available_token_capacity -= num_tokens
+        return None
+
+    def rate_limit_headers(self) -> dict:
+        headers = {}
+        if self.config.requests_per_minute:
+            headers["x-ratelimit-limit-requests"] = str(int(self.config.requests_per_minute))
+            headers["x-ratelimit-remaining-requests"] = str(
+                max(0, int(self.available_request_capacity))
+            )
+            headers["x-ratelimit-reset-requests"] = (
+                f"{max(0.0, 1 - self.available_request_capacity) * 60 / self.config.requests_per_minute:.3f}s"
+            )
+        if self.config.tokens_per_minute:
+            headers["x-ratelimit-limit-tokens"] = str(int(self.config.tokens_per_minute))
+            headers["x-ratelimit-remaining-tokens"] = str(
+                max(0, int(self.available_token_capacity))
+            )
+            headers["x-ratelimit-reset-tokens"] = (
+                f"{(self.config.tokens_per_minute - max(0.0, self.available_token_capacity)) * 60 / self.config.tokens_per_minute:.3f}s"
+            )
+        return headers
+
+    def record(self, status: int, latency: float):
+        self.num_responses_by_status[status] = (
+            self.num_responses_by_status.get(status, 0) + 1
+        )
+        self.latencies.append(latency)
+
+    def stats(self) -> dict:
+        latencies = self.latencies or [0.0]
+        percentiles = (
+            statistics.quantiles(latencies, n=100, method="inclusive")
+            if len(latencies) > 1
+            else latencies * 99
+        )
+        return {
+            "num_requests": self.num_requests,
+            "num_responses_by_status": {
+                str(status): count
+                for status, count in sorted(self.num_responses_by_status.items())
+            },
+            "latency_p50": percentiles[49],
+            "latency_p99": percentiles[98],
+            "latency_mean": statistics.fmean(latencies),
+        }
+
+    def reset(self):
+        self.num_requests = 0
+        self.num_responses_by_status = {}
+        self.latencies = []
+
+    def add_file(self, contents: bytes, filename: str, purpose: str) -> dict:
+        file = {
+            "id": f"file-mock-{next(self.ids)}",
+            "object": "file",
+            "bytes": len(contents),
+            "created_at": int(time.time()),
+            "filename": filename,
+            "purpose": purpose,
+        }
+        self.files[file["id"]] = (file, contents)
+        return file
+
+
+def error_response(status: int, message: str, error_type: str, headers: dict):
+    return web.json_response(
+        {"error": {"message": message, "type": error_type, "code": None}},
+        status=status,
+        headers=headers,
+    )
+
+
+def num_prompt_tokens(body: dict) -> int:
+    """Rough token count of the prompt (4 characters per token), to charge the token bucket."""
+    num_characters = 0
+    for message in body.get("messages", []):
+        content = message.get("content") or ""
+        if isinstance(content, list):
+            content = "".join(part.get("text", "") for part in content)
+        num_characters += len(content)
+    return num_characters // 4 + 4 * len(body.get("messages", []))
+
+
+def max_completion_tokens(body: dict) -> int:
+    return body.get("max_completion_tokens") or body.get("max_tokens") or 4096
+
+
+def completion(state: MockServerState, body: dict) -> dict:
+    """A chat completion of random length for a request body."""
+    prompt_tokens = num_prompt_tokens(body)
+    max_tokens = max_completion_tokens(body)
+    completion_tokens = [
+        max(1, min(max_tokens, int(state.rng.expovariate(1 / state.config.completion_tokens))))
+        for _ in range(body.get("n", 1))
+    ]
+    return {
+        "id": f"chatcmpl-mock-{next(state.ids)}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model"),
+        "choices": [
+            {
+                "index": index,
+                "message": {"role": "assistant", "content": "lorem " * num_tokens},
+                "finish_reason": "length" if num_tokens == max_tokens else "stop",
+            }
+            for index, num_tokens in enumerate(completion_tokens)
+        ],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": sum(completion_tokens),
+            "total_tokens": prompt_tokens + sum(completion_tokens),
+        },
+    }
+
+
+async def chat_completions(request: web.Request):
+    state = request.app["state"]
+    config = state.config
+    start_time = time.monotonic()
+    state.num_requests += 1
+    body = await request.json()
+
+    prompt_tokens = num_prompt_tokens(body)
+    n = body.get("n", 1)
+    max_tokens = max_completion_tokens(body)
+
+    # enforced limits reject the request right away, like the provider
+    seconds_to_wait = state.admit(prompt_tokens + n * max_tokens)
+    if seconds_to_wait is not None:
+        headers = state.rate_limit_headers()
+        headers["retry-after"] = f"{seconds_to_wait:.3f}"
+        state.record(429, time.monotonic() - start_time)
+        return error_response(
+            429,
+            f"Rate limit reached. Please try again in {seconds_to_wait:.3f}s.",
+            "requests",
+            headers,
+        )
+
+    await asyncio.sleep(config.sample_latency(state.rng))
+
+    headers = state.rate_limit_headers()
+    draw = state.rng.random()
+    if draw < config.error_rate_429:
+        headers["retry-after"] = str(config.retry_after)
+        state.record(429, time.monotonic() - start_time)
+        return error_response(
+            429, "Rate limit reached (injected).", "requests", headers
+        )
+    if draw < config.error_rate_429 + config.error_rate_500:
+        state.record(500, time.monotonic() - start_time)
+        return error_response(
+            500, "The server had an error while processing your request (injected).", "server_error", headers
+        )
+
+    response = completion(state, body)
+    # refund the part of the max_tokens reservation that was not generated, as the provider does
+    state.available_token_capacity += n * max_tokens - response["usage"]["completion_tokens"]
+    state.record(200, time.monotonic() - start_time)
+    return web.json_response(response, headers=headers)
+
+
+async def get_stats(request: web.Request):
+    state = request.app["state"]
+    stats = state.stats()
+    if request.query.get("reset"):
+        state.reset()
+    return web.json_response(stats)
+
+
+async def upload_file(request: web.Request):
+    state = request.app["state"]
+    form = await request.post()
+    upload = form["file"]
+    file = state.add_file(upload.file.read(), upload.filename, form.get("purpose", "batch"))
+    return web.json_response(file)
+
+
+async def get_file(request: web.Request):
+    state = request.app["state"]
+    if request.match_info["file_id"] not in state.files:
+        return error_response(404, "No such File object.", "invalid_request_error", {})
+    file, _ = state.files[request.match_info["file_id"]]
+    return web.json_response(file)
+
+
+async def get_file_content(request: web.Request):
+    state = request.app["state"]
+    if request.match_info["file_id"] not in state.files:
+        return error_response(404, "No such File object.", "invalid_request_error", {})
+    _, contents = state.files[request.match_info["file_id"]]
+    status, headers, start = 200, {}, 0
+    if request.http_range.start is not None:
+        start = request.http_range.start
+        if start >= len(contents):
+            return web.Response(status=416, headers={"Content-Range": f"bytes */{len(contents)}"})
+        status = 206
+        headers["Content-Range"] = f"bytes {start}-{len(contents) - 1}/{len(contents)}"
+    body = contents[start:]
+    response = web.StreamResponse(status=status, headers=headers)
+    response.content_type = "application/octet-stream"
+    response.content_length = len(body)
+    await response.prepare(request)
+    if state.rng.random() < state.config.download_interruption_rate:
+        await response.write(body[: len(body) // 2])
+        request.transport.close()
+        return response
+    await response.write(body)
+    await response.write_eof()
+    return response
+
+
+async def create_batch(request: web.Request):
+    state = request.app["state"]
+    body = await request.json()
+    if body.get("input_file_id") not in state.files:
+        return error_response(400, "Invalid input_file_id.", "invalid_request_error", {})
+    batch = {
+        "id": f"batch_mock-{next(state.ids)}",
+        "object": "batch",
+        "endpoint": body.get("endpoint"),
+        "input_file_id": body["input_file_id"],
+        "completion_window": body.get("completion_window", "24h"),
+        "status": "validating",
+        "output_file_id": None,
+        "error_file_id": None,
+        "created_at": int(time.time()),
+        "completed_at": None,
+        "request_counts": {"total": 0, "completed": 0, "failed": 0},
+        "metadata": body.get("metadata"),
+    }
+    state.batches[batch["id"]] = batch
+    task = asyncio.get_running_loop().create_task(process_batch(state, batch))
+    state.batch_tasks.add(task)
+    task.add_done_callback(state.batch_tasks.discard)
+    return web.json_response(batch)
+
+
+async def process_batch(state: MockServerState, batch: dict):
+    """Answer the requests of a batch one by one, spread over config.batch_seconds; a cancelled batch keeps the
+    answers it has."""
+    config = state.config
+    _, contents = state.files[batch["input_file_id"]]
+    lines = [orjson.loads(line) for line in contents.splitlines() if line.strip()]
+    await asyncio.sleep(config.batch_seconds * 0.1)
+    if batch["status"] == "cancelling":
+        batch["status"] = "cancelled"
+        return
+    batch["status"] = "in_progress"
+    batch["request_counts"]["total"] = len(lines)
+    outputs, errors = [], []
+    for line in lines:
+        await asyncio.sleep(config.batch_seconds * 0.8 / len(lines))
+        if batch["status"] == "cancelling":
+            break
+        request_id = f"req_mock-{next(state.ids)}"
+        if state.rng.random() < config.batch_error_rate:
+            response = {
+                "status_code": 500,
+                "request_id": request_id,
+                "body": {"error": {"message": "The server had an error (injected).", "type": "server_error"}},
+            }
+            errors.append({"id": request_id, "custom_id": line.get("custom_id"), "response": response, "error": None})
+        else:
+            response = {"status_code": 200, "request_id": request_id, "body": completion(state, line["body"])}
+            outputs.append({"id": request_id, "custom_id": line.get("custom_id"), "response": response, "error": None})
+        batch["request_counts"].update(completed=len(outputs), failed=len(errors))
+    if batch["status"] != "cancelling":
+        batch["status"] = "finalizing"
+    await asyncio.sleep(config.batch_seconds * 0.1)
+    if outputs:
+        batch["output_file_id"] = state.add_file(
+            b"".join(orjson.dumps(x, option=orjson.OPT_APPEND_NEWLINE) for x in outputs),
+            f"{batch['id']}_output.jsonl",
+            "batch_output",
+        )["id"]
+    if errors:
+        batch["error_file_id"] = state.add_file(
+            b"".join(orjson.dumps(x, option=orjson.OPT_APPEND_NEWLINE) for x in errors),
+            f"{batch['id']}_error.jsonl",
+            "batch_output",
+        )["id"]
+    batch["status"] = "cancelled" if batch["status"] == "cancelling" else "completed"
+    batch["completed_at"] = int(time.time())
+
+
+async def get_batch(request: web.Request):
+    state = request.app["state"]
+    batch = state.batches.get(request.match_info["batch_id"])
+    if batch is None:
+        return error_response(404, "No such Batch object.", "invalid_request_error", {})
+    return web.json_response(batch)
+
+
+async def cancel_batch(request: web.Request):
+    state = request.app["state"]
+    batch = state.batches.get(request.match_info["batch_id"])
+    if batch is None:
+        return error_response(404, "No such Batch object.", "invalid_request_error", {})
+    if batch["status"] in ("validating", "in_progress"):
+        batch["status"] = "cancelling"
+    return web.json_response(batch)
+
+
+def make_app(config: MockServerConfig) -> web.Application:
+    """Build the mock server application; run it with web.run_app or an AppRunner."""
+    app = web.Application(client_max_size=64 * 1024**2)
+    app["state"] = MockServerState(config)
+    app.router.add_post("/v1/chat/completions", chat_completions)
+    app.router.add_get("/stats", get_stats)
+    app.router.add_post("/v1/files", upload_file)
+    app.router.add_get("/v1/files/{file_id}", get_file)
+    app.router.add_get("/v1/files/{file_id}/content", get_file_content)
+    app.router.add_post("/v1/batches", create_batch)
+    app.router.add_get("/v1/batches/{batch_id}", get_batch)
+    app.router.add_post("/v1/batches/{batch_id}/cancel", cancel_batch)
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="local OpenAI-compatible server for load-testing the request dispatcher"
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--latency_distribution",
+        choices=["constant", "uniform", "exponential", "lognormal"],
+        default="lognormal",
+    )
+    parser.add_argument("--latency_mean", type=float, default=0.5)
+    parser.add_argument("--latency_sigma", type=float, default=0.5)
+    parser.add_argument("--requests_per_minute", type=float, default=None)
+    parser.add_argument("--tokens_per_minute", type=float, default=None)
+    parser.add_argument("--error_rate_429", type=float, default=0.0)
+    parser.add_argument("--error_rate_500", type=float, default=0.0)
+    parser.add_argument("--retry_after", type=float, default=1.0)
+    parser.add_argument("--completion_tokens", type=int, default=150)
+    parser.add_argument("--batch_seconds", type=float, default=5.0)
+    parser.add_argument("--batch_error_rate", type=float, default=0.0)
+    parser.add_argument("--download_interruption_rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    config = MockServerConfig(
+        latency_distribution=args.latency_distribution,
+        latency_mean=args.latency_mean,
+        latency_sigma=args.latency_sigma,
+        requests_per_minute=args.requests_per_minute,
+        tokens_per_minute=args.tokens_per_minute,
+        error_rate_429=args.error_rate_429,
+        error_rate_500=args.error_rate_500,
+        retry_after=args.retry_after,
+        completion_tokens=args.completion_tokens,
+        batch_seconds=args.batch_seconds,
+        batch_error_rate=args.batch_error_rate,
+        download_interruption_rate=args.download_interruption_rate,
+        seed=args.seed,
+    )
+    web.run_app(make_app(config), host=args.host, port=args.port, print=None)
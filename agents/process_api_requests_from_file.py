@@ -13,7 +13,10 @@ Features:
 - Makes requests concurrently, to maximize throughput
 - Throttles request and token usage, to stay under rate limits
 - Retries failed requests up to {max_attempts} times, to avoid missing data
+- Does not retry requests that cannot succeed (e.g. malformed, too long or filtered), so they cost no capacity
 - Logs errors, to diagnose problems with requests
+- Keeps live metrics (rates, load, latency histograms per endpoint), to find bottlenecks while a run is going
+- Processes many requests files in one run, sharing one connection pool and one rate budget
 
 Example command to call script:
 ```
@@ -31,6 +34,8 @@ python examples/api_request_parallel_processor.py \
 Inputs:
 - requests_filepath : str
     - path to the file containing the requests to be processed
+    - several paths may be given; their requests are sent in one run under one rate limit, and the results of
+      each file go to its own results file
     - file should be a jsonl file, where each line is a json object with API parameters and an optional metadata field
     - e.g., {"model": "text-embedding-3-small", "input": "embed me", "metadata": {"row_id": 1}}
     - as with all jsonl files, take care that newlines in the content are properly escaped (json.dumps does this automatically)
@@ -41,26 +46,108 @@ Inputs:
     - file will be a jsonl file, where each line is an array with the original request plus the API response
     - e.g., [{"model": "text-embedding-3-small", "input": "embed me"}, {...}]
     - if omitted, results will be saved to {requests_filename}_results.jsonl
+    - with several requests files, give one save path per requests file, in the same order
+- record_format : str, optional
+    - "raw" writes [task_id, request, response(, metadata)] arrays
+    - "batch" writes {"custom_id": ..., "response": {"body": ...}} objects, the format of OpenAI batch outputs;
+      requests that failed after all attempts carry an "error" key and a null body
+    - if omitted, will default to "raw"
+- ordered_output : bool, optional
+    - write results in the order of the requests file instead of the order they finish
+    - at most {max_reorder_buffer} results are held back waiting for an earlier request; reading stops until it finishes
+    - if omitted, will default to False
+- resume : bool, optional
+    - pick up an interrupted run instead of starting over
+    - a {save_filepath}.inprogress marker records which requests file the results belong to; it is removed once
+      every request has succeeded
+    - if the marker matches, successful results are kept and only missing or failed requests are sent again;
+      otherwise an existing results file is discarded
+    - if omitted, will default to False
+- learn_output_lengths : bool, optional
+    - each request reserves its prompt tokens plus n * max_tokens from the token bucket; the unused part of the
+      reservation is refunded from the usage field of the response
+    - with this flag, the reservation for completions shrinks to the output length each model actually produces
+      (mean + 3 standard deviations, once 20 responses have been seen), capped at n * max_tokens
+    - if omitted, will default to True
+- requests_to_prefetch : int, optional
+    - number of parsed, token-counted requests kept ready ahead of the dispatcher
+    - requests are read, parsed and counted in chunks in a worker thread, with repeated strings such as system
+      prompts counted once
+    - if omitted, will default to 4,096
+- max_requests_in_flight : int, optional
+    - maximum number of requests started but not finished, including those waiting to be retried
+    - also the size of the connection pool; when it is reached, no new requests are read until one finishes,
+      so memory and open connections stay flat however large the requests files are
+    - if omitted, will default to 500
+- hedge_percentile : float, optional
+    - send a duplicate of a request once it has been waiting longer than this percentile of the latencies seen
+      so far in the run (e.g. 95); the first answer is kept and the other call is cancelled
+    - if omitted, requests are not hedged
+- hedge_budget : float, optional
+    - at most this many hedges per request sent, to bound the extra calls and cost
+    - if omitted, will default to 0.05
+- record_timings : bool, optional
+    - add the unix times each request was queued, (last) sent, got its first response byte and was done to its
+      result: a "timings" key in "batch" records, or in the metadata of "raw" records
+    - if omitted, will default to False
+- metrics_path : str, optional
+    - file that a snapshot of live metrics is written to every {metrics_interval} seconds (see dispatcher_metrics.py):
+      requests and tokens per minute, requests in flight, retry backlog, per-endpoint load, limits and latency
+      histograms
+    - Prometheus textfile format if the path ends in .prom, JSON otherwise
+    - if omitted, metrics are only logged (at INFO level) every {metrics_interval} seconds
+- metrics_interval : float, optional
+    - if omitted, will default to 15
+- cache_path : str, optional
+    - sqlite file of a response cache (see response_cache.py); identical requests are answered from it without a call
+    - only requests with temperature <= {cache_max_temperature} are cached
+    - if omitted, no cache is used
+- cache_max_bytes : int, optional
+    - size bound of the response cache; least recently used entries are evicted beyond it
+    - if omitted, will default to 1 GiB
+- cache_max_temperature : float, optional
+    - if omitted, will default to 0.1
+- fsync_interval : float, optional
+    - seconds between fsyncs of the results file; results are written in batches in between
+    - if omitted, will default to 1
 - request_url : str, optional
     - URL of the API endpoint to call
     - if omitted, will default to "https://api.openai.com/v1/embeddings"
 - api_key : str, optional
     - API key to use
     - if omitted, the script will attempt to read it from an environment variable {os.getenv("OPENAI_API_KEY")}
+- endpoints_file : str, optional
+    - json list of endpoints to spread the requests over, e.g. several API keys or several vLLM replicas:
+      [{"request_url": ..., "api_key_env": "OPENAI_KEY_2", "max_requests_per_minute": 500,
+        "max_tokens_per_minute": 100000, "models": ["gpt-4.1"]}, ...]
+    - each endpoint has its own rate limits (defaulting to the ones below) and serves the listed models (all if
+      omitted); requests go to the endpoint with the fewest outstanding requests, weighted by its latency
+    - endpoints that keep failing with connection or server errors are paused by a circuit breaker
+    - if omitted, requests are sent to request_url with api_key
 - max_requests_per_minute : float, optional
     - target number of requests to make per minute (will make less if limited by tokens)
     - leave headroom by setting this to 50% or 75% of your limit
     - if requests are limiting you, try batching multiple embeddings or completions into one request
+    - with adaptive rate limiting this is only the starting rate
     - if omitted, will default to 1,500
 - max_tokens_per_minute : float, optional
     - target number of tokens to use per minute (will use less if limited by requests)
     - leave headroom by setting this to 50% or 75% of your limit
+    - with adaptive rate limiting this is only the starting rate
     - if omitted, will default to 125,000
+- adaptive_rate_limit : bool, optional
+    - adjust the request and token rates while running (additive increase, multiplicative decrease)
+    - rates are capped by the provider's x-ratelimit-limit-* headers and held back by x-ratelimit-remaining-*
+    - a rate limit error halves the rates and delays only the failed request, by Retry-After when given
+    - if omitted, will default to True
 - token_encoding_name : str, optional
     - name of the token encoding used, as defined in the `tiktoken` package
     - if omitted, will default to "cl100k_base" (used by `text-embedding-3-small`)
 - max_attempts : int, optional
     - number of times to retry a failed request before giving up
+    - only rate limit errors, server errors and connection errors are retried, after the delay the provider asks
+      for or an exponential backoff with jitter; other errors (400s, context length, content filter, no quota)
+      are written to the results file right away
     - if omitted, will default to 5
 - logging_level : int, optional
     - level of logging to use; higher numbers will log fewer messages
@@ -73,21 +160,36 @@ Inputs:
 The script is structured as follows:
     - Imports
     - Define main()
-        - Initialize things
+        - process_api_requests_from_file wraps a single requests file
+        - Initialize things (one DispatchJob per requests file; metrics gauges and snapshot task)
         - In main loop:
             - Get next request if one is not already waiting for capacity
-            - Update available token & request capacity
-            - If enough capacity available, call API
-            - The loop pauses if a rate limit error is hit
+            - If an endpoint has enough capacity, call API on the least loaded one
+            - New requests are only taken while fewer than {max_requests_in_flight} are in progress
+            - Rate limit errors slow the send rate; the failed request waits out its Retry-After
             - The loop breaks when no tasks remain
+            - Otherwise the loop sleeps until capacity refills, a retry is due or an in-flight call finishes
     - Define dataclasses
         - StatusTracker (stores script metadata counters; only one instance is created)
-        - APIRequest (stores API inputs, outputs, metadata; one method to call API)
+        - RateLimiter (request & token buckets; computes how long to wait for capacity; adapts to provider limits)
+        - Endpoint (URL, key and rate limiter of one endpoint, with load, latency and a circuit breaker)
+        - EndpointPool (routes each request to the least loaded healthy endpoint serving its model)
+        - Hedger (tracks recent latencies; decides when a slow request gets a duplicate, within a budget)
+        - RetryQueue (failed requests ordered by the time they may be retried)
+        - ResultWriter (owns the results file; batches, orders and fsyncs writes)
+        - DispatchJob (one requests file with its results file; resumes, then closes once all its requests finished)
+        - TokenCounter (one shared encoding; memoizes counts of repeated strings)
+        - OutputLengthEstimator (learns per-model completion lengths to size token reservations)
+        - APIRequest (stores API inputs, outputs, metadata; call_api handles a request, send makes one attempt)
     - Define functions
         - api_endpoint_from_url (extracts API endpoint from request URL)
-        - append_to_jsonl (writes to results file)
-        - num_tokens_consumed_from_request (bigger function to infer token usage from request)
-        - task_id_generator_function (yields 0, 1, 2, ...)
+        - request_header (Bearer or Azure api-key authentication header of an endpoint)
+        - seconds_from_duration (parses rate limit reset durations such as "6m0s")
+        - retry_after_from_response (reads Retry-After style hints from headers and error bodies)
+        - classify_error (sorts failed calls into rate limit, retriable and non-retriable errors)
+        - file_fingerprint, request_key, compact_results_file, sort_results_file (support resuming a run)
+        - num_tokens_consumed_from_requests (bigger function to infer token usage from requests)
+        - read_requests (reads, parses and token-counts the requests files in turn, ahead of the main loop)
     - Run main()
 """
 
@@ -95,12 +197,21 @@ The script is structured as follows:
 import aiohttp  # for making API calls concurrently
 import argparse  # for running script from command line
 import asyncio  # for running API calls concurrently
-import json  # for saving results to a jsonl file
+import collections  # for memoizing token counts
+import functools  # for loading each token encoding once
 import logging  # for logging rate limit warnings and other messages
-import os  # for reading API key
+import math  # for rounding token reservations
+import orjson  # for reading requests and saving results to a jsonl file
+import os  # for reading API key and syncing results to disk
+import random  # for jittering retry backoff
 import re  # for matching endpoint from request URL
+from dispatcher_metrics import DispatcherMetrics  # for watching a run while it is going
+from response_cache import ResponseCache  # for answering repeated deterministic requests from disk
 import tiktoken  # for counting tokens
-import time  # for sleeping after rate limit is hit
+import hashlib  # for fingerprinting the requests file when resuming
+import heapq  # for ordering retries by the time they are due
+import itertools  # for reading the requests file in chunks
+import time  # for refilling capacity and scheduling retries
 from dataclasses import (
     dataclass,
     field,
@@ -108,8 +219,16 @@ from dataclasses import (
 
 
 async def process_api_requests_from_file(
-    requests_filepath: str,
-    save_filepath: str,
+    requests_filepath: str, save_filepath: str, *args, **kwargs
+):
+    """Processes API requests in parallel, throttling to stay under rate limits."""
+    await process_api_requests_from_files(
+        [(requests_filepath, save_filepath)], *args, **kwargs
+    )
+
+
+async def process_api_requests_from_files(
+    requests_and_save_filepaths: list,
     request_url: str,
     api_key: str,
     max_requests_per_minute: float,
@@ -117,157 +236,337 @@ async def process_api_requests_from_file(
     token_encoding_name: str,
     max_attempts: int,
     logging_level: int,
+    adaptive_rate_limit: bool = True,
+    record_format: str = "raw",
+    ordered_output: bool = False,
+    fsync_interval: float = 1.0,
+    max_reorder_buffer: int = 10_000,
+    resume: bool = False,
+    learn_output_lengths: bool = True,
+    requests_to_prefetch: int = 4096,
+    max_requests_in_flight: int = 500,
+    endpoints: list = None,
+    hedge_percentile: float = None,
+    hedge_budget: float = 0.05,
+    record_timings: bool = False,
+    metrics_path: str = None,
+    metrics_interval: float = 15.0,
+    cache_path: str = None,
+    cache_max_bytes: int = 1 << 30,
+    cache_max_temperature: float = 0.1,
 ):
-    """Processes API requests in parallel, throttling to stay under rate limits."""
-    # constants
-    seconds_to_pause_after_rate_limit_error = 15
-    seconds_to_sleep_each_loop = (
-        0.001  # 1 ms limits max throughput to 1,000 requests per second
-    )
+    """Processes the requests of several files in parallel, sharing one connection pool and one rate budget.
 
+    Files are read one after the other, but a file's slow tail overlaps with the requests of the next one,
+    so the rate limits stay saturated across the whole set.
+    """
     # initialize logging
     logging.basicConfig(level=logging_level)
     logging.debug(f"Logging initialized at level {logging_level}")
 
-    # infer API endpoint and construct request header
-    api_endpoint = request_url
-    request_header = {"Authorization": f"Bearer {api_key}"}
-    # use api-key header for Azure deployments
-    if "/deployments" in request_url:
-        request_header = {"api-key": f"{api_key}"}
+    # endpoints to send requests to, each with its own capacity counts;
+    # without a list of endpoints, only request_url is used
+    if endpoints is None:
+        endpoints = [{"request_url": request_url, "api_key": api_key}]
+    endpoint_pool = EndpointPool(
+        [
+            Endpoint(
+                request_url=endpoint["request_url"],
+                api_key=endpoint.get("api_key", api_key),
+                models=endpoint.get("models"),
+                rate_limiter=RateLimiter(
+                    max_requests_per_minute=endpoint.get(
+                        "max_requests_per_minute", max_requests_per_minute
+                    ),
+                    max_tokens_per_minute=endpoint.get(
+                        "max_tokens_per_minute", max_tokens_per_minute
+                    ),
+                    adaptive=adaptive_rate_limit,
+                ),
+            )
+            for endpoint in endpoints
+        ]
+    )
+    # responses are cached per provider, whichever of its endpoints served them
+    request_url = request_url or endpoint_pool.endpoints[0].request_url
+
+    # one job per requests file, each with its own results file
+    jobs = [
+        DispatchJob(
+            requests_filepath=requests_filepath,
+            save_filepath=save_filepath,
+            resume=resume,
+            writer=ResultWriter(
+                save_filepath=save_filepath,
+                record_format=record_format,
+                ordered=ordered_output,
+                fsync_interval=fsync_interval,
+                max_reorder_buffer=max_reorder_buffer,
+                record_timings=record_timings,
+            ),  # single task that owns the results file
+        )
+        for requests_filepath, save_filepath in requests_and_save_filepaths
+    ]
 
     # initialize trackers
-    queue_of_requests_to_retry = asyncio.Queue()
-    task_id_generator = (
-        task_id_generator_function()
-    )  # generates integer IDs of 0, 1, 2, ...
+    queue_of_requests_to_retry = RetryQueue()
     status_tracker = (
         StatusTracker()
     )  # single instance to track a collection of variables
     next_request = None  # variable to hold the next request to call
 
-    # initialize available capacity counts
-    available_request_capacity = max_requests_per_minute
-    available_token_capacity = max_tokens_per_minute
-    last_update_time = time.time()
+    response_cache = (
+        ResponseCache(
+            cache_path, max_bytes=cache_max_bytes, max_temperature=cache_max_temperature
+        )
+        if cache_path
+        else None
+    )
+
+    output_length_estimator = OutputLengthEstimator(enabled=learn_output_lengths)
+    hedger = (
+        Hedger(endpoint_pool, percentile=hedge_percentile, budget=hedge_budget)
+        if hedge_percentile is not None
+        else None
+    )
+    metrics = DispatcherMetrics()
 
     # initialize flags
-    file_not_finished = True  # after file is empty, we'll skip reading it
+    file_not_finished = True  # after the last file is empty, we'll skip reading
     logging.debug(f"Initialization complete.")
 
-    # initialize file reading
-    with open(requests_filepath) as file:
-        # `requests` will provide requests one at a time
-        requests = file.__iter__()
-        logging.debug(f"File opened. Entering main loop")
-        async with aiohttp.ClientSession() as session:  # Initialize ClientSession here
+    # initialize file reading: requests are parsed and token-counted ahead of the main loop
+    request_queue = asyncio.Queue(maxsize=requests_to_prefetch)
+    reader_task = asyncio.create_task(
+        read_requests(
+            jobs=jobs,
+            request_queue=request_queue,
+            token_counter=get_token_counter(token_encoding_name),
+            status_tracker=status_tracker,
+        )
+    )
+    reader_task.add_done_callback(lambda _: status_tracker.wakeup_event.set())
+    next_read = None  # parsed request waiting for room in the reorder buffer
+    in_flight_tasks = set()  # call_api tasks; kept so they are not garbage collected mid-call
+
+    # gauges are read whenever a metrics snapshot is taken
+    metrics.register_gauge("requests_in_flight", lambda: len(in_flight_tasks))
+    metrics.register_gauge(
+        "requests_in_progress", lambda: status_tracker.num_tasks_in_progress
+    )
+    metrics.register_gauge("retry_backlog", lambda: len(queue_of_requests_to_retry))
+    metrics.register_gauge("requests_prefetched", lambda: request_queue.qsize())
+    metrics.register_gauge("requests_succeeded", lambda: status_tracker.num_tasks_succeeded)
+    metrics.register_gauge("requests_failed", lambda: status_tracker.num_tasks_failed)
+    metrics.register_gauge("requests_skipped", lambda: status_tracker.num_tasks_skipped)
+    metrics.register_gauge(
+        "endpoint_outstanding_requests",
+        lambda: [
+            ({"endpoint": e.request_url}, e.num_outstanding)
+            for e in endpoint_pool.endpoints
+        ],
+    )
+    metrics.register_gauge(
+        "endpoint_requests_per_minute_limit",
+        lambda: [
+            ({"endpoint": e.request_url}, e.rate_limiter.max_requests_per_minute)
+            for e in endpoint_pool.endpoints
+        ],
+    )
+    metrics.register_gauge(
+        "endpoint_tokens_per_minute_limit",
+        lambda: [
+            ({"endpoint": e.request_url}, e.rate_limiter.max_tokens_per_minute)
+            for e in endpoint_pool.endpoints
+        ],
+    )
+    metrics.register_gauge(
+        "endpoint_circuit_open",
+        lambda: [
+            ({"endpoint": e.request_url}, int(e.is_open()))
+            for e in endpoint_pool.endpoints
+        ],
+    )
+    if hedger is not None:
+        metrics.register_gauge("hedges_sent", lambda: hedger.num_hedges)
+        metrics.register_gauge("hedges_won", lambda: hedger.num_hedges_won)
+    metrics_task = asyncio.create_task(metrics.run(metrics_path, metrics_interval))
+    logging.debug(f"Reader started. Entering main loop")
+    async with aiohttp.ClientSession(
+        # each request in flight may have one hedge in flight too
+        connector=aiohttp.TCPConnector(
+            limit=max_requests_in_flight * (2 if hedger else 1)
+        )
+    ) as session:  # Initialize ClientSession here
+        try:
             while True:
                 # get next request (if one is not already waiting for capacity)
                 if next_request is None:
-                    if not queue_of_requests_to_retry.empty():
-                        next_request = queue_of_requests_to_retry.get_nowait()
+                    if queue_of_requests_to_retry.has_due_request():
+                        next_request = queue_of_requests_to_retry.pop()
                         logging.debug(
-                            f"Retrying request {next_request.task_id}: {next_request}"
+                            "Retrying request %s: %s", next_request.task_id, next_request
                         )
-                    elif file_not_finished:
-                        try:
+                    elif (
+                        file_not_finished
+                        and status_tracker.num_tasks_in_progress
+                        < max_requests_in_flight
+                    ):
+                        # stop taking new requests while saturated; the bounded prefetch queue
+                        # then stops the reader, and retries never exceed the in-flight limit
+                        if next_read is None and not request_queue.empty():
+                            next_read = request_queue.get_nowait()
+                            if next_read is None:
+                                # if the last file runs out, set flag to stop reading
+                                logging.debug("Read files exhausted")
+                                file_not_finished = False
+                        if next_read is not None and next_read[0].writer.has_room_for(
+                            next_read[1]
+                        ):
                             # get new request
-                            request_json = json.loads(next(requests))
+                            job, task_id, request_json, prompt_tokens, completion_tokens = (
+                                next_read
+                            )
+                            next_read = None
                             next_request = APIRequest(
-                                task_id=next(task_id_generator),
+                                task_id=task_id,
                                 request_json=request_json,
-                                token_consumption=num_tokens_consumed_from_request(
-                                    request_json, api_endpoint, token_encoding_name
-                                ),
+                                token_consumption=prompt_tokens + completion_tokens,
+                                prompt_tokens=prompt_tokens,
+                                max_completion_tokens=completion_tokens,
                                 attempts_left=max_attempts,
                                 metadata=request_json.pop("metadata", None),
+                                job=job,
+                                timings={"queued": time.time()},
                             )
                             status_tracker.num_tasks_started += 1
                             status_tracker.num_tasks_in_progress += 1
                             logging.debug(
-                                f"Reading request {next_request.task_id}: {next_request}"
+                                "Reading request %s: %s", next_request.task_id, next_request
                             )
-                        except StopIteration:
-                            # if file runs out, set flag to stop reading it
-                            logging.debug("Read file exhausted")
-                            file_not_finished = False
-
-                # update available capacity
-                current_time = time.time()
-                seconds_since_update = current_time - last_update_time
-                available_request_capacity = min(
-                    available_request_capacity
-                    + max_requests_per_minute * seconds_since_update / 60.0,
-                    max_requests_per_minute,
-                )
-                available_token_capacity = min(
-                    available_token_capacity
-                    + max_tokens_per_minute * seconds_since_update / 60.0,
-                    max_tokens_per_minute,
-                )
-                last_update_time = current_time
+                            if response_cache is not None:
+                                next_request.cache_key = response_cache.key(
+                                    request_json["body"], request_url
+                                )
+                                cached_response = (
+                                    await response_cache.get_async(next_request.cache_key)
+                                    if next_request.cache_key
+                                    else None
+                                )
+                                if cached_response is not None:
+                                    next_request.timings["done"] = time.time()
+                                    metrics.increment("cache_hits_total")
+                                    job.writer.write(next_request, response=cached_response)
+                                    job.task_finished()
+                                    status_tracker.num_tasks_in_progress -= 1
+                                    status_tracker.num_tasks_succeeded += 1
+                                    status_tracker.num_cache_hits += 1
+                                    next_request = None
+                                    continue
+                        elif reader_task.done() and reader_task.exception():
+                            raise reader_task.exception()
 
                 # if enough capacity available, call API
                 if next_request:
-                    next_request_tokens = next_request.token_consumption
-                    if (
-                        available_request_capacity >= 1
-                        and available_token_capacity >= next_request_tokens
-                    ):
+                    next_request.token_consumption = (
+                        next_request.prompt_tokens
+                        + output_length_estimator.completion_tokens_to_reserve(next_request)
+                    )
+                    endpoint = endpoint_pool.choose(next_request)
+                    if endpoint is not None:
                         # update counters
-                        available_request_capacity -= 1
-                        available_token_capacity -= next_request_tokens
+                        endpoint.rate_limiter.consume(next_request.token_consumption)
+                        endpoint.num_outstanding += 1
                         next_request.attempts_left -= 1
 
                         # call API
-                        asyncio.create_task(
+                        task = asyncio.create_task(
                             next_request.call_api(
                                 session=session,
-                                request_url=request_url,
-                                request_header=request_header,
+                                endpoint=endpoint,
                                 retry_queue=queue_of_requests_to_retry,
-                                save_filepath=save_filepath,
+                                response_cache=response_cache,
+                                output_length_estimator=output_length_estimator,
                                 status_tracker=status_tracker,
+                                hedger=hedger,
+                                metrics=metrics,
                             )
                         )
+                        in_flight_tasks.add(task)
+                        task.add_done_callback(in_flight_tasks.discard)
                         next_request = None  # reset next_request to empty
+                        # yield once so finished calls get handled, then look for more work
+                        await asyncio.sleep(0)
+                        continue
 
                 # if all tasks are finished, break
-                if status_tracker.num_tasks_in_progress == 0:
+                if status_tracker.num_tasks_in_progress == 0 and not file_not_finished:
                     break
 
-                # main loop sleeps briefly so concurrent tasks can run
-                await asyncio.sleep(seconds_to_sleep_each_loop)
-
-                # if a rate limit error was hit recently, pause to cool down
-                seconds_since_rate_limit_error = (
-                    time.time() - status_tracker.time_of_last_rate_limit_error
-                )
-                if (
-                    seconds_since_rate_limit_error
-                    < seconds_to_pause_after_rate_limit_error
-                ):
-                    remaining_seconds_to_pause = (
-                        seconds_to_pause_after_rate_limit_error
-                        - seconds_since_rate_limit_error
+                # nothing can be sent right now: sleep until capacity refills, a
+                # retry is due or an in-flight call finishes (successes free the
+                # loop to exit, failures land in the retry queue)
+                if next_request:
+                    seconds_to_wait = endpoint_pool.seconds_until_available(
+                        next_request
                     )
-                    await asyncio.sleep(remaining_seconds_to_pause)
-                    # ^e.g., if pause is 15 seconds and final limit was hit 5 seconds ago
-                    logging.warning(
-                        f"Pausing to cool down until {time.ctime(status_tracker.time_of_last_rate_limit_error + seconds_to_pause_after_rate_limit_error)}"
+                else:
+                    seconds_to_wait = queue_of_requests_to_retry.seconds_until_due()
+                status_tracker.wakeup_event.clear()
+                try:
+                    await asyncio.wait_for(
+                        status_tracker.wakeup_event.wait(), timeout=seconds_to_wait
                     )
-                
-        # after finishing, log final status
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            # on errors or cancellation, do not leave calls running against a closed session
+            for task in in_flight_tasks:
+                task.cancel()
+            await asyncio.gather(*in_flight_tasks, return_exceptions=True)
+
+    # after finishing, wait for the last results files to be flushed and log final status
+    await asyncio.gather(*(job.finish_task for job in jobs))
+    metrics_task.cancel()
+    await asyncio.gather(metrics_task, return_exceptions=True)
+    if response_cache is not None:
+        await asyncio.to_thread(response_cache.close)
+    logging.info(
+        f"""Parallel processing complete. Results of {len(jobs)} requests file(s) saved."""
+    )
+    if status_tracker.num_tasks_failed > 0:
+        logging.warning(
+            f"{status_tracker.num_tasks_failed} / {status_tracker.num_tasks_started} requests failed. Errors logged to the results files."
+        )
+    if status_tracker.num_cache_hits > 0:
         logging.info(
-            f"""Parallel processing complete. Results saved to {save_filepath}"""
+            f"{status_tracker.num_cache_hits} / {status_tracker.num_tasks_started} requests answered from the response cache."
         )
-        if status_tracker.num_tasks_failed > 0:
-            logging.warning(
-                f"{status_tracker.num_tasks_failed} / {status_tracker.num_tasks_started} requests failed. Errors logged to {save_filepath}."
+    if status_tracker.num_tokens_refunded > 0:
+        logging.info(
+            f"{status_tracker.num_tokens_refunded} reserved tokens were refunded from response usage."
+        )
+    if hedger is not None and hedger.num_hedges > 0:
+        logging.info(
+            f"{hedger.num_hedges} slow requests were hedged; the hedge answered first {hedger.num_hedges_won} times."
+        )
+    if status_tracker.num_non_retriable_errors > 0:
+        logging.warning(
+            f"{status_tracker.num_non_retriable_errors} requests were rejected with errors that retrying cannot fix; they were not retried."
+        )
+    if status_tracker.num_rate_limit_errors > 0:
+        logging.warning(
+            f"{status_tracker.num_rate_limit_errors} rate limit errors received. Consider running at a lower rate."
+        )
+    for (name, labels), histogram in sorted(metrics.histograms.items()):
+        if name == "call_latency_seconds":
+            logging.info(
+                f"Latency of {dict(labels)['endpoint']}: p50 {histogram.quantile(0.5):.2f}s, p99 {histogram.quantile(0.99):.2f}s over {histogram.count} calls"
             )
-        if status_tracker.num_rate_limit_errors > 0:
-            logging.warning(
-                f"{status_tracker.num_rate_limit_errors} rate limit errors received. Consider running at a lower rate."
+    if adaptive_rate_limit:
+        for endpoint in endpoint_pool.endpoints:
+            logging.info(
+                f"Final adaptive rates of {endpoint.request_url}: {endpoint.rate_limiter.max_requests_per_minute:.0f} requests/min, {endpoint.rate_limiter.max_tokens_per_minute:.0f} tokens/min"
             )
 
 
@@ -279,13 +578,650 @@ class StatusTracker:
     """Stores metadata about the script's progress. Only one instance is created."""
 
     num_tasks_started: int = 0
+    num_tasks_skipped: int = 0  # already completed by an interrupted run that is being resumed
     num_tasks_in_progress: int = 0  # script ends when this reaches 0
     num_tasks_succeeded: int = 0
     num_tasks_failed: int = 0
+    num_cache_hits: int = 0
+    num_tokens_refunded: int = 0  # reserved completion tokens that responses did not use
     num_rate_limit_errors: int = 0
     num_api_errors: int = 0  # excluding rate limit errors, counted above
+    num_non_retriable_errors: int = 0  # API errors that were not retried, e.g. invalid or too long requests
     num_other_errors: int = 0
     time_of_last_rate_limit_error: int = 0  # used to cool off after hitting rate limits
+    wakeup_event: asyncio.Event = field(
+        default_factory=asyncio.Event
+    )  # set whenever a call finishes, so the main loop can sleep between dispatches
+
+
+@dataclass
+class RateLimiter:
+    """Token buckets for request and token capacity. Each refills continuously up to one minute of budget.
+
+    When adaptive, the per-minute rates follow an AIMD controller: they grow additively while requests
+    are waiting for capacity and halve on rate limit errors. Rates never exceed the provider limits
+    advertised in x-ratelimit-limit-* headers, and x-ratelimit-remaining-* headers clamp the buckets.
+    """
+
+    max_requests_per_minute: float
+    max_tokens_per_minute: float
+    adaptive: bool = False
+    available_request_capacity: float = field(init=False)
+    available_token_capacity: float = field(init=False)
+    last_update_time: float = field(init=False)
+    paused_until: float = field(init=False, default=0.0)  # set when the provider reports no quota left
+    saturated: bool = field(init=False, default=False)  # set when a request had to wait for capacity
+    provider_request_limit: float = field(init=False, default=None)
+    provider_token_limit: float = field(init=False, default=None)
+    last_decrease_time: float = field(init=False, default=float("-inf"))
+
+    # AIMD parameters
+    additive_increase = 0.01  # fraction of the starting rate added per successful saturated request
+    multiplicative_decrease = 0.5
+    seconds_between_decreases = 5.0  # a burst of 429s from the same window only counts once
+    minimum_fraction = 0.02  # rates never drop below this fraction of the starting rate
+    provider_limit_headroom = 0.9
+
+    def __post_init__(self):
+        self.initial_requests_per_minute = self.max_requests_per_minute
+        self.initial_tokens_per_minute = self.max_tokens_per_minute
+        self.available_request_capacity = self.max_requests_per_minute
+        self.available_token_capacity = self.max_tokens_per_minute
+        self.last_update_time = time.monotonic()
+
+    def refill(self):
+        """Add the capacity accumulated since the last update."""
+        current_time = time.monotonic()
+        seconds_since_update = current_time - self.last_update_time
+        self.available_request_capacity = min(
+            self.available_request_capacity
+            + self.max_requests_per_minute * seconds_since_update / 60.0,
+            self.max_requests_per_minute,
+        )
+        self.available_token_capacity = min(
+            self.available_token_capacity
+            + self.max_tokens_per_minute * seconds_since_update / 60.0,
+            self.max_tokens_per_minute,
+        )
+        self.last_update_time = current_time
+
+    def tokens_required(self, num_tokens: int) -> float:
+        """A request larger than a full bucket only has to wait for a full bucket, otherwise it would never be sent."""
+        return min(num_tokens, self.max_tokens_per_minute)
+
+    def has_capacity(self, num_tokens: int) -> bool:
+        self.refill()
+        return (
+            time.monotonic() >= self.paused_until
+            and self.available_request_capacity >= 1
+            and self.available_token_capacity >= self.tokens_required(num_tokens)
+        )
+
+    def consume(self, num_tokens: int):
+        self.available_request_capacity -= 1
+        self.available_token_capacity -= self.tokens_required(num_tokens)
+
+    def refund(self, num_tokens: int):
+        """Return reserved tokens a call did not use; a negative refund charges tokens used beyond the reservation."""
+        self.refill()
+        self.available_token_capacity = min(
+            self.available_token_capacity + num_tokens, self.max_tokens_per_minute
+        )
+
+    def seconds_until_available(self, num_tokens: int) -> float:
+        """Time until both buckets hold enough capacity for a request of `num_tokens` tokens."""
+        self.refill()
+        request_deficit = max(0.0, 1 - self.available_request_capacity)
+        token_deficit = max(
+            0.0, self.tokens_required(num_tokens) - self.available_token_capacity
+        )
+        seconds = max(
+            request_deficit * 60.0 / self.max_requests_per_minute,
+            token_deficit * 60.0 / self.max_tokens_per_minute,
+            self.paused_until - time.monotonic(),
+        )
+        if seconds > 0:
+            self.saturated = True
+        return seconds
+
+    def on_success(self, headers):
+        """Probe for more throughput after a successful call, within the provider's advertised limits."""
+        if not self.adaptive:
+            return
+        self.apply_headers(headers)
+        if self.saturated:
+            self.saturated = False
+            self.max_requests_per_minute += (
+                self.initial_requests_per_minute * self.additive_increase
+            )
+            self.max_tokens_per_minute += (
+                self.initial_tokens_per_minute * self.additive_increase
+            )
+            self.clamp_to_provider_limits()
+
+    def on_rate_limit(self, headers):
+        """Back off after a rate limit error. In-flight requests are left alone."""
+        if not self.adaptive:
+            return
+        self.apply_headers(headers)
+        self.refill()
+        self.available_request_capacity = min(self.available_request_capacity, 0.0)
+        self.available_token_capacity = min(self.available_token_capacity, 0.0)
+        current_time = time.monotonic()
+        if current_time - self.last_decrease_time < self.seconds_between_decreases:
+            return
+        self.last_decrease_time = current_time
+        self.max_requests_per_minute = max(
+            self.max_requests_per_minute * self.multiplicative_decrease,
+            self.initial_requests_per_minute * self.minimum_fraction,
+        )
+        self.max_tokens_per_minute = max(
+            self.max_tokens_per_minute * self.multiplicative_decrease,
+            self.initial_tokens_per_minute * self.minimum_fraction,
+        )
+        self.clamp_to_provider_limits()
+        logging.warning(
+            f"Rate limit hit. Slowing down to {self.max_requests_per_minute:.0f} requests/min, {self.max_tokens_per_minute:.0f} tokens/min"
+        )
+
+    def apply_headers(self, headers):
+        """Learn provider limits and remaining quota from x-ratelimit-* headers (OpenAI, Azure)."""
+        if headers is None:
+            return
+        request_limit = header_as_float(headers, "x-ratelimit-limit-requests")
+        if request_limit:
+            self.provider_request_limit = request_limit
+        token_limit = header_as_float(headers, "x-ratelimit-limit-tokens")
+        if token_limit:
+            self.provider_token_limit = token_limit
+        self.clamp_to_provider_limits()
+
+        self.refill()
+        for kind in ("requests", "tokens"):
+            remaining = header_as_float(headers, f"x-ratelimit-remaining-{kind}")
+            if remaining is None:
+                continue
+            if kind == "requests":
+                self.available_request_capacity = min(
+                    self.available_request_capacity, remaining
+                )
+            else:
+                self.available_token_capacity = min(
+                    self.available_token_capacity, remaining
+                )
+            if remaining <= 0:
+                reset_seconds = seconds_from_duration(
+                    headers.get(f"x-ratelimit-reset-{kind}")
+                )
+                if reset_seconds:
+                    self.paused_until = max(
+                        self.paused_until, time.monotonic() + reset_seconds
+                    )
+
+    def clamp_to_provider_limits(self):
+        if self.provider_request_limit:
+            self.max_requests_per_minute = min(
+                self.max_requests_per_minute,
+                self.provider_request_limit * self.provider_limit_headroom,
+            )
+        if self.provider_token_limit:
+            self.max_tokens_per_minute = min(
+                self.max_tokens_per_minute,
+                self.provider_token_limit * self.provider_limit_headroom,
+            )
+
+
+@dataclass
+class Endpoint:
+    """One URL and API key requests can be sent to, with its own rate limits, load and health.
+
+    A circuit breaker stops routing to an endpoint after `failure_threshold` consecutive connection errors
+    or 5xx responses. Once its cooldown has passed, a single probe request is let through; a success
+    closes the circuit, a failure opens it again for twice as long.
+    """
+
+    request_url: str
+    api_key: str
+    rate_limiter: RateLimiter
+    models: list = None  # models served by this endpoint; None serves every model
+    num_outstanding: int = field(init=False, default=0)
+    latency: float = field(init=False, default=None)  # moving average of successful calls, in seconds
+    consecutive_failures: int = field(init=False, default=0)
+    open_until: float = field(init=False, default=0.0)
+
+    # circuit breaker and latency parameters
+    failure_threshold = 5
+    cooldown_seconds = 10.0
+    max_cooldown_seconds = 300.0
+    latency_smoothing = 0.2
+
+    @property
+    def request_header(self) -> dict:
+        return request_header(self.request_url, self.api_key)
+
+    def serves(self, model: str) -> bool:
+        return self.models is None or model in self.models
+
+    def is_open(self) -> bool:
+        """Whether the circuit breaker keeps requests away from this endpoint."""
+        if self.consecutive_failures < self.failure_threshold:
+            return False
+        # half open: after the cooldown, one probe at a time
+        return time.monotonic() < self.open_until or self.num_outstanding > 0
+
+    def on_success(self, latency: float):
+        self.consecutive_failures = 0
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += self.latency_smoothing * (latency - self.latency)
+
+    def on_failure(self):
+        """Count a connection error or server error towards opening the circuit."""
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= self.failure_threshold:
+            cooldown = min(
+                self.cooldown_seconds
+                * 2 ** (self.consecutive_failures - self.failure_threshold),
+                self.max_cooldown_seconds,
+            )
+            self.open_until = time.monotonic() + cooldown
+            logging.warning(
+                f"{self.consecutive_failures} consecutive failures from {self.request_url}; pausing it for {cooldown:.0f} seconds"
+            )
+
+
+@dataclass
+class EndpointPool:
+    """Endpoints a run can send requests to, e.g. several API keys or several replicas of a vLLM server.
+
+    Each request goes to the endpoint serving its model with the fewest outstanding requests, weighted by
+    observed latency, among those with rate limit capacity and a closed circuit.
+    """
+
+    endpoints: list
+
+    def candidates(self, model: str) -> list:
+        candidates = [endpoint for endpoint in self.endpoints if endpoint.serves(model)]
+        if not candidates:
+            raise ValueError(f"no endpoint serves model {model}")
+        return candidates
+
+    def choose(self, request: "APIRequest"):
+        """The endpoint to send `request` to now, or None if every endpoint is busy or unhealthy."""
+        candidates = self.candidates(request.request_json["body"].get("model"))
+        known_latencies = [e.latency for e in candidates if e.latency is not None]
+        default_latency = (
+            sum(known_latencies) / len(known_latencies) if known_latencies else 1.0
+        )
+        best_endpoint, best_score = None, None
+        for endpoint in candidates:
+            if endpoint.is_open() or not endpoint.rate_limiter.has_capacity(
+                request.token_consumption
+            ):
+                continue
+            score = (endpoint.num_outstanding + 1) * (
+                endpoint.latency if endpoint.latency is not None else default_latency
+            )
+            if best_score is None or score < best_score:
+                best_endpoint, best_score = endpoint, score
+        return best_endpoint
+
+    def seconds_until_available(self, request: "APIRequest"):
+        """Seconds until some endpoint could take `request`, or None to wait for a call to finish."""
+        seconds = []
+        for endpoint in self.candidates(request.request_json["body"].get("model")):
+            if endpoint.is_open():
+                if endpoint.num_outstanding == 0:
+                    seconds.append(max(0.0, endpoint.open_until - time.monotonic()))
+            else:
+                seconds.append(
+                    endpoint.rate_limiter.seconds_until_available(
+                        request.token_consumption
+                    )
+                )
+        return min(seconds) if seconds else None
+
+
+@dataclass
+class Hedger:
+    """Decides when a slow request gets a duplicate ("hedge") sent to the least loaded endpoint.
+
+    A request is hedged once it has taken longer than `percentile` of the recent successful calls. At most
+    `budget` hedges are sent per started request, so hedging adds a bounded fraction of calls and cost.
+    """
+
+    endpoint_pool: EndpointPool
+    percentile: float = 95.0
+    budget: float = 0.05
+    min_samples: int = 50  # no hedging until this many latencies have been observed
+    seconds_between_checks: float = 1.0  # while no latency is known, or the budget or capacity ran out
+    latencies: collections.deque = field(
+        default_factory=lambda: collections.deque(maxlen=1000)
+    )
+    num_requests: int = field(init=False, default=0)
+    num_hedges: int = field(init=False, default=0)
+    num_hedges_won: int = field(init=False, default=0)
+    delay: float = field(init=False, default=None)
+    num_observed_since_update: int = field(init=False, default=0)
+
+    def observe(self, latency: float):
+        self.latencies.append(latency)
+        self.num_observed_since_update += 1
+        # re-sorting the window after every call would cost more than it is worth
+        if self.num_observed_since_update >= 20 and len(self.latencies) >= self.min_samples:
+            ordered = sorted(self.latencies)
+            self.delay = ordered[
+                min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))
+            ]
+            self.num_observed_since_update = 0
+
+    def seconds_to_hedge(self, start_time: float) -> float:
+        """Seconds until a request sent at `start_time` is due for a hedge; 0 if it is due now."""
+        if self.delay is None:
+            # too few latencies observed yet; look again later
+            return self.seconds_between_checks
+        return max(0.0, start_time + self.delay - time.monotonic())
+
+    def hedge_endpoint(self, request: "APIRequest"):
+        """Reserve capacity for a hedge of `request` if the budget allows it; returns the endpoint or None."""
+        if self.num_hedges >= self.budget * self.num_requests:
+            return None
+        endpoint = self.endpoint_pool.choose(request)
+        if endpoint is None:
+            return None
+        endpoint.rate_limiter.consume(request.token_consumption)
+        endpoint.num_outstanding += 1
+        self.num_hedges += 1
+        return endpoint
+
+
+@dataclass
+class RetryQueue:
+    """Failed requests waiting to be retried, ordered by the time they become due."""
+
+    heap: list = field(default_factory=list)
+    sequence: itertools.count = field(
+        default_factory=itertools.count
+    )  # breaks ties; task_ids repeat across files
+
+    def put(self, request):
+        heapq.heappush(
+            self.heap, (request.retry_not_before, next(self.sequence), request)
+        )
+
+    def has_due_request(self) -> bool:
+        return bool(self.heap) and self.heap[0][0] <= time.monotonic()
+
+    def pop(self):
+        return heapq.heappop(self.heap)[2]
+
+    def seconds_until_due(self):
+        """Seconds until the earliest retry is due, or None if nothing is waiting."""
+        if not self.heap:
+            return None
+        return max(0.0, self.heap[0][0] - time.monotonic())
+
+    def __len__(self):
+        return len(self.heap)
+
+
+@dataclass
+class ResultWriter:
+    """Owns the results file. Results are queued in memory and written in batches by a single task.
+
+    The file stays open for the whole run and is fsynced every `fsync_interval` seconds. With `ordered`,
+    results are released in task_id order (the order of the requests file) through a reorder buffer.
+    """
+
+    save_filepath: str
+    record_format: str = "raw"
+    ordered: bool = False
+    fsync_interval: float = 1.0
+    max_reorder_buffer: int = 10_000
+    record_timings: bool = False  # add the queued/sent/first_byte/done times of each request
+    next_task_id: int = field(init=False, default=0)  # next task_id to release when ordered
+    reorder_buffer: dict = field(init=False, default_factory=dict)
+    pending_lines: list = field(init=False, default_factory=list)
+    lines_ready: asyncio.Event = field(init=False, default_factory=asyncio.Event)
+    closed: bool = field(init=False, default=False)
+
+    def format_record(self, request: "APIRequest", response, errors) -> bytes:
+        if self.record_format == "batch":
+            record = {
+                "custom_id": request.request_json.get("custom_id"),
+                "response": {"body": response},
+            }
+            if errors is not None:
+                record["error"] = errors
+            if self.record_timings:
+                record["timings"] = request.timings
+        else:
+            record = [
+                request.task_id,
+                request.request_json,
+                response if errors is None else errors,
+            ]
+            metadata = request.metadata
+            if self.record_timings:
+                metadata = {**(metadata or {}), "timings": request.timings}
+            if metadata:
+                record.append(metadata)
+        return orjson.dumps(record, option=orjson.OPT_APPEND_NEWLINE)
+
+    def write(self, request: "APIRequest", response=None, errors=None):
+        """Queue the result of a request (or the errors of a failed one) for writing."""
+        line = self.format_record(request, response, errors)
+        if self.ordered:
+            self.reorder_buffer[request.task_id] = line
+            self.release_in_order()
+        else:
+            self.pending_lines.append(line)
+        if self.pending_lines:
+            self.lines_ready.set()
+
+    def skip(self, task_id: int):
+        """Mark a request that needs no result (e.g. already written by a previous run) as done."""
+        if self.ordered:
+            self.reorder_buffer[task_id] = None
+            self.release_in_order()
+
+    def release_in_order(self):
+        while self.next_task_id in self.reorder_buffer:
+            line = self.reorder_buffer.pop(self.next_task_id)
+            if line is not None:
+                self.pending_lines.append(line)
+            self.next_task_id += 1
+
+    def has_room_for(self, task_id: int) -> bool:
+        """Whether a new request can start without overflowing the reorder buffer."""
+        return not self.ordered or task_id - self.next_task_id < self.max_reorder_buffer
+
+    async def run(self):
+        """Write queued lines as they arrive until closed, syncing to disk periodically."""
+        last_fsync_time = time.monotonic()
+        unsynced = False
+        with open(self.save_filepath, "ab") as f:
+            while True:
+                seconds_to_next_fsync = self.fsync_interval - (
+                    time.monotonic() - last_fsync_time
+                )
+                try:
+                    await asyncio.wait_for(
+                        self.lines_ready.wait(),
+                        timeout=max(0.0, seconds_to_next_fsync) if unsynced else None,
+                    )
+                except asyncio.TimeoutError:
+                    pass
+                self.lines_ready.clear()
+                if self.pending_lines:
+                    lines, self.pending_lines = self.pending_lines, []
+                    f.write(b"".join(lines))
+                    f.flush()
+                    unsynced = True
+                if unsynced and (
+                    self.closed
+                    or time.monotonic() - last_fsync_time >= self.fsync_interval
+                ):
+                    await asyncio.to_thread(os.fsync, f.fileno())
+                    last_fsync_time = time.monotonic()
+                    unsynced = False
+                if self.closed and not self.pending_lines:
+                    break
+
+    async def close(self, writer_task: asyncio.Task):
+        """Flush everything still queued and wait for the writer task to finish."""
+        if self.reorder_buffer:
+            logging.warning(
+                f"{len(self.reorder_buffer)} results were still waiting for earlier requests; writing them out of order"
+            )
+            for task_id in sorted(self.reorder_buffer):
+                line = self.reorder_buffer.pop(task_id)
+                if line is not None:
+                    self.pending_lines.append(line)
+        self.closed = True
+        self.lines_ready.set()
+        await writer_task
+
+
+@dataclass
+class DispatchJob:
+    """One requests file and the results file it is written to. All jobs of a run share its main loop."""
+
+    requests_filepath: str
+    save_filepath: str
+    writer: ResultWriter
+    resume: bool = False
+    completed_keys: set = field(init=False, default_factory=set)
+    num_tasks_pending: int = field(init=False, default=0)  # read, but not yet written
+    num_tasks_failed: int = field(init=False, default=0)
+    finished_reading: bool = field(init=False, default=False)
+    writer_task: asyncio.Task = field(init=False, default=None)
+    finish_task: asyncio.Task = field(init=False, default=None)
+
+    @property
+    def progress_filepath(self) -> str:
+        return f"{self.save_filepath}.inprogress"
+
+    def prepare(self):
+        """When resuming, keep the results of an interrupted run on the same requests file."""
+        if not self.resume:
+            return
+        fingerprint = file_fingerprint(self.requests_filepath)
+        previous_fingerprint = None
+        if os.path.exists(self.progress_filepath):
+            with open(self.progress_filepath) as f:
+                previous_fingerprint = f.read().strip()
+        if os.path.exists(self.save_filepath):
+            if previous_fingerprint == fingerprint:
+                self.completed_keys = compact_results_file(
+                    self.save_filepath, self.writer.record_format
+                )
+                logging.info(
+                    f"Resuming: {len(self.completed_keys)} requests already completed in {self.save_filepath}"
+                )
+            else:
+                logging.warning(
+                    f"{self.save_filepath} does not belong to an interrupted run on {self.requests_filepath}. Starting over."
+                )
+                os.remove(self.save_filepath)
+        with open(self.progress_filepath, "w") as f:
+            f.write(fingerprint)
+
+    def start(self):
+        self.writer_task = asyncio.create_task(self.writer.run())
+
+    def task_finished(self, failed: bool = False):
+        self.num_tasks_pending -= 1
+        if failed:
+            self.num_tasks_failed += 1
+        self.maybe_finish()
+
+    def maybe_finish(self):
+        """Close the results file once the requests file is read and every request has a result."""
+        if (
+            self.finished_reading
+            and self.num_tasks_pending == 0
+            and self.finish_task is None
+        ):
+            self.finish_task = asyncio.create_task(self.finish())
+
+    async def finish(self):
+        await self.writer.close(self.writer_task)
+        if self.resume:
+            if self.completed_keys and self.writer.ordered:
+                await asyncio.to_thread(
+                    sort_results_file,
+                    self.save_filepath,
+                    self.requests_filepath,
+                    self.writer.record_format,
+                )
+            if self.num_tasks_failed == 0:
+                os.remove(self.progress_filepath)
+        logging.info(f"Results saved to {self.save_filepath}")
+        if self.num_tasks_failed > 0:
+            logging.warning(
+                f"{self.num_tasks_failed} requests of {self.requests_filepath} failed. Errors logged to {self.save_filepath}."
+            )
+
+
+@dataclass
+class TokenCounter:
+    """Counts tokens with one shared encoding, memoizing the counts of repeated strings such as system prompts."""
+
+    encoding: tiktoken.Encoding
+    max_cached_strings: int = 10_000
+    cached_counts: collections.OrderedDict = field(
+        default_factory=collections.OrderedDict
+    )
+
+    def count(self, strings: list) -> list:
+        """Token counts of `strings`; strings not seen recently are encoded together with encode_batch."""
+        missing = [
+            string for string in dict.fromkeys(strings) if string not in self.cached_counts
+        ]
+        if missing:
+            encoded = self.encoding.encode_batch(missing, disallowed_special=())
+            for string, tokens in zip(missing, encoded):
+                self.cached_counts[string] = len(tokens)
+        counts = []
+        for string in strings:
+            self.cached_counts.move_to_end(string)
+            counts.append(self.cached_counts[string])
+        while len(self.cached_counts) > self.max_cached_strings:
+            self.cached_counts.popitem(last=False)
+        return counts
+
+
+@dataclass
+class OutputLengthEstimator:
+    """Learns how many completion tokens each model actually produces, so requests reserve that instead of n * max_tokens."""
+
+    enabled: bool = True
+    min_samples: int = 20
+    num_standard_deviations: float = 3.0
+    stats: dict = field(default_factory=dict)  # model -> (count, mean, sum of squared deviations)
+
+    def observe(self, model: str, completion_tokens_per_choice: float):
+        """Welford update of the mean and variance of completion lengths for `model`."""
+        count, mean, m2 = self.stats.get(model, (0, 0.0, 0.0))
+        count += 1
+        delta = completion_tokens_per_choice - mean
+        mean += delta / count
+        m2 += delta * (completion_tokens_per_choice - mean)
+        self.stats[model] = (count, mean, m2)
+
+    def completion_tokens_to_reserve(self, request: "APIRequest") -> int:
+        if not self.enabled:
+            return request.max_completion_tokens
+        count, mean, m2 = self.stats.get(
+            request.request_json["body"].get("model"), (0, 0.0, 0.0)
+        )
+        if count < self.min_samples:
+            return request.max_completion_tokens
+        n = request.request_json["body"].get("n", 1)
+        per_choice = mean + self.num_standard_deviations * (m2 / (count - 1)) ** 0.5
+        return min(request.max_completion_tokens, max(1, math.ceil(n * per_choice)))
 
 
 @dataclass
@@ -294,73 +1230,271 @@ class APIRequest:
 
     task_id: int
     request_json: dict
-    token_consumption: int
+    token_consumption: int  # tokens reserved from the token bucket for the current attempt
     attempts_left: int
     metadata: dict
+    prompt_tokens: int = 0
+    max_completion_tokens: int = 0  # n * max_tokens
     result: list = field(default_factory=list)
+    retry_not_before: float = 0.0  # monotonic time before which a retry is not sent
+    cache_key: str = None  # set if the response may be stored in the response cache
+    job: "DispatchJob" = field(
+        default=None, repr=False
+    )  # requests file the request belongs to (left out of the repr, which would dump its writer and buffers)
+    timings: dict = field(
+        default_factory=dict
+    )  # unix times the request was queued, last sent, got its first byte and was done
+
+    # retry backoff when the provider does not say how long to wait
+    backoff_base_seconds = 1.0
+    backoff_max_seconds = 60.0
 
     async def call_api(
         self,
         session: aiohttp.ClientSession,
-        request_url: str,
-        request_header: dict,
-        retry_queue: asyncio.Queue,
-        save_filepath: str,
+        endpoint: Endpoint,
+        retry_queue: RetryQueue,
         status_tracker: StatusTracker,
+        response_cache: ResponseCache = None,
+        output_length_estimator: OutputLengthEstimator = None,
+        hedger: "Hedger" = None,
+        metrics: DispatcherMetrics = None,
     ):
         """Calls the OpenAI API and saves results."""
         logging.info(f"Starting request #{self.task_id}")
+        if hedger is None:
+            response, error, error_class, retry_after = await self.send(
+                session,
+                endpoint,
+                status_tracker,
+                output_length_estimator,
+                metrics=metrics,
+            )
+        else:
+            # if the first attempt is slower than most calls, send a duplicate and keep the first answer
+            start_time = time.monotonic()
+            hedger.num_requests += 1
+            attempts = {
+                asyncio.create_task(
+                    self.send(
+                        session,
+                        endpoint,
+                        status_tracker,
+                        output_length_estimator,
+                        hedger,
+                        metrics,
+                    )
+                )
+            }
+            hedge = None
+            outcome = None
+            try:
+                while hedge is None:
+                    seconds_to_hedge = hedger.seconds_to_hedge(start_time)
+                    if seconds_to_hedge == 0:
+                        hedge_endpoint = hedger.hedge_endpoint(self)
+                        if hedge_endpoint is not None:
+                            logging.debug(
+                                f"Hedging request {self.task_id} after {time.monotonic() - start_time:.1f}s"
+                            )
+                            hedge = asyncio.create_task(
+                                self.send(
+                                    session,
+                                    hedge_endpoint,
+                                    status_tracker,
+                                    output_length_estimator,
+                                    hedger,
+                                    metrics,
+                                )
+                            )
+                            attempts.add(hedge)
+                            break
+                        # out of budget or capacity for now
+                        seconds_to_hedge = hedger.seconds_between_checks
+                    done, _ = await asyncio.wait(attempts, timeout=seconds_to_hedge)
+                    if done:
+                        break
+                while attempts:
+                    done, attempts = await asyncio.wait(
+                        attempts, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    for attempt in done:
+                        if outcome is None or outcome[1] is not None:
+                            outcome = attempt.result()
+                            if attempt is hedge:
+                                hedger.num_hedges_won += outcome[1] is None
+                    if outcome[1] is None:
+                        break
+            finally:
+                for attempt in attempts:
+                    attempt.cancel()
+            response, error, error_class, retry_after = outcome
+        self.timings["done"] = time.time()
+        if error:
+            self.result.append(error)
+            if error_class != "non_retriable" and self.attempts_left:
+                # wait as long as the provider asked, or back off exponentially with jitter
+                self.retry_not_before = time.monotonic() + (
+                    retry_after or self.backoff_seconds()
+                )
+                retry_queue.put(self)
+                if metrics is not None:
+                    metrics.increment("retries_total", error_class=error_class)
+            else:
+                if error_class == "non_retriable":
+                    logging.error(
+                        f"Request {self.request_json} failed with an error that retrying cannot fix. Saving errors: {self.result}"
+                    )
+                else:
+                    logging.error(
+                        f"Request {self.request_json} failed after all attempts. Saving errors: {self.result}"
+                    )
+                self.job.writer.write(self, errors=[str(e) for e in self.result])
+                self.job.task_finished(failed=True)
+                status_tracker.num_tasks_in_progress -= 1
+                status_tracker.num_tasks_failed += 1
+                if metrics is not None:
+                    metrics.increment("requests_total", outcome="failed")
+        else:
+            self.job.writer.write(self, response=response)
+            self.job.task_finished()
+            if response_cache is not None and self.cache_key:
+                response_cache.put_later(self.cache_key, response)
+            status_tracker.num_tasks_in_progress -= 1
+            status_tracker.num_tasks_succeeded += 1
+            if metrics is not None:
+                metrics.increment("requests_total", outcome="succeeded")
+                metrics.observe(
+                    "request_seconds", self.timings["done"] - self.timings["queued"]
+                )
+            logging.debug("Request %s queued for %s", self.task_id, self.job.save_filepath)
+        status_tracker.wakeup_event.set()
+
+    async def send(
+        self,
+        session: aiohttp.ClientSession,
+        endpoint: Endpoint,
+        status_tracker: StatusTracker,
+        output_length_estimator: OutputLengthEstimator = None,
+        hedger: "Hedger" = None,
+        metrics: DispatcherMetrics = None,
+    ):
+        """Make one attempt on an endpoint whose capacity has been consumed.
+
+        Returns (response, error, error_class, retry_after); error_class is None on success, otherwise one of
+        "rate_limit", "retriable" or "non_retriable" (see classify_error).
+        """
+        response = None
         error = None
+        error_class = None
+        retry_after = None
+        status = None
+        used_tokens = None
+        rate_limiter = endpoint.rate_limiter
+        start_time = time.monotonic()
+        self.timings["sent"] = time.time()
         try:
             async with session.post(
-                url=request_url, headers=request_header, json=self.request_json["body"]
+                url=endpoint.request_url,
+                headers=endpoint.request_header,
+                json=self.request_json["body"],
             ) as response:
-                response = await response.json()
+                self.timings["first_byte"] = time.time()
+                if metrics is not None:
+                    metrics.observe(
+                        "time_to_first_byte_seconds",
+                        time.monotonic() - start_time,
+                        endpoint=endpoint.request_url,
+                    )
+                status = response.status
+                response_headers = response.headers
+                response = await response.json(content_type=None)
+            if (
+                isinstance(response, list)
+                and response
+                and isinstance(response[0], dict)
+                and "error" in response[0]
+            ):
+                # Gemini wraps errors in a list
+                response = response[0]
             if "error" in response:
                 logging.warning(
                     f"Request {self.task_id} failed with error {response['error']}"
                 )
-                status_tracker.num_api_errors += 1
                 error = response
-                if "rate limit" in response["error"].get("message", "").lower():
+                error_class = classify_error(status, response)
+                if error_class == "rate_limit":
                     status_tracker.time_of_last_rate_limit_error = time.time()
                     status_tracker.num_rate_limit_errors += 1
-                    status_tracker.num_api_errors -= (
-                        1  # rate limit errors are counted separately
+                    retry_after = retry_after_from_response(response_headers, response)
+                    rate_limiter.on_rate_limit(response_headers)
+                else:
+                    status_tracker.num_api_errors += 1
+                    if error_class == "non_retriable":
+                        # the request was rejected without being processed
+                        status_tracker.num_non_retriable_errors += 1
+                        rate_limiter.refund(self.token_consumption)
+                    elif status >= 500:
+                        endpoint.on_failure()
+            else:
+                latency = time.monotonic() - start_time
+                rate_limiter.on_success(response_headers)
+                endpoint.on_success(latency)
+                if hedger is not None:
+                    hedger.observe(latency)
+                usage = response.get("usage") or {}
+                if usage.get("completion_tokens") is not None:
+                    used_tokens = (
+                        usage.get("prompt_tokens") or self.prompt_tokens
+                    ) + usage["completion_tokens"]
+                    rate_limiter.refund(self.token_consumption - used_tokens)
+                    status_tracker.num_tokens_refunded += max(
+                        0, self.token_consumption - used_tokens
                     )
+                    if output_length_estimator is not None:
+                        output_length_estimator.observe(
+                            self.request_json["body"].get("model"),
+                            usage["completion_tokens"]
+                            / self.request_json["body"].get("n", 1),
+                        )
 
         except (
             Exception
         ) as e:  # catching naked exceptions is bad practice, but in this case we'll log & save them
             logging.warning(f"Request {self.task_id} failed with Exception {e}")
             status_tracker.num_other_errors += 1
+            endpoint.on_failure()
             error = e
-        if error:
-            self.result.append(error)
-            if self.attempts_left:
-                retry_queue.put_nowait(self)
-            else:
-                logging.error(
-                    f"Request {self.request_json} failed after all attempts. Saving errors: {self.result}"
-                )
-                data = (
-                    [self.task_id, self.request_json, [str(e) for e in self.result], self.metadata]
-                    if self.metadata
-                    else [self.task_id, self.request_json, [str(e) for e in self.result]]
-                )
-                append_to_jsonl(data, save_filepath)
-                status_tracker.num_tasks_in_progress -= 1
-                status_tracker.num_tasks_failed += 1
-        else:
-            data = (
-                [self.task_id, self.request_json, response, self.metadata]
-                if self.metadata
-                else [self.task_id,self.request_json, response]
+            error_class = "retriable"
+        finally:
+            endpoint.num_outstanding -= 1
+        if metrics is not None:
+            metrics.increment(
+                "calls_total",
+                endpoint=endpoint.request_url,
+                outcome=error_class or "success",
             )
-            append_to_jsonl(data, save_filepath)
-            status_tracker.num_tasks_in_progress -= 1
-            status_tracker.num_tasks_succeeded += 1
-            logging.debug(f"Request {self.task_id} saved to {save_filepath}")
+            if not error:
+                metrics.observe(
+                    "call_latency_seconds",
+                    time.monotonic() - start_time,
+                    endpoint=endpoint.request_url,
+                )
+                metrics.request_rate.add()
+                if used_tokens is not None:
+                    metrics.token_rate.add(used_tokens)
+                    metrics.increment(
+                        "tokens_total", used_tokens, endpoint=endpoint.request_url
+                    )
+        return response, error, error_class, retry_after
+
+    def backoff_seconds(self) -> float:
+        """Exponential backoff with jitter, growing with the number of failed attempts so far."""
+        backoff = min(
+            self.backoff_max_seconds,
+            self.backoff_base_seconds * 2 ** (len(self.result) - 1),
+        )
+        return random.uniform(backoff / 2, backoff)
 
 
 # functions
@@ -385,42 +1519,286 @@ def api_endpoint_from_url(request_url):
     return match[1]
 
 
-def append_to_jsonl(data, filename: str) -> None:
-    """Append a json payload to the end of a jsonl file."""
-    json_string = json.dumps(data)
-    with open(filename, "a") as f:
-        f.write(json_string + "\n")
+def load_endpoints_file(endpoints_filepath: str) -> list:
+    """Read a json list of endpoints; keys can be given directly (api_key) or by environment variable (api_key_env)."""
+    with open(endpoints_filepath, "rb") as f:
+        endpoints = orjson.loads(f.read())
+    for endpoint in endpoints:
+        if "api_key_env" in endpoint:
+            endpoint["api_key"] = os.getenv(endpoint.pop("api_key_env"))
+    return endpoints
+
+
+def request_header(request_url: str, api_key: str) -> dict:
+    """Authentication header for an endpoint."""
+    # use api-key header for Azure deployments
+    if "/deployments" in request_url or ".azure.com" in request_url:
+        return {"api-key": f"{api_key}"}
+    return {"Authorization": f"Bearer {api_key}"}
+
+
+def header_as_float(headers, name: str):
+    """Read a numeric header, returning None if it is missing or malformed."""
+    value = headers.get(name)
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def seconds_from_duration(duration):
+    """Parse durations such as "1s", "6m0s", "20ms" or "1h2m3.5s" into seconds."""
+    if not duration:
+        return None
+    try:
+        return float(duration)
+    except ValueError:
+        pass
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", duration)
+    if not parts:
+        return None
+    return sum(float(value) * units[unit] for value, unit in parts)
+
+
+def retry_after_from_response(headers, response_json):
+    """Seconds the provider asked us to wait before retrying, if it said so."""
+    retry_after_ms = header_as_float(headers, "retry-after-ms")
+    if retry_after_ms is not None:
+        return retry_after_ms / 1000.0
+    retry_after = header_as_float(headers, "retry-after")
+    if retry_after is not None:
+        return retry_after
+    # Gemini reports the delay in the error details, e.g. {"@type": ".../google.rpc.RetryInfo", "retryDelay": "23s"}
+    error = response_json.get("error", {}) if isinstance(response_json, dict) else {}
+    for detail in error.get("details", []) if isinstance(error, dict) else []:
+        if isinstance(detail, dict) and "retryDelay" in detail:
+            return seconds_from_duration(detail["retryDelay"])
+    return None
+
+
+# error codes of requests that will fail however often they are retried
+NON_RETRIABLE_ERROR_CODES = (
+    "context_length_exceeded",
+    "content_filter",
+    "content_policy_violation",
+    "invalid_prompt",
+    "insufficient_quota",
+    "model_not_found",
+    "invalid_api_key",
+)
+
+
+def classify_error(status, response_json) -> str:
+    """Sort a failed call into "rate_limit", "retriable" (e.g. server errors) or "non_retriable" (e.g. a 400)."""
+    error = response_json.get("error") if isinstance(response_json, dict) else None
+    if not isinstance(error, dict):
+        error = {"message": str(error or "")}
+    # some providers answer 200 with the actual status as the error code
+    if isinstance(error.get("code"), int) and status in (None, 200):
+        status = error["code"]
+    code = f"{error.get('code') or ''} {error.get('type') or ''}".lower()
+    message = str(error.get("message") or "").lower()
+    if any(non_retriable_code in code for non_retriable_code in NON_RETRIABLE_ERROR_CODES):
+        return "non_retriable"
+    if status == 429 or "rate limit" in message:
+        return "rate_limit"
+    if status is None or status in (408, 409) or status >= 500:
+        return "retriable"
+    if 400 <= status < 500:
+        return "non_retriable"
+    return "retriable"
+
+
+def file_fingerprint(filepath: str) -> str:
+    """sha256 of a file's contents, used to tell whether partial results belong to it."""
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def request_key(request_json: dict, task_id: int):
+    """Identify a request across runs by its custom_id, or by its line number if it has none."""
+    return request_json.get("custom_id", task_id)
+
+
+def result_key_and_status(record, record_format: str):
+    """Return the request key of a results record and whether the request succeeded."""
+    if record_format == "batch":
+        return record["custom_id"], "error" not in record
+    task_id, request_json, response = record[0], record[1], record[2]
+    return request_key(request_json, task_id), isinstance(
+        response, dict
+    ) and "error" not in response
+
+
+def compact_results_file(save_filepath: str, record_format: str) -> set:
+    """Drop failed, duplicate and truncated records from a results file. Returns the keys of the successful ones."""
+    completed_keys = set()
+    temporary_filepath = f"{save_filepath}.tmp"
+    with open(save_filepath, "rb") as f_in, open(temporary_filepath, "wb") as f_out:
+        for line in f_in:
+            try:
+                key, succeeded = result_key_and_status(orjson.loads(line), record_format)
+            except (orjson.JSONDecodeError, KeyError, IndexError, TypeError):
+                continue  # e.g. a line cut short by the interruption
+            if succeeded and key not in completed_keys:
+                completed_keys.add(key)
+                f_out.write(line if line.endswith(b"\n") else line + b"\n")
+    os.replace(temporary_filepath, save_filepath)
+    return completed_keys
+
+
+def sort_results_file(save_filepath: str, requests_filepath: str, record_format: str):
+    """Put a resumed results file back into the order of the requests file."""
+    with open(requests_filepath, "rb") as f:
+        order = {
+            request_key(orjson.loads(line), line_number): line_number
+            for line_number, line in enumerate(f)
+        }
+    with open(save_filepath, "rb") as f:
+        lines = f.readlines()
+    lines.sort(
+        key=lambda line: order.get(
+            result_key_and_status(orjson.loads(line), record_format)[0], len(order)
+        )
+    )
+    temporary_filepath = f"{save_filepath}.tmp"
+    with open(temporary_filepath, "wb") as f:
+        f.writelines(lines)
+    os.replace(temporary_filepath, save_filepath)
+
+
+@functools.lru_cache(maxsize=None)
+def get_token_counter(token_encoding_name: str) -> "TokenCounter":
+    """One token counter (and one loaded encoding) per encoding name for the whole process."""
+    return TokenCounter(tiktoken.get_encoding(token_encoding_name))
+
+
+def num_tokens_consumed_from_requests(
+    request_jsons: list,
+    token_counter: "TokenCounter",
+) -> list:
+    """Count the (prompt, completion) tokens of each request. Only supports chat completion requests."""
+    strings = [
+        value if isinstance(value, str) else orjson.dumps(value).decode()
+        for request_json in request_jsons
+        for message in request_json["body"]["messages"]
+        for value in message.values()
+    ]
+    string_counts = iter(token_counter.count(strings))
+    token_counts = []
+    for request_json in request_jsons:
+        # if completions request, tokens = prompt + n * max_tokens
+        max_tokens = request_json["body"].get(
+            "max_tokens", request_json.get("max_tokens", 15)
+        )
+        n = request_json["body"].get("n", request_json.get("n", 1))
+        completion_tokens = n * max_tokens
+        num_tokens = 0
+        for message in request_json["body"]["messages"]:
+            num_tokens += 4  # every message follows <im_start>{role/name}\n{content}<im_end>\n
+            for key in message:
+                num_tokens += next(string_counts)
+                if key == "name":  # if there's a name, the role is omitted
+                    num_tokens -= 1  # role is always required and always 1 token
+        num_tokens += 2  # every reply is primed with <im_start>assistant
+        token_counts.append((num_tokens, completion_tokens))
+    return token_counts
 
 
 def num_tokens_consumed_from_request(
     request_json: dict,
-    api_endpoint: str,
     token_encoding_name: str,
 ):
-    """Count the number of tokens in the request. Only supports completion and embedding requests."""
-    encoding = tiktoken.get_encoding(token_encoding_name)
-    # if completions request, tokens = prompt + n * max_tokens
-    max_tokens = request_json.get("max_tokens", 15)
-    n = request_json.get("n", 1)
-    completion_tokens = n * max_tokens
-    num_tokens = 0
-    for message in request_json["body"]["messages"]:
-        num_tokens += 4  # every message follows <im_start>{role/name}\n{content}<im_end>\n
-        for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
-            if key == "name":  # if there's a name, the role is omitted
-                num_tokens -= 1  # role is always required and always 1 token
-    num_tokens += 2  # every reply is primed with <im_start>assistant
-    return num_tokens + completion_tokens
-
-
-
-def task_id_generator_function():
-    """Generate integers 0, 1, 2, and so on."""
-    task_id = 0
-    while True:
-        yield task_id
-        task_id += 1
+    """Count the number of tokens in the request. Only supports chat completion requests."""
+    return sum(
+        num_tokens_consumed_from_requests(
+            [request_json], get_token_counter(token_encoding_name)
+        )[0]
+    )
+
+
+def prepare_requests(
+    lines: list,
+    first_task_id: int,
+    token_counter: "TokenCounter",
+    completed_keys: set,
+) -> list:
+    """Parse a chunk of request lines and count their tokens. Requests completed by a previous run come back as None;
+    blank lines are left out."""
+    prepared = []
+    for task_id, line in enumerate(lines, start=first_task_id):
+        if not line.strip():
+            continue
+        request_json = orjson.loads(line)
+        if completed_keys and request_key(request_json, task_id) in completed_keys:
+            request_json = None
+        prepared.append((task_id, request_json))
+    token_counts = iter(
+        num_tokens_consumed_from_requests(
+            [request_json for _, request_json in prepared if request_json is not None],
+            token_counter,
+        )
+    )
+    return [
+        (task_id, request_json, *next(token_counts))
+        if request_json is not None
+        else (task_id, None, 0, 0)
+        for task_id, request_json in prepared
+    ]
+
+
+async def read_requests(
+    jobs: list,
+    request_queue: asyncio.Queue,
+    token_counter: "TokenCounter",
+    status_tracker: "StatusTracker",
+    lines_per_chunk: int = 256,
+):
+    """Feed (job, task_id, request_json, prompt_tokens, completion_tokens) tuples to the main loop, one requests
+    file after the other, then None at the end of the last file.
+
+    Reading, parsing and token counting run in a worker thread so the event loop stays free to dispatch;
+    the bounded queue stops reading while the dispatcher is behind.
+    """
+    for job in jobs:
+        await asyncio.to_thread(job.prepare)
+        job.start()
+        task_id = 0
+        with open(job.requests_filepath, "rb") as file:
+            while True:
+                lines = await asyncio.to_thread(
+                    lambda: list(itertools.islice(file, lines_per_chunk))
+                )
+                if not lines:
+                    break
+                prepared = await asyncio.to_thread(
+                    prepare_requests, lines, task_id, token_counter, job.completed_keys
+                )
+                # blank lines get no request, but their task_ids still have to be released in order
+                prepared_task_ids = {prepared_request[0] for prepared_request in prepared}
+                for blank_task_id in range(task_id, task_id + len(lines)):
+                    if blank_task_id not in prepared_task_ids:
+                        job.writer.skip(blank_task_id)
+                task_id += len(lines)
+                for prepared_request in prepared:
+                    if prepared_request[1] is None:
+                        # completed in a previous run
+                        job.writer.skip(prepared_request[0])
+                        status_tracker.num_tasks_skipped += 1
+                        continue
+                    job.num_tasks_pending += 1
+                    await request_queue.put((job, *prepared_request))
+                    status_tracker.wakeup_event.set()
+        job.finished_reading = True
+        job.maybe_finish()
+    await request_queue.put(None)
+    status_tracker.wakeup_event.set()
 
 
 # run script
@@ -429,25 +1807,47 @@ def task_id_generator_function():
 if __name__ == "__main__":
     # parse command line arguments
     parser = argparse.ArgumentParser()
-    parser.add_argument("--requests_filepath")
-    parser.add_argument("--save_filepath", default=None)
+    parser.add_argument("--requests_filepath", nargs="+")
+    parser.add_argument("--save_filepath", nargs="+", default=None)
     parser.add_argument("--request_url", default="https://api.openai.com/v1/chat/completions")
     parser.add_argument("--api_key", default=os.getenv("OPENAI_API_KEY"))
+    parser.add_argument("--endpoints_file", default=None)
     parser.add_argument("--max_requests_per_minute", type=int, default=1_000 * 0.5)
     parser.add_argument("--max_tokens_per_minute", type=int, default=10_000_000 * 0.5)
     parser.add_argument("--token_encoding_name", default="cl100k_base")
     parser.add_argument("--max_attempts", type=int, default=10)
     parser.add_argument("--logging_level", default=logging.INFO)
+    parser.add_argument("--adaptive_rate_limit", type=lambda x: x == "True", default=True)
+    parser.add_argument("--record_format", choices=["raw", "batch"], default="raw")
+    parser.add_argument("--ordered_output", type=lambda x: x == "True", default=False)
+    parser.add_argument("--fsync_interval", type=float, default=1.0)
+    parser.add_argument("--resume", type=lambda x: x == "True", default=False)
+    parser.add_argument("--learn_output_lengths", type=lambda x: x == "True", default=True)
+    parser.add_argument("--max_requests_in_flight", type=int, default=500)
+    parser.add_argument("--hedge_percentile", type=float, default=None)
+    parser.add_argument("--hedge_budget", type=float, default=0.05)
+    parser.add_argument("--record_timings", type=lambda x: x == "True", default=False)
+    parser.add_argument("--metrics_path", default=None)
+    parser.add_argument("--metrics_interval", type=float, default=15.0)
+    parser.add_argument("--cache_path", default=None)
+    parser.add_argument("--cache_max_bytes", type=int, default=1 << 30)
+    parser.add_argument("--cache_max_temperature", type=float, default=0.1)
     args = parser.parse_args()
 
     if args.save_filepath is None:
-        args.save_filepath = args.requests_filepath.replace(".jsonl", "_results.jsonl")
+        args.save_filepath = [
+            requests_filepath.replace(".jsonl", "_results.jsonl")
+            for requests_filepath in args.requests_filepath
+        ]
+    if len(args.save_filepath) != len(args.requests_filepath):
+        parser.error("--save_filepath needs one path per requests file")
 
     # run script
     asyncio.run(
-        process_api_requests_from_file(
-            requests_filepath=args.requests_filepath,
-            save_filepath=args.save_filepath,
+        process_api_requests_from_files(
+            requests_and_save_filepaths=list(
+                zip(args.requests_filepath, args.save_filepath)
+            ),
             request_url=args.request_url,
             api_key=args.api_key,
             max_requests_per_minute=float(args.max_requests_per_minute),
@@ -455,6 +1855,26 @@ if __name__ == "__main__":
             token_encoding_name=args.token_encoding_name,
             max_attempts=int(args.max_attempts),
             logging_level=int(args.logging_level),
+            adaptive_rate_limit=args.adaptive_rate_limit,
+            record_format=args.record_format,
+            ordered_output=args.ordered_output,
+            fsync_interval=args.fsync_interval,
+            resume=args.resume,
+            learn_output_lengths=args.learn_output_lengths,
+            max_requests_in_flight=args.max_requests_in_flight,
+            endpoints=(
+                load_endpoints_file(args.endpoints_file)
+                if args.endpoints_file
+                else None
+            ),
+            hedge_percentile=args.hedge_percentile,
+            hedge_budget=args.hedge_budget,
+            record_timings=args.record_timings,
+            metrics_path=args.metrics_path,
+            metrics_interval=args.metrics_interval,
+            cache_path=args.cache_path,
+            cache_max_bytes=args.cache_max_bytes,
+            cache_max_temperature=args.cache_max_temperature,
         )
     )
 
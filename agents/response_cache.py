@@ -0,0 +1,167 @@
+"""
+RESPONSE CACHE
+
+On-disk cache of API responses for (near) deterministic requests, so that reruns of the same request file,
+or regeneration rounds that send an identical evaluation request again, do not pay for another call.
+
+Entries are keyed by the sha256 of the normalized request body (model, messages and sampling parameters, with
+keys sorted) plus the URL it is sent to. Only requests whose temperature is at most `max_temperature` are
+cached; sampling at higher temperatures is expected to give a different answer each time.
+
+The cache is a single sqlite file. When it grows past `max_bytes`, the least recently used entries are evicted.
+
+All sqlite work runs on one thread of the cache's own, so a running event loop only waits for it through
+`get_async`, and never for writes: `put_later` keeps responses in memory and writes them `commit_every` at a
+time, in one transaction, while the loop carries on.
+"""
+
+import asyncio  # for looking up responses without blocking the event loop
+import concurrent.futures  # for the thread that owns the sqlite connection
+import hashlib  # for content-addressing request bodies
+import logging  # for reporting evictions
+import os  # for creating the cache directory
+import sqlite3  # for storing responses on disk
+import time  # for tracking when entries were last used
+
+import orjson  # for serializing request bodies and responses
+
+# body fields that do not change the response
+IGNORED_BODY_KEYS = ("user", "metadata", "store", "stream_options")
+
+
+class ResponseCache:
+    """Size-bounded, least-recently-used store of responses keyed by request content."""
+
+    def __init__(
+        self,
+        path: str,
+        max_bytes: int = 1 << 30,
+        max_temperature: float = 0.1,
+        commit_every: int = 100,
+    ) -> None:
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_temperature = max_temperature
+        self.commit_every = commit_every
+        self.uncommitted_writes = 0
+        self.num_hits = 0
+        self.num_misses = 0
+        self.pending_puts = {}  # key -> response, not yet handed to the sqlite thread
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="response_cache"
+        )
+        self.executor.submit(self.open).result()
+
+    def open(self) -> None:
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response BLOB, size INTEGER, last_used REAL)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)"
+        )
+        self.total_bytes = self.connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+
+    def key(self, body: dict, request_url: str):
+        """Content address of a request, or None if the request is not deterministic enough to cache."""
+        temperature = body.get("temperature") if body.get("temperature") is not None else 1.0
+        if temperature > self.max_temperature:
+            return None
+        normalized = {k: v for k, v in body.items() if k not in IGNORED_BODY_KEYS}
+        payload = orjson.dumps(
+            {"url": request_url, "body": normalized}, option=orjson.OPT_SORT_KEYS
+        )
+        return hashlib.sha256(payload).hexdigest()
+
+    def get(self, key: str):
+        """Return the stored response for `key`, or None."""
+        row = self.connection.execute(
+            "SELECT response FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            self.num_misses += 1
+            return None
+        self.num_hits += 1
+        self.connection.execute(
+            "UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key)
+        )
+        self.maybe_commit()
+        return orjson.loads(row[0])
+
+    async def get_async(self, key: str):
+        """`get` on the sqlite thread; responses still waiting to be written are answered from memory."""
+        if key in self.pending_puts:
+            self.num_hits += 1
+            return self.pending_puts[key]
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.get, key)
+
+    def put_later(self, key: str, response) -> None:
+        """Queue a successful response; every `commit_every` of them are written together on the sqlite thread."""
+        self.pending_puts[key] = response
+        if len(self.pending_puts) >= self.commit_every:
+            self.flush()
+
+    def flush(self) -> None:
+        """Hand the queued responses to the sqlite thread, without waiting for them to be written."""
+        if self.pending_puts:
+            pending_puts, self.pending_puts = self.pending_puts, {}
+            self.executor.submit(self.put_many, pending_puts)
+
+    def put_many(self, responses: dict) -> None:
+        for key, response in responses.items():
+            self.put(key, response, commit=False)
+        self.connection.commit()
+        self.uncommitted_writes = 0
+
+    def put(self, key: str, response, commit: bool = True) -> None:
+        """Store a successful response, evicting old entries if the cache is over its size bound."""
+        blob = orjson.dumps(response)
+        previous = self.connection.execute(
+            "SELECT size FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        self.connection.execute(
+            "INSERT OR REPLACE INTO responses (key, response, size, last_used) VALUES (?, ?, ?, ?)",
+            (key, blob, len(blob), time.time()),
+        )
+        self.total_bytes += len(blob) - (previous[0] if previous else 0)
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+        if commit:
+            self.maybe_commit()
+
+    def evict(self) -> None:
+        """Drop least recently used entries until the cache is back under 90% of its bound."""
+        target_bytes = self.max_bytes * 0.9
+        num_evicted = 0
+        rows = self.connection.execute(
+            "SELECT key, size FROM responses ORDER BY last_used"
+        ).fetchall()
+        for key, size in rows:
+            if self.total_bytes <= target_bytes:
+                break
+            self.connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self.total_bytes -= size
+            num_evicted += 1
+        logging.info(f"Evicted {num_evicted} entries from response cache {self.path}")
+
+    def maybe_commit(self) -> None:
+        self.uncommitted_writes += 1
+        if self.uncommitted_writes >= self.commit_every:
+            self.connection.commit()
+            self.uncommitted_writes = 0
+
+    def close(self) -> None:
+        """Write the queued responses and close the connection; waits for the sqlite thread to finish."""
+        self.flush()
+        self.executor.submit(self.close_connection).result()
+        self.executor.shutdown()
+
+    def close_connection(self) -> None:
+        self.connection.commit()
+        self.connection.close()
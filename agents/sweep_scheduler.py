@@ -0,0 +1,232 @@
+"""
+SWEEP SCHEDULER
+
+Runs the vLLM dialogue generation sweep of generate_dialogues_vllm.sh (starters, turn 0, then user and assistant
+turns for every language) as a dependency graph of stages, so that the loaded model changes as rarely as possible.
+
+generate_dialogues_vllm.sh goes language by language and alternates the user and assistant models at every
+stage, so a sweep of 6 languages and 4 turns loads a model 60 times. Each language's stage only depends on the
+previous stage of the same language, though, so all the stages that are ready for the loaded model, across
+languages, can run before switching. The models then alternate once per stage of the dialogue, about 2 loads
+per turn (10 for the whole sweep).
+
+Features:
+- Builds the (language, turn, role) stage graph and runs it in waves, one model per wave
+- Starts a resident vLLM worker (vllm_batch.py --serve) for the whole sweep; the stages of a wave run as
+  concurrent processes of the existing 0_, 1_ and 4_ scripts, which submit their batches to the worker, so their
+  evaluation API calls also overlap
+- A stage that fails skips the stages that depend on it; the other languages carry on
+- Writes the output of each stage to its own log file
+- --dry_run prints the waves and the number of model loads without running anything
+
+Example command:
+```
+python agents/sweep_scheduler.py --model_owner microsoft --model Phi-4-mini-instruct --tensor_parallel_size 4
+```
+
+The script is structured as follows:
+    - Imports
+    - Define dataclasses
+        - Stage (one script invocation: a language, turn and role, with the model it needs)
+    - Define functions
+        - build_stages (the dependency graph of a sweep)
+        - next_model (which model to run next)
+        - run_sweep (run the graph in waves)
+    - Main
+"""
+
+# imports
+import argparse  # for running script from command line
+import asyncio  # for running the stages of a wave concurrently
+import logging  # for logging progress
+import os  # for log files and environment variables
+import subprocess  # for the resident vLLM worker
+import sys  # for running the worker with this interpreter
+import time  # for timing waves
+from dataclasses import dataclass, field  # for storing stages
+
+LANGUAGES = ["chinese", "english", "french", "german", "portuguese", "spanish"]
+
+
+# dataclasses
+
+
+@dataclass
+class Stage:
+    """One script invocation of the sweep."""
+
+    lang: str
+    turn: int
+    role: str  # "starters", "user" or "assistant"
+    model: str  # model the stage runs on vLLM
+    command: list
+    dependencies: list = field(default_factory=list)  # names of the stages this one needs
+    status: str = "waiting"  # waiting, running, done, failed or skipped
+
+    @property
+    def name(self) -> str:
+        return f"{self.lang}/turn-{self.turn}/{self.role}"
+
+
+# functions
+
+
+def build_stages(args) -> dict:
+    """The stages of a sweep by name, as in generate_dialogues_vllm.sh."""
+    user_model = f"{args.user_owner}/{args.user}"
+    assistant_model = f"{args.model_owner}/{args.model}"
+    tp = str(args.tensor_parallel_size)
+    stages = {}
+
+    def add(stage):
+        stages[stage.name] = stage
+        return stage.name
+
+    for lang in args.langs:
+        previous = add(
+            Stage(lang, 0, "starters", user_model,
+                  ["./0_generate_starters_vllm.sh", args.user_owner, args.user, lang, tp, args.original_dataset])
+        )
+        previous = add(
+            Stage(lang, 0, "assistant", assistant_model,
+                  ["./1_generate_turn0_vllm.sh", args.model_owner, args.model, lang, args.user, tp, args.original_dataset],
+                  [previous])
+        )
+        for turn in range(1, args.turns + 1):
+            previous = add(
+                Stage(lang, turn, "user", user_model,
+                      ["./4_generate_turnX.sh", args.user_owner, args.user, lang, str(turn), args.model, tp, "user"],
+                      [previous])
+            )
+            previous = add(
+                Stage(lang, turn, "assistant", assistant_model,
+                      ["./4_generate_turnX.sh", args.model_owner, args.model, lang, str(turn), args.user, tp, "assistant"],
+                      [previous])
+            )
+    return stages
+
+
+def ready_stages(stages: dict) -> list:
+    """Waiting stages whose dependencies are done; stages behind a failure are marked skipped."""
+    ready = []
+    for stage in stages.values():
+        if stage.status != "waiting":
+            continue
+        statuses = [stages[name].status for name in stage.dependencies]
+        if any(status in ("failed", "skipped") for status in statuses):
+            stage.status = "skipped"
+            logging.warning(f"{stage.name} skipped, a stage it depends on failed")
+        elif all(status == "done" for status in statuses):
+            ready.append(stage)
+    return ready
+
+
+def next_model(ready: list, loaded_model: str):
+    """Stay on the loaded model while it has ready stages, otherwise switch to the model with the most."""
+    models = [stage.model for stage in ready]
+    if not models:
+        return None
+    if loaded_model in models:
+        return loaded_model
+    return max(dict.fromkeys(models), key=models.count)
+
+
+async def run_stage(stage: Stage, log_dir: str, env: dict, semaphore: asyncio.Semaphore):
+    async with semaphore:
+        stage.status = "running"
+        log_filepath = os.path.join(log_dir, f"{stage.name.replace('/', '_')}.log")
+        logging.info(f"{stage.name} started ({' '.join(stage.command)}), logging to {log_filepath}")
+        with open(log_filepath, "ab") as log_file:
+            process = await asyncio.create_subprocess_exec(
+                *stage.command, stdout=log_file, stderr=subprocess.STDOUT, env=env
+            )
+            returncode = await process.wait()
+        stage.status = "done" if returncode == 0 else "failed"
+        if returncode != 0:
+            logging.warning(f"{stage.name} failed with exit status {returncode}, see {log_filepath}")
+
+
+async def run_sweep(stages: dict, args) -> int:
+    """Run the stages in waves of one model each. Returns the number of model loads."""
+    env = {**os.environ, "VLLM_SPOOL": args.spool_dir}
+    semaphore = asyncio.Semaphore(args.max_parallel_stages)
+    loaded_model = None
+    num_loads = 0
+    num_waves = 0
+    while True:
+        ready = ready_stages(stages)
+        model = next_model(ready, loaded_model)
+        if model is None:
+            break
+        if model != loaded_model:
+            loaded_model = model
+            num_loads += 1
+        wave = [stage for stage in ready if stage.model == model]
+        num_waves += 1
+        logging.warning(
+            f"Wave {num_waves}: {model} for {len(wave)} stages ({', '.join(stage.name for stage in wave)})"
+        )
+        if args.dry_run:
+            for stage in wave:
+                stage.status = "done"
+            continue
+        start_time = time.time()
+        await asyncio.gather(*(run_stage(stage, args.log_dir, env, semaphore) for stage in wave))
+        logging.warning(f"Wave {num_waves} finished in {time.time() - start_time:.0f}s")
+    return num_loads
+
+
+def main(args):
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    stages = build_stages(args)
+    worker = None
+    if not args.dry_run:
+        os.makedirs(args.log_dir, exist_ok=True)
+        worker_log = open(os.path.join(args.log_dir, "vllm_worker.log"), "ab")
+        # the stages submit their batches to this worker (see VLLM_SPOOL in the 0_, 1_ and 4_ scripts)
+        worker = subprocess.Popen(
+            [
+                sys.executable,
+                os.path.join(os.path.dirname(os.path.abspath(__file__)), "vllm_batch.py"),
+                "--serve",
+                "--spool_dir", args.spool_dir,
+                "--tensor_parallel_size", str(args.tensor_parallel_size),
+                "--engine", args.engine,
+            ],
+            stdout=worker_log,
+            stderr=subprocess.STDOUT,
+        )
+    try:
+        num_loads = asyncio.run(run_sweep(stages, args))
+    finally:
+        if worker is not None:
+            worker.terminate()
+            worker.wait()
+            worker_log.close()
+    statuses = [stage.status for stage in stages.values()]
+    logging.warning(
+        f"Sweep finished with {num_loads} model loads: {statuses.count('done')} stages done, "
+        f"{statuses.count('failed')} failed, {statuses.count('skipped')} skipped"
+    )
+    return 1 if statuses.count("done") < len(statuses) else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="run the vLLM dialogue generation sweep with as few model loads as possible"
+    )
+    parser.add_argument("--model_owner", required=True, help="owner of the assistant model")
+    parser.add_argument("--model", required=True, help="assistant model")
+    parser.add_argument("--tensor_parallel_size", type=int, default=4)
+    parser.add_argument("--user_owner", default="google")
+    parser.add_argument("--user", default="gemma-3-27b-it", help="model simulating the user")
+    parser.add_argument("--original_dataset", default="ATOMIC10X_persona_1k_3")
+    parser.add_argument("--langs", nargs="+", default=LANGUAGES)
+    parser.add_argument("--turns", type=int, default=4, help="user/assistant turns after turn 0")
+    parser.add_argument("--max_parallel_stages", type=int, default=6, help="stages of a wave running at once")
+    parser.add_argument("--spool_dir", default=os.getenv("VLLM_SPOOL", "vllm_spool"))
+    parser.add_argument("--log_dir", default="logs/sweep")
+    parser.add_argument("--engine", choices=["vllm", "fake"], default="vllm", help="engine of the vLLM worker")
+    parser.add_argument("--dry_run", action="store_true", help="print the waves without running them")
+    args = parser.parse_args()
+    sys.exit(main(args))
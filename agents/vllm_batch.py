@@ -1,82 +1,598 @@
+"""
+VLLM BATCH
+
+Runs a batch file of chat completion requests through a local vLLM engine and writes the completions to
+completed_batches/..., in the format of OpenAI batch outputs.
+
+Modes:
+- default: run the file, loading each model it names in turn, exit
+- --serve: a resident worker that keeps the model loaded and runs every batch file submitted to its spool
+  directory, so the model is loaded once per model instead of once per pipeline step; it only reloads when a
+  batch names another model, and takes the batches for the loaded model first
+- --submit: hand a batch file to the worker of a spool directory and wait for its completions
+
+A batch file may mix models and sampling parameters (e.g. generation and regeneration requests): its requests are
+grouped by model, loaded once each, and every request is generated with its own temperature, max_tokens and
+top_p. Completions are matched back to requests by custom_id.
+
+Spool directory layout:
+- pending/<id>.json : submitted jobs, {"input_file": ..., "output": ...}
+- running/<id>.json : the job the worker is on (moved back to pending/ if the worker is restarted)
+- done/<id>.json, failed/<id>.json : finished jobs, with the output path or the error
+- worker.json : pid, loaded model and a heartbeat, refreshed every few seconds while the worker is alive
+
+Prefix caching: every request of a batch file starts with the same long system prompt, and the prompts of later
+turns share whole dialogue histories with each other. With --prefix_caching auto (the default), automatic prefix
+caching is turned on for models that support it (see prefix_caching_supported), and prompts are sent sorted, so
+that those sharing a prefix are prefilled one after the other while it is cached. Completions are still written in
+the order of the batch file. The share of prompt tokens served from the cache is reported after each batch.
+
+Crash safety: requests are generated --chunk_size at a time, and each finished chunk is appended (and fsynced) to
+{output}.part. Running the same batch file again after an interruption skips the requests already done (see
+process_file), so a job on a preemptible node loses at most one chunk of work.
+
+Preprocessing: chat templates are applied (and prompts tokenized, with --pretokenize True) by a pool of
+--preprocess_workers processes. Every chunk is queued at once, so later chunks are templated while the engine
+generates earlier ones. The rendered system prompt prefix and its token ids are computed once per model and system
+prompt, and prompts are sent to the engine as token ids, so vLLM does not tokenize them again.
+
+--engine fake replaces vLLM with an engine that runs on CPU and echoes the prompts, to test the control plane
+(submitting, spooling, output format) without a GPU or vLLM installed.
+"""
+
 import os
-from vllm import LLM, SamplingParams
+import gc
+import sys
+import glob
+import time
+import signal
+import uuid
+import hashlib
+import threading
+import multiprocessing
 import orjson
 import argparse
+from concurrent.futures import Future, ProcessPoolExecutor
+
+# architectures (and model names) vLLM cannot cache prefixes for, e.g. because of block-sparse attention
+PREFIX_CACHING_UNSUPPORTED = ("phi3small", "phi-3-small")
+# conversations templated per task of a preprocessing process
+PREPROCESS_BATCH_SIZE = 64
+
+# tokenizer of a preprocessing process (see init_preprocessing)
+preprocessing_tokenizer = None
+# rendered system prompt prefixes by (model, system message), see system_prefix
+system_prefixes = {}
 
 
 def main(args):
+    if args.serve:
+        return serve(args)
     if args.input_file is None:
         raise ValueError("input file is required")
-    if args.output is None:
-        input_file_name = os.path.splitext(os.path.basename(args.input_file))[0]
-        previous_directory = os.path.basename(os.path.dirname(args.input_file))
-        two_directories_up = os.path.basename(os.path.dirname(os.path.dirname(args.input_file)))
-        three_directories_up = os.path.basename(os.path.dirname(os.path.dirname(os.path.dirname(args.input_file))))
-        out_fp = f"completed_batches/{three_directories_up}/{two_directories_up}/{previous_directory}/{input_file_name}.jsonl"
-        if not os.path.exists(os.path.dirname(out_fp)):
-            os.makedirs(os.path.dirname(out_fp))
+    out_fp = args.output or output_filepath(args.input_file)
+    if args.submit:
+        return submit(args.spool_dir, args.input_file, out_fp, args.submit_timeout)
+
+    engine = Engine(args)
+    process_file(engine, args.input_file, out_fp, args.chunk_size)
+
+
+def output_filepath(input_file):
+    """completed_batches/ path of a batch file under batches_to_process/"""
+    input_file_name = os.path.splitext(os.path.basename(input_file))[0]
+    previous_directory = os.path.basename(os.path.dirname(input_file))
+    two_directories_up = os.path.basename(os.path.dirname(os.path.dirname(input_file)))
+    three_directories_up = os.path.basename(os.path.dirname(os.path.dirname(os.path.dirname(input_file))))
+    return f"completed_batches/{three_directories_up}/{two_directories_up}/{previous_directory}/{input_file_name}.jsonl"
+
+
+class Engine:
+    """The loaded model, kept across batch files; loading another model frees the previous one first."""
+
+    def __init__(self, args):
+        self.args = args
+        self.model = None
+        self.llm = None
+        self.tokenizer = None
+        self.prefix_caching = False
+        self.pool = None
+
+    def load(self, model):
+        if model == self.model:
+            return
+        self.unload()
+        print(f"Loading {model}")
+        start_time = time.time()
+        if self.args.prefix_caching == "auto":
+            self.prefix_caching = prefix_caching_supported(model)
+        else:
+            self.prefix_caching = self.args.prefix_caching == "on"
+        try:
+            self.llm = self.new_llm(model)
+        except Exception as e:
+            if self.args.prefix_caching != "auto" or not self.prefix_caching:
+                raise
+            print(f"Loading {model} with prefix caching failed ({e!r}), loading it without")
+            self.unload()
+            self.prefix_caching = False
+            self.llm = self.new_llm(model)
+        print(f"Prefix caching {'on' if self.prefix_caching else 'off'} for {model}")
+        self.tokenizer = self.llm.get_tokenizer()
+        self.model = model
+        if self.args.preprocess_workers > 0:
+            # spawned rather than forked, the engine may have initialised CUDA in this process
+            self.pool = ProcessPoolExecutor(self.args.preprocess_workers,
+                                            mp_context=multiprocessing.get_context("spawn"),
+                                            initializer=init_preprocessing,
+                                            initargs=(model, self.args.engine))
+        print(f"Loaded {model} in {time.time() - start_time:.1f}s")
+
+    def new_llm(self, model):
+        if self.args.engine == "fake":
+            return FakeLLM(model, enable_prefix_caching=self.prefix_caching)
+        # imported here so the control plane (and --submit) works without vLLM
+        from vllm import LLM
+        return LLM(model=model,
+                   tensor_parallel_size=self.args.tensor_parallel_size,
+                   pipeline_parallel_size=self.args.pipeline_parallel_size,
+                   max_model_len=2048*2,
+                   trust_remote_code=True,
+                   enable_prefix_caching=self.prefix_caching,
+                   gpu_memory_utilization=self.args.util)
+
+    def unload(self):
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
+        self.llm = None
+        self.tokenizer = None
+        self.model = None
+        self.prefix_caching = False
+        gc.collect()
+        if self.args.engine != "fake":
+            # release the GPU memory and the parallel groups of the previous model
+            import torch
+            from vllm.distributed.parallel_state import destroy_distributed_environment, destroy_model_parallel
+            destroy_model_parallel()
+            destroy_distributed_environment()
+            torch.cuda.empty_cache()
+
+    def preprocess(self, messages_list):
+        """Futures of the (prompt, prompt_token_ids) of each conversation, rendered in parallel batches."""
+        if self.pool is None:
+            future = Future()
+            future.set_result(render_prompts(self.model, messages_list, self.args.pretokenize, self.tokenizer))
+            return [future]
+        return [self.pool.submit(render_prompts, self.model, messages_list[i:i + PREPROCESS_BATCH_SIZE], self.args.pretokenize)
+                for i in range(0, len(messages_list), PREPROCESS_BATCH_SIZE)]
+
+    def sampling_params(self, body):
+        if self.args.engine == "fake":
+            return FakeSamplingParams(temperature=body["temperature"], max_tokens=body["max_tokens"], top_p=body["top_p"])
+        from vllm import SamplingParams
+        return SamplingParams(temperature=body["temperature"],
+                              max_tokens=body["max_tokens"],
+                              top_p=body["top_p"],
+                              #frequency_penalty=body["frequency_penalty"],
+                              #presence_penalty=body["presence_penalty"]
+                              )
+
+
+def process_file(engine, input_file, out_fp, chunk_size=1024):
+    """Generate the completions of a batch file chunk by chunk, so an interrupted run loses at most one chunk.
+
+    Finished records are appended (and fsynced) to {out_fp}.part as each chunk completes. {out_fp}.inprogress
+    records the fingerprint of the batch file; when it matches, a new run skips the custom_ids already in
+    {out_fp}.part. Once every request is done, the records are written to out_fp in the order of the batch file.
+    """
+    os.makedirs(os.path.dirname(out_fp) or ".", exist_ok=True)
+    part_fp = f"{out_fp}.part"
+    marker_fp = f"{out_fp}.inprogress"
+
+    with open(input_file, 'rb') as file:
+        jobs = [orjson.loads(line) for line in file if line.strip()]
+    fingerprint = file_fingerprint(input_file)
+    if os.path.exists(part_fp) and read_marker(marker_fp) == fingerprint:
+        completed_ids = completed_custom_ids(part_fp)
+        print(f"Resuming {input_file}: {len(completed_ids)} of {len(jobs)} requests already done")
     else:
-        out_fp = args.output
-    
-    custom_ids = []
-    prompts_to_process = []
-    with open(out_fp, 'w') as file_out:
-        with open(args.input_file, 'r') as file:
-            first_line=True
-            for line in file:
-                job = orjson.loads(line)
-                custom_ids.append(job["custom_id"])
-                if first_line:
-                    # Initialize model and tokenizer from job
-                    first_line = False
-                    model = job["body"]["model"]
-                    llm = LLM(model=model,
-                                tensor_parallel_size=args.tensor_parallel_size,
-                                pipeline_parallel_size=args.pipeline_parallel_size,
-                                max_model_len=2048*2,
-                                trust_remote_code=True,
-                                #enable_prefix_caching=True, # Phi doesn't support APC
-                                gpu_memory_utilization=args.util)
-                    tokenizer = llm.get_tokenizer()
-                    sampling_params = SamplingParams(temperature=job["body"]["temperature"],
-                                            max_tokens=job["body"]["max_tokens"],
-                                            top_p=job["body"]["top_p"],
-                                            #frequency_penalty=job["body"]["frequency_penalty"],
-                                            #presence_penalty=job["body"]["presence_penalty"]
-                                            )
-                
-                if "gemma-3" in model:
-                    message = add_type(job["body"]["messages"])
-                else:
-                    message = job["body"]["messages"]
-                prompts_to_process.append(tokenizer.apply_chat_template(message,
-                                        tokenize=False,
-                                        add_generation_prompt=True))
-        
-        outputs = llm.generate(prompts_to_process, sampling_params)
-        
-        for i,output in enumerate(outputs):
-            obj = {
-                "custom_id": custom_ids[i],
-                "response": {
-                    "body": {
-                        "model": job["body"]["model"],
-                        "choices": [
-                            {
-                                "message": {
-                                    "role": "assistant",
-                                    "content": output.outputs[0].text
-                                },
-                            },
-                        ],
-                    },
-                "prompt": output.prompt,
-                }
-            }
-            file_out.write(orjson.dumps(obj).decode('utf-8','replace') + '\n')
+        completed_ids = set()
+        open(part_fp, 'wb').close()
+        write_json(marker_fp, {"input_file": input_file, "fingerprint": fingerprint})
+    remaining = [job for job in jobs if job["custom_id"] not in completed_ids]
+
+    if remaining:
+        with open(part_fp, 'ab') as file_out:
+            for records in generate_records(engine, remaining, chunk_size):
+                for obj in records:
+                    file_out.write(orjson.dumps(obj, option=orjson.OPT_APPEND_NEWLINE))
+                file_out.flush()
+                os.fsync(file_out.fileno())
+
+    # put the records in the order of the batch file (later steps match them to requests by position)
+    with open(part_fp, 'rb') as file:
+        records = {orjson.loads(line)["custom_id"]: line for line in file}
+    with open(f"{out_fp}.tmp", 'wb') as file_out:
+        for job in jobs:
+            file_out.write(records[job["custom_id"]])
+    os.replace(f"{out_fp}.tmp", out_fp)
+    os.remove(part_fp)
+    os.remove(marker_fp)
     print(f"Saved to {out_fp}")
 
 
+def generate_records(engine, jobs, chunk_size=1024):
+    """Generate the completions of batch requests, yielding the records of each chunk as it finishes.
+
+    Requests are grouped by model, starting with the loaded one, and by sampling parameters within a model.
+    Records are in the format of OpenAI batch outputs; within a chunk they are in generation order, not request
+    order, so callers match them to requests by custom_id.
+    """
+    models = list(dict.fromkeys(job["body"]["model"] for job in jobs))
+    models.sort(key=lambda model: model != engine.model)
+    num_groups = len({(job["body"]["model"], sampling_key(job["body"])) for job in jobs})
+    print(f"{len(jobs)} requests in {num_groups} groups of model and sampling parameters")
+    prompts_generated = []
+    cached_tokens, prompt_tokens = [], 0
+    for model in models:
+        model_jobs = [job for job in jobs if job["body"]["model"] == model]
+        # Initialize model and tokenizer (kept if already loaded)
+        engine.load(model)
+        sampling_params = {}
+        for job in model_jobs:
+            key = sampling_key(job["body"])
+            if key not in sampling_params:
+                sampling_params[key] = engine.sampling_params(job["body"])
+
+        if engine.args.sort_by_prefix:
+            # prompts sharing a prefix (system prompt, dialogue history) go one after the other, while it is cached
+            order = sorted(range(len(model_jobs)), key=lambda i: (sampling_key(model_jobs[i]["body"]), "\x00".join(
+                message["content"] for message in model_jobs[i]["body"]["messages"])))
+        else:
+            order = sorted(range(len(model_jobs)), key=lambda i: sampling_key(model_jobs[i]["body"]))
+        chunks = [order[chunk_start:chunk_start + chunk_size] for chunk_start in range(0, len(order), chunk_size)]
+        # all chunks are queued for preprocessing at once, so later chunks are templated while earlier ones generate
+        rendered_chunks = [engine.preprocess([model_jobs[i]["body"]["messages"] for i in chunk]) for chunk in chunks]
+        for chunk, futures in zip(chunks, rendered_chunks):
+            rendered = [prompt for future in futures for prompt in future.result()]
+            prompts_generated += [prompt for prompt, _ in rendered]
+            outputs = engine.llm.generate(
+                # a dict with prompt_token_ids is a vllm TokensPrompt, which vLLM does not tokenize again
+                [prompt if prompt_token_ids is None else {"prompt_token_ids": prompt_token_ids}
+                 for prompt, prompt_token_ids in rendered],
+                # one SamplingParams per request
+                [sampling_params[sampling_key(model_jobs[i]["body"])] for i in chunk])
+            records = []
+            for i, (prompt, _), output in zip(chunk, rendered, outputs):
+                records.append({
+                    "custom_id": model_jobs[i]["custom_id"],
+                    "response": {
+                        "body": {
+                            "model": model,
+                            "choices": [
+                                {
+                                    "message": {
+                                        "role": "assistant",
+                                        "content": output.outputs[0].text
+                                    },
+                                },
+                            ],
+                        },
+                    "prompt": prompt,
+                    }
+                })
+                cached_tokens.append(getattr(output, "num_cached_tokens", None))
+                prompt_tokens += len(getattr(output, "prompt_token_ids", None) or [])
+            yield records
+            print(f"Generated {len(prompts_generated)} of {len(jobs)} requests")
+    report_prefix_reuse(prompts_generated, cached_tokens, prompt_tokens)
+
+
+def sampling_key(body):
+    """The sampling parameters of a request, as used by Engine.sampling_params."""
+    return body["temperature"], body["max_tokens"], body["top_p"]
+
+
+def init_preprocessing(model, engine):
+    """Load the tokenizer of a preprocessing process."""
+    global preprocessing_tokenizer
+    if engine == "fake":
+        preprocessing_tokenizer = FakeTokenizer()
+    else:
+        from transformers import AutoTokenizer
+        preprocessing_tokenizer = AutoTokenizer.from_pretrained(model, trust_remote_code=True)
+
+
+def render_prompts(model, messages_list, pretokenize, tokenizer=None):
+    """Apply the chat template to conversations, in a preprocessing process unless a tokenizer is given."""
+    tokenizer = tokenizer or preprocessing_tokenizer
+    return [render_prompt(tokenizer, model, messages, pretokenize) for messages in messages_list]
+
+
+def render_prompt(tokenizer, model, messages, pretokenize):
+    """The prompt of a conversation and, with pretokenize, its token ids (None otherwise).
+
+    The token ids of the system prompt prefix are reused from system_prefix; the first time a prefix is used,
+    they are checked against tokenizing the whole prompt, in case tokens merge across the cut.
+    """
+    if "gemma-3" in model:
+        messages = add_type(messages)
+    prompt = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+    if not pretokenize:
+        return prompt, None
+    prefix = system_prefix(tokenizer, model, messages)
+    if prefix is None or prefix["token_ids"] is None or not prompt.startswith(prefix["text"]):
+        return prompt, tokenizer.encode(prompt)
+    prompt_token_ids = prefix["token_ids"] + tokenizer.encode(prompt[len(prefix["text"]):], add_special_tokens=False)
+    if not prefix["checked"]:
+        prefix["checked"] = True
+        full_prompt_token_ids = tokenizer.encode(prompt)
+        if prompt_token_ids != full_prompt_token_ids:
+            prefix["token_ids"] = None
+            return prompt, full_prompt_token_ids
+    return prompt, prompt_token_ids
+
+
+def system_prefix(tokenizer, model, messages):
+    """The rendered system prompt up to its last line break and its token ids, cached per model and system prompt.
+
+    The rendering is found by applying the chat template to the system prompt and a placeholder user message,
+    since templates differ in what they put around the system prompt (gemma-3 folds it into the first user turn).
+    None for conversations without a system prompt.
+    """
+    if len(messages) < 2 or messages[0]["role"] != "system":
+        return None
+    key = (model, orjson.dumps(messages[0]))
+    if key not in system_prefixes:
+        placeholder = "<<user message>>"
+        content = placeholder if isinstance(messages[1]["content"], str) else [{"type": "text", "text": placeholder}]
+        try:
+            rendered = tokenizer.apply_chat_template([messages[0], {"role": "user", "content": content}],
+                                                     tokenize=False,
+                                                     add_generation_prompt=False)
+        except Exception:
+            rendered = ""
+        text = rendered[:rendered.find(placeholder)] if placeholder in rendered else ""
+        text = text[:text.rfind("\n") + 1]
+        system_prefixes[key] = {"text": text, "token_ids": tokenizer.encode(text) if text else None, "checked": False}
+    return system_prefixes[key]
+
+
+def file_fingerprint(filepath):
+    """sha256 of a file's contents, to tell whether partial results belong to it"""
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_marker(marker_fp):
+    try:
+        with open(marker_fp, 'rb') as f:
+            return orjson.loads(f.read())["fingerprint"]
+    except (FileNotFoundError, orjson.JSONDecodeError, KeyError):
+        return None
+
+
+def completed_custom_ids(part_fp):
+    """custom_ids of the complete records of a partial output; a record cut short by the interruption is dropped."""
+    completed_ids = set()
+    valid_bytes = 0
+    with open(part_fp, 'rb') as f:
+        for line in f:
+            try:
+                completed_ids.add(orjson.loads(line)["custom_id"])
+            except (orjson.JSONDecodeError, KeyError):
+                break
+            if not line.endswith(b"\n"):
+                break
+            valid_bytes += len(line)
+    with open(part_fp, 'r+b') as f:
+        f.truncate(valid_bytes)
+    return completed_ids
+
+
+def prefix_caching_supported(model):
+    """Whether vLLM can cache prefixes for a model, judged from its name and the architectures in its config."""
+    names = [model.lower()]
+    try:
+        from transformers import AutoConfig
+        names += [architecture.lower() for architecture in AutoConfig.from_pretrained(model, trust_remote_code=True).architectures or []]
+    except Exception:
+        pass  # e.g. no transformers or no access to the config; the load falls back if caching fails
+    return not any(unsupported in name for name in names for unsupported in PREFIX_CACHING_UNSUPPORTED)
+
+
+def report_prefix_reuse(prompts, cached_tokens, prompt_tokens):
+    """Print how much of the prompts repeats the previous one, and how much the engine served from its cache."""
+    total_characters = sum(len(prompt) for prompt in prompts)
+    shared_characters = sum(len(os.path.commonprefix([a, b])) for a, b in zip(prompts, prompts[1:]))
+    print(f"Prompts share {shared_characters / max(total_characters, 1):.1%} of their characters with the previous prompt")
+    if cached_tokens and all(num_cached_tokens is not None for num_cached_tokens in cached_tokens):
+        print(f"Prefix cache hit rate: {sum(cached_tokens) / max(prompt_tokens, 1):.1%} of {prompt_tokens} prompt tokens")
+
+
+def serve(args):
+    """Run the jobs of the spool directory as they arrive until idle for --idle_timeout seconds.
+
+    Jobs for the loaded model go first (see next_ticket), otherwise the oldest job.
+    """
+    for state in ("pending", "running", "done", "failed"):
+        os.makedirs(os.path.join(args.spool_dir, state), exist_ok=True)
+    # a job left running by a previous worker did not finish
+    for ticket in glob.glob(os.path.join(args.spool_dir, "running", "*.json")):
+        os.replace(ticket, os.path.join(args.spool_dir, "pending", os.path.basename(ticket)))
+
+    # kill (e.g. from the trap of generate_dialogues_vllm.sh) shuts the worker down cleanly
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    engine = Engine(args)
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=beat, args=(args.spool_dir, engine, stop), daemon=True)
+    heartbeat.start()
+    print(f"Serving {args.spool_dir}")
+    last_job_time = time.time()
+    try:
+        while args.idle_timeout is None or time.time() - last_job_time < args.idle_timeout:
+            tickets = sorted(glob.glob(os.path.join(args.spool_dir, "pending", "*.json")), key=os.path.getmtime)
+            if not tickets:
+                time.sleep(args.poll_interval)
+                continue
+            pending = next_ticket(tickets, engine.model)
+            running = os.path.join(args.spool_dir, "running", os.path.basename(pending))
+            try:
+                os.replace(pending, running)
+            except FileNotFoundError:
+                continue  # taken back by its submitter
+            with open(running, 'rb') as f:
+                ticket = orjson.loads(f.read())
+            try:
+                process_file(engine, ticket["input_file"], ticket["output"], args.chunk_size)
+                ticket["status"] = "done"
+            except Exception as e:
+                print(f"Failed {ticket['input_file']}: {e!r}")
+                ticket["status"] = "failed"
+                ticket["error"] = repr(e)
+            write_json(os.path.join(args.spool_dir, ticket["status"], os.path.basename(running)), ticket)
+            os.remove(running)
+            last_job_time = time.time()
+    finally:
+        stop.set()
+        heartbeat.join()
+        engine.unload()
+        os.remove(os.path.join(args.spool_dir, "worker.json"))
+    print(f"Idle for {args.idle_timeout}s, exiting")
+
+
+def next_ticket(tickets, model):
+    """The oldest pending job with requests for the loaded model, so a mixed spool switches models less often."""
+    for pending in tickets:
+        try:
+            with open(pending, 'rb') as f:
+                input_file = orjson.loads(f.read())["input_file"]
+            with open(input_file, 'rb') as f:
+                if any(orjson.loads(line)["body"]["model"] == model for line in f if line.strip()):
+                    return pending
+        except (OSError, orjson.JSONDecodeError, KeyError):
+            continue
+    return tickets[0]
+
+
+def beat(spool_dir, engine, stop, interval=5.0):
+    """Tell submitters the worker is alive, even while it loads a model or generates."""
+    while not stop.is_set():
+        write_json(os.path.join(spool_dir, "worker.json"), {"pid": os.getpid(), "model": engine.model, "time": time.time()})
+        stop.wait(interval)
+
+
+def submit(spool_dir, input_file, out_fp, timeout=60.0):
+    """Hand a batch file to the worker of spool_dir and wait until it is done. Returns the exit status."""
+    ticket_id = f"{time.time():.6f}-{uuid.uuid4().hex[:8]}.json"
+    pending = os.path.join(spool_dir, "pending", ticket_id)
+    write_json(pending, {"input_file": os.path.abspath(input_file), "output": os.path.abspath(out_fp), "submitted_at": time.time()})
+    print(f"Submitted {input_file} to {spool_dir}")
+    while True:
+        for status in ("done", "failed"):
+            finished = os.path.join(spool_dir, status, ticket_id)
+            if os.path.exists(finished):
+                with open(finished, 'rb') as f:
+                    ticket = orjson.loads(f.read())
+                os.remove(finished)
+                if status == "failed":
+                    print(f"Worker failed on {input_file}: {ticket['error']}")
+                    return 1
+                print(f"Saved to {out_fp}")
+                return 0
+        if not worker_alive(spool_dir, timeout):
+            try:
+                os.remove(pending)
+            except FileNotFoundError:
+                pass
+            print(f"No live worker on {spool_dir} (start one with --serve)")
+            return 1
+        time.sleep(1.0)
+
+
+def worker_alive(spool_dir, timeout):
+    try:
+        with open(os.path.join(spool_dir, "worker.json"), 'rb') as f:
+            worker = orjson.loads(f.read())
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        return False
+    return time.time() - worker["time"] < timeout
+
+
+def write_json(path, obj):
+    """Write a small json file so that readers never see it half written."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(f"{path}.tmp", 'wb') as f:
+        f.write(orjson.dumps(obj))
+    os.replace(f"{path}.tmp", path)
+
+
+class FakeSamplingParams:
+    def __init__(self, temperature, max_tokens, top_p):
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.top_p = top_p
+
+
+class FakeTokenizer:
+    def apply_chat_template(self, messages, tokenize=False, add_generation_prompt=True):
+        prompt = ""
+        for message in messages:
+            content = message["content"]
+            if isinstance(content, list):
+                content = "".join(part["text"] for part in content)
+            prompt += f"<{message['role']}>\n{content}</{message['role']}>\n"
+        return prompt + ("<assistant>\n" if add_generation_prompt else "")
+
+    def encode(self, text, add_special_tokens=True):
+        return list(text.encode())
+
+
+class FakeCompletion:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeRequestOutput:
+    def __init__(self, prompt, text, num_cached_tokens):
+        self.prompt = prompt
+        self.prompt_token_ids = list(prompt.encode())
+        self.num_cached_tokens = num_cached_tokens
+        self.outputs = [FakeCompletion(text)]
+
+
+class FakeLLM:
+    """CPU stand-in for vllm.LLM: answers each prompt with the end of the prompt, capped at max_tokens words.
+
+    Tokens are bytes; with prefix caching, the 16-token blocks a prompt shares with the previous one count as cached.
+    """
+
+    def __init__(self, model, enable_prefix_caching=False):
+        self.model = model
+        self.enable_prefix_caching = enable_prefix_caching
+
+    def get_tokenizer(self):
+        return FakeTokenizer()
+
+    def generate(self, prompts, sampling_params):
+        outputs = []
+        previous = b""
+        for prompt in prompts:
+            if isinstance(prompt, dict):
+                prompt = bytes(prompt["prompt_token_ids"]).decode()
+            params = sampling_params[len(outputs)] if isinstance(sampling_params, list) else sampling_params
+            num_cached_tokens = 0
+            if self.enable_prefix_caching:
+                num_cached_tokens = len(os.path.commonprefix([previous, prompt.encode()])) // 16 * 16
+            previous = prompt.encode()
+            outputs.append(FakeRequestOutput(prompt, " ".join(prompt.split()[-params.max_tokens:]), num_cached_tokens))
+        return outputs
+
+
 def add_type(messages):
     """
     Transforms the list of message dictionaries by wrapping each message's content string
@@ -99,7 +615,7 @@ def add_type(messages):
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='arguments for creating and launching batch jobs for narrative generation using VLLM')
-    
+
     parser.add_argument('--input_file',
                         type=str,
                         required=False,
@@ -116,7 +632,53 @@ if __name__ == '__main__':
     parser.add_argument('--util',
                         type=float,
                         default=0.9)
-    
+    parser.add_argument('--prefix_caching',
+                        choices=['auto', 'on', 'off'],
+                        default='auto',
+                        help='automatic prefix caching; auto turns it on for models that support it')
+    parser.add_argument('--sort_by_prefix',
+                        type=lambda x: x == "True",
+                        default=True,
+                        help='Whether to send prompts sorted, so that prompts sharing a prefix are prefilled together')
+    parser.add_argument('--chunk_size',
+                        type=int,
+                        default=1024,
+                        help='requests generated (and saved) at a time; an interrupted run loses at most one chunk')
+    parser.add_argument('--preprocess_workers',
+                        type=int,
+                        default=min(8, os.cpu_count() or 1),
+                        help='processes applying chat templates while the engine generates (0 templates in this process)')
+    parser.add_argument('--pretokenize',
+                        type=lambda x: x == "True",
+                        default=True,
+                        help='Whether to send token ids to the engine instead of prompt text')
+    parser.add_argument('--serve',
+                        action='store_true',
+                        help='run as a resident worker for the batch files submitted to --spool_dir')
+    parser.add_argument('--submit',
+                        action='store_true',
+                        help='hand --input_file to the worker of --spool_dir and wait for it')
+    parser.add_argument('--spool_dir',
+                        type=str,
+                        default=os.getenv('VLLM_SPOOL', 'vllm_spool'),
+                        help='spool directory shared by the worker and submitters')
+    parser.add_argument('--idle_timeout',
+                        type=float,
+                        default=None,
+                        help='seconds without jobs after which the worker exits (never by default)')
+    parser.add_argument('--poll_interval',
+                        type=float,
+                        default=0.5,
+                        help='seconds between checks of the spool directory by an idle worker')
+    parser.add_argument('--submit_timeout',
+                        type=float,
+                        default=60.0,
+                        help='seconds without a worker heartbeat after which a submitter gives up')
+    parser.add_argument('--engine',
+                        choices=['vllm', 'fake'],
+                        default='vllm',
+                        help='fake runs a CPU engine that echoes prompts, to test without a GPU')
+
     args = parser.parse_args()
-    main(args)
-    
+    exit(main(args))
+
@@ -5,6 +5,8 @@ import os
 
 import argparse
 
+COLUMNS = ["source", "scene", "lang", "dialogue", "models", "ended"]
+
 def main(args):
     in_file = args.input_batch
     dial_file = args.dialogue_file
@@ -14,63 +16,65 @@ def main(args):
     two_directories_up = os.path.basename(os.path.dirname(os.path.dirname(in_file)))
     three_directories_up = os.path.basename(os.path.dirname(os.path.dirname(os.path.dirname(in_file))))
     
-    ended_count=0
     # open in_file
     with open(in_file, 'r') as f:
-        data = f.readlines()
+        data = [json.loads(line) for line in f.readlines()]
 
     if dial_file is not None:
 
         dataset = datasets.load_from_disk(dial_file)
-        dialogue = dataset['dialogue']
-        models = dataset['models']
-        lang = dataset['lang']
-        source = dataset['source']
-        scene = dataset['scene']
-        ended = dataset['ended']
-
-        new = False
+        columns = {column: dataset[column] for column in COLUMNS}
+        source_data = None
 
     else:
-        dialogue =  [[] for _ in range(len(data))]
-        models =  [[] for _ in range(len(data))]
-        lang =  [[] for _ in range(len(data))]
-        source =  [[] for _ in range(len(data))]
-        scene = [[] for _ in range(len(data))]
-        ended = [[] for _ in range(len(data))]
-
-        new = True
         #read source data
         with open(args.source, 'r') as f:
-            source_data = f.readlines()
+            source_data = [json.loads(line) for line in f.readlines()]
 
         assert len(data) == len(source_data)
+        columns = new_dialogues(len(data))
 
     dial_file = f"dialogues/{three_directories_up}/{two_directories_up}/{previous_directory}/{input_file_name}"
     
-    for i in tqdm(range(len(data))):
-        data_input = json.loads(data[i])
+    ended_count = update_dialogues(columns, data, args.role, args.model, args.lang, source_data)
+
+    dataset = datasets.Dataset.from_dict(columns)
+    dataset.save_to_disk(dial_file)
+    print(f"Saved to {dial_file}")
+    print(f"INFO: Dialogues that have ended:{100*sum(columns['ended'])/len(dataset)}%")
+    print(f"INFO: New Dialogues that have ended:{100*ended_count/len(dataset)}%\n")
+
+
+def new_dialogues(num_dialogues):
+    """Empty dialogue columns, for a batch of conversation starters."""
+    return {column: [[] for _ in range(num_dialogues)] for column in COLUMNS}
+
+
+def update_dialogues(columns, data, role, model, lang, source_data=None):
+    """
+    Add the responses of a completed batch to the dialogue columns, in place.
+
+    source_data holds the starter requests when the columns are new (see new_dialogues).
+    Returns the number of dialogues ended by this batch.
+    """
+    ended_count=0
+    for data_input in tqdm(data):
         response = data_input["response"]["body"]["choices"][0]["message"]["content"]
         id = int(data_input["custom_id"].split('-')[-1])
         
         if "END_OF_DIALOGUE" in response:
             ended_count+=1
-            ended[id] = True
+            columns["ended"][id] = True
         else:
-            dialogue[id].append({"role": args.role, "content": response.strip('"').strip("user: ")}) #strip quotes
-            models[id].append(args.model)
-        if new:
-            src = json.loads(source_data[id])
-            lang[id] = args.lang
-            source[id] = src["custom_id"]
-            scene[id] = src["body"]["messages"][-1]["content"]
-            ended[id] = False
-
-    dataset = datasets.Dataset.from_dict({"source": source, "scene": scene, "lang": lang, "dialogue": dialogue, "models": models, "ended": ended})
-    dataset.save_to_disk(dial_file)
-    print(f"Saved to {dial_file}")
-    print(f"INFO: Dialogues that have ended:{100*sum(ended)/len(dataset)}%")
-    print(f"INFO: New Dialogues that have ended:{100*ended_count/len(dataset)}%\n")
+            columns["dialogue"][id].append({"role": role, "content": response.strip('"').strip("user: ")}) #strip quotes
+            columns["models"][id].append(model)
+        if source_data is not None:
+            src = source_data[id]
+            columns["lang"][id] = lang
+            columns["source"][id] = src["custom_id"]
+            columns["scene"][id] = src["body"]["messages"][-1]["content"]
+            columns["ended"][id] = False
+    return ended_count
 
 
 if __name__ == '__main__':
@@ -4,6 +4,8 @@ evaluator_owner=openai
 evaluator=o3
 
 
+# build the requests of every language first, then send them in one run that shares the rate budget
+inputs=()
 for lang in "${langs[@]}"; do
     dialogue=RELEASE_CLEANING/benchmark_dialogues/${lang}_selected
     python tasks/dialogue_evaluation/evaluate_dialogue.py \
@@ -13,11 +15,12 @@ for lang in "${langs[@]}"; do
         --model ${evaluator_owner}/${evaluator} 
     
     input=batches_to_process/evaluation/${dialogue}/${evaluator}-${lang}.jsonl
-    
-    python agents/gpt.py \
-        --input_file ${input} \
-        --type upload \
-        --api_key $OPENAI_KEY \
-        --batched False \
-        --provider openai
+    inputs+=(${input})
 done
+
+python agents/gpt.py \
+    --input_file "${inputs[@]}" \
+    --type upload \
+    --api_key $OPENAI_KEY \
+    --batched False \
+    --provider openai
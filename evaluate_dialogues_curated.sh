@@ -3,6 +3,8 @@ langs=(chinese english french german portuguese spanish)
 evaluator_owner=openai
 evaluator=gpt-4o-2024-11-20
 
+# build the requests of every language first, then send them in one run that shares the rate budget
+inputs=()
 for lang in "${langs[@]}"; do
     dialogue=RELEASE_CLEANING/sampled_dialogues/${lang}
     python tasks/dialogue_evaluation/evaluate_dialogue.py \
@@ -12,11 +14,12 @@ for lang in "${langs[@]}"; do
         --lang ${lang}
     
     input=batches_to_process/evaluation/${dialogue}/${evaluator}-${lang}.jsonl
-    
-    python agents/gpt.py \
-        --input_file ${input} \
-        --type upload \
-        --api_key $OPENROUTER_KEY \
-        --batched False \
-        --provider openrouter
-done
\ No newline at end of file
+    inputs+=(${input})
+done
+
+python agents/gpt.py \
+    --input_file "${inputs[@]}" \
+    --type upload \
+    --api_key $OPENROUTER_KEY \
+    --batched False \
+    --provider openrouter
@@ -6,6 +6,8 @@ release=RELEASE_CLEANING
 evaluator_owner=openai
 evaluator=gpt-4.1
 
+# build the requests of the whole grid first, then send them in one run that shares the rate budget
+inputs=()
 for lang in "${langs[@]}"; do
     for user in "${users[@]}"; do
         for target in "${targets[@]}"; do
@@ -17,12 +19,14 @@ for lang in "${langs[@]}"; do
                 --dialogue ${dialogue} \
                 --lang ${lang}
             echo ${input}
-            python agents/gpt.py \
-                --input_file ${input} \
-                --type upload \
-                --api_key $OPENAI_API_KEY \
-                --batched False \
-                --provider azure
+            inputs+=(${input})
         done
     done
 done
+
+python agents/gpt.py \
+    --input_file "${inputs[@]}" \
+    --type upload \
+    --api_key $OPENAI_API_KEY \
+    --batched False \
+    --provider azure
@@ -9,6 +9,17 @@ langs=(chinese english french german portuguese spanish)
 user_owner=google
 user=gemma-3-27b-it
 
+# With VLLM_SPOOL set, one resident worker loads each model once and runs every vLLM step
+# (see agents/vllm_batch.py --serve) instead of every step loading its model again
+if [ -n "${VLLM_SPOOL}" ]; then
+    python agents/vllm_batch.py \
+        --serve \
+        --spool_dir ${VLLM_SPOOL} \
+        --tensor_parallel_size ${tensor_parallel_size} &
+    worker_pid=$!
+    trap "kill ${worker_pid}" EXIT
+fi
+
 for lang in "${langs[@]}"; do
     # Generate and validate turn 0 user starters
     ./0_generate_starters_vllm.sh ${user_owner} ${user} ${lang} ${tensor_parallel_size} ${original_dataset}
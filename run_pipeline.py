@@ -0,0 +1,326 @@
+"""
+PIPELINE RUNNER
+
+Runs the dialogue generation of generate_dialogues_vllm.sh (starters, turn 0, then user and assistant turns for
+every language) in one Python process.
+
+Every step of the shell scripts is a separate process that imports datasets and vllm again, loads its dialogues
+from disk and passes its requests and completions through jsonl files under batches_to_process/ and
+completed_batches/. For small models, that startup and serialization takes longer than the generation itself.
+Here, dialogues and requests stay in memory between stages, one vLLM engine (agents/vllm_batch.py) and one HTTP
+session for the Gemini evaluations are kept for the whole run, and only the dialogue datasets are written, at
+checkpoints.
+
+Features:
+- Runs the (language, turn, role) stage graph of agents/sweep_scheduler.py in waves, one model per wave; the
+  stages of a wave are generated together, so the engine only switches models between waves
+- Validates starters and user turns like the shell scripts (up to 10 and 5 regenerations), evaluating all the
+  responses of a round concurrently, and regenerating the failed ones in one engine call per round; a response
+  whose evaluation request fails for good (or comes back empty) counts as not passed, without failing its stage
+- Saves the dialogues after the starters and every --checkpoint_every assistant turns, to the paths the shell
+  scripts use, so either can pick up the other's output
+- With --resume True (the default), each language restarts from its latest checkpoint
+- A stage that fails skips the stages that depend on it; the other languages carry on
+
+Example command:
+```
+python run_pipeline.py --model_owner microsoft --model Phi-4-mini-instruct --tensor_parallel_size 4
+```
+
+The script is structured as follows:
+    - Imports
+    - Define dataclasses
+        - StageRun (the requests and completions of a stage while it runs)
+    - Define functions
+        - prepare_stage (build the generation requests of a stage)
+        - run_wave (generate, evaluate and regenerate the stages of a wave)
+        - finish_stage (add the completions to the dialogues and save checkpoints)
+        - run_pipeline (run the graph in waves)
+    - Main
+"""
+
+# imports
+import argparse  # for running script from command line
+import asyncio  # for running evaluations concurrently
+import logging  # for logging progress
+import os  # for checkpoint paths and environment variables
+import sys  # for the exit status
+import time  # for timing waves
+from dataclasses import dataclass, field  # for storing stage runs
+
+import aiohttp  # for the evaluation requests
+import datasets  # for saving and loading dialogues
+
+from agents.sweep_scheduler import LANGUAGES, Stage, build_stages, next_model, ready_stages
+from agents.vllm_batch import Engine, generate_records
+from dialogues.process_batch import COLUMNS, new_dialogues, update_dialogues
+from tasks.dialogue_generation.generate_turn import GEMINI_URL
+from tasks.dialogue_generation.generate_turn import Generator as TurnGenerator
+from tasks.narrative_generation.generate_narratives import Generator as NarrativeGenerator
+
+# agents/ scripts import each other as top-level modules
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "agents"))
+from chat_client import chat_completion
+
+RUN_ID = "affective_persona"  # run id of the starters, as in 0_generate_starters_vllm.sh
+
+
+# dataclasses
+
+
+@dataclass
+class StageRun:
+    """The requests and completions of a stage while its wave runs."""
+
+    stage: Stage
+    generator: object  # NarrativeGenerator for starters, TurnGenerator otherwise
+    requests: list
+    max_regenerations: int  # 0 for stages without validation
+    pending: list = field(default_factory=list)  # requests to generate in the next round
+    results: dict = field(default_factory=dict)  # latest completion by custom_id
+    first_results: dict = field(default_factory=dict)  # first completion by custom_id
+    regen_messages: dict = field(default_factory=dict)  # regeneration messages with feedback so far, by custom_id
+    passed: set = field(default_factory=set)  # custom_ids that passed evaluation
+    calls: dict = field(init=False)  # requests by custom_id
+
+    def __post_init__(self):
+        self.calls = {call["custom_id"]: call for call in self.requests}
+
+
+# functions
+
+
+def checkpoint_path(stage: Stage, args) -> str:
+    """Where the dialogues are saved after a stage, as in the shell scripts."""
+    if stage.role == "starters":
+        return f"dialogues/completed_batches/batches_to_process/{RUN_ID}/{args.original_dataset}_{stage.lang}_turn0_{args.user}"
+    name = args.user if stage.role == "user" else args.model
+    return f"dialogues/{stage.lang}/{args.user}_{args.model}/{name}/turn-{stage.turn}_{name}"
+
+
+def is_checkpoint(stage: Stage, args) -> bool:
+    if stage.role == "starters":
+        return True
+    return stage.role == "assistant" and (stage.turn % args.checkpoint_every == 0 or stage.turn == args.turns)
+
+
+def resume(stages: dict, dialogues: dict, args):
+    """Load each language from its latest checkpoint and mark the stages up to it done."""
+    for lang in args.langs:
+        checkpoints = [stage for stage in stages.values() if stage.lang == lang and is_checkpoint(stage, args)]
+        for checkpoint in sorted(checkpoints, key=lambda stage: (stage.turn, stage.role == "assistant"), reverse=True):
+            path = checkpoint_path(checkpoint, args)
+            if not os.path.exists(path):
+                continue
+            dataset = datasets.load_from_disk(path)
+            dialogues[lang] = {column: dataset[column] for column in COLUMNS}
+            for stage in stages.values():
+                if stage.lang == lang and (stage.turn < checkpoint.turn or (
+                        stage.turn == checkpoint.turn and (checkpoint.role == "assistant" or stage.role == "starters"))):
+                    stage.status = "done"
+            logging.warning(f"{lang}: resuming from {path}")
+            break
+
+
+def prepare_stage(stage: Stage, dialogues: dict, args) -> StageRun:
+    """Build the generators and generation requests of a stage, from the dialogues in memory."""
+    if stage.role == "starters":
+        # defaults of generate_narratives.py
+        generator = NarrativeGenerator(argparse.Namespace(
+            model=f"{args.user_owner}/{args.user}", temperature=1.5, top_p=1, frequency_penalty=1.0,
+            presence_penalty=0.6, max_tokens=1024, run_id=RUN_ID, lang=stage.lang,
+            dataset=f"tasks/narrative_generation/data/{args.original_dataset}.json", type=None,
+        ))
+        max_regenerations = args.max_starter_regenerations
+    else:
+        owner, name = (args.user_owner, args.user) if stage.role == "user" else (args.model_owner, args.model)
+        # defaults of generate_turn.py
+        generator = TurnGenerator(argparse.Namespace(
+            service="vllm", model=f"{owner}/{name}", temperature=0.9, top_p=0.95, frequency_penalty=1.0,
+            presence_penalty=0.6, max_tokens=512, context=None, run_id=f"{args.user}_{args.model}",
+            role=stage.role, turn=stage.turn, lang=stage.lang, type=None,
+        ), data=datasets.Dataset.from_dict(dialogues[stage.lang]))
+        max_regenerations = args.max_regenerations if stage.role == "user" else 0
+    requests = generator.generation_requests()
+    return StageRun(stage, generator, requests, max_regenerations, pending=list(requests))
+
+
+async def evaluate(run: StageRun, record: dict, session: aiohttp.ClientSession, slots: asyncio.Semaphore, args) -> str:
+    call = run.generator.build_eval_request(record)
+    async with slots:
+        body = await chat_completion(session, args.eval_url, args.eval_api_key, call["body"])
+    return body["choices"][0]["message"]["content"] or ""
+
+
+def regeneration_request(run: StageRun, custom_id: str, eval: str) -> dict:
+    """The next request for a response that failed evaluation, as in the process steps of the shell scripts."""
+    if run.stage.role == "starters":
+        # narratives are sampled again
+        return run.calls[custom_id]
+    if custom_id not in run.regen_messages:
+        run.regen_messages[custom_id] = run.generator.regen_message(run.generator.data[int(custom_id.split("-")[-1])])
+    regen_res = run.results[custom_id]["response"]["body"]["choices"][0]["message"]["content"]
+    return run.generator.feedback_call(custom_id, run.regen_messages[custom_id], regen_res, eval)
+
+
+async def run_wave(runs: list, engine: Engine, session: aiohttp.ClientSession, args):
+    """Generate the stages of a wave together, then evaluate and regenerate their failed responses in rounds."""
+    slots = asyncio.Semaphore(args.max_concurrent_evaluations)
+    runs_by_id = {custom_id: run for run in runs for custom_id in run.calls}
+    for regenerations in range(max(run.max_regenerations for run in runs) + 1):
+        jobs = [call for run in runs for call in run.pending]
+        if not jobs:
+            break
+        if regenerations:
+            logging.warning(f"Regenerating {len(jobs)} responses")
+        for records in generate_records(engine, jobs, args.chunk_size):
+            for record in records:
+                run = runs_by_id[record["custom_id"]]
+                run.results[record["custom_id"]] = record
+                run.first_results.setdefault(record["custom_id"], record)
+        to_evaluate = [
+            (run, call["custom_id"]) for run in runs if run.max_regenerations > 0 for call in run.pending
+        ]
+        for run in runs:
+            run.pending = []
+        evals = await asyncio.gather(
+            *(evaluate(run, run.results[custom_id], session, slots, args) for run, custom_id in to_evaluate),
+            return_exceptions=True,
+        )
+        for (run, custom_id), eval in zip(to_evaluate, evals):
+            if isinstance(eval, Exception):
+                # an evaluation that failed for good only fails its own response, without feedback to regenerate on
+                logging.warning(f"{run.stage.name}: evaluation of {custom_id} failed: {eval!r}")
+                continue
+            passed = bool(eval) and ("No" not in eval if run.stage.role == "starters" else "Yes" in eval)
+            if passed:
+                run.passed.add(custom_id)
+            elif regenerations < run.max_regenerations:
+                run.pending.append(regeneration_request(run, custom_id, eval))
+
+
+def finish_stage(run: StageRun, dialogues: dict, args):
+    """Add the completions of a stage to its dialogues, in request order, and save them at checkpoints."""
+    stage = run.stage
+    records = []
+    for call in run.requests:
+        custom_id = call["custom_id"]
+        record = run.results[custom_id]
+        if run.max_regenerations > 0 and custom_id not in run.passed:
+            if stage.role == "starters":
+                record = run.first_results[custom_id]  # a starter that never passes keeps its first generation
+            else:
+                # mark as ended to avoid continuation of dialogue with bad user response
+                record["response"]["body"]["choices"][0]["message"]["content"] = "END_OF_DIALOGUE"
+        records.append(record)
+    if stage.role == "starters":
+        dialogues[stage.lang] = new_dialogues(len(run.requests))
+        update_dialogues(dialogues[stage.lang], records, "user", args.user, stage.lang, run.requests)
+    else:
+        name = args.user if stage.role == "user" else args.model
+        update_dialogues(dialogues[stage.lang], records, stage.role, name, stage.lang)
+    if run.max_regenerations > 0:
+        logging.warning(f"{stage.name}: {len(run.passed)} of {len(run.requests)} responses passed evaluation")
+    if is_checkpoint(stage, args):
+        path = checkpoint_path(stage, args)
+        datasets.Dataset.from_dict(dialogues[stage.lang]).save_to_disk(path)
+        logging.warning(f"{stage.name}: saved dialogues to {path}")
+
+
+async def run_pipeline(stages: dict, args) -> int:
+    """Run the stages in waves of one model each. Returns the number of model loads."""
+    engine = Engine(args)
+    dialogues = {}
+    if args.resume:
+        resume(stages, dialogues, args)
+    loaded_model = None
+    num_loads = 0
+    num_waves = 0
+    try:
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=600)) as session:
+            while True:
+                ready = ready_stages(stages)
+                model = next_model(ready, loaded_model)
+                if model is None:
+                    break
+                if model != loaded_model:
+                    loaded_model = model
+                    num_loads += 1
+                wave = [stage for stage in ready if stage.model == model]
+                num_waves += 1
+                logging.warning(
+                    f"Wave {num_waves}: {model} for {len(wave)} stages ({', '.join(stage.name for stage in wave)})"
+                )
+                start_time = time.time()
+                runs = []
+                for stage in wave:
+                    stage.status = "running"
+                    try:
+                        runs.append(prepare_stage(stage, dialogues, args))
+                    except Exception as e:
+                        stage.status = "failed"
+                        logging.exception(f"{stage.name} failed: {e!r}")
+                try:
+                    await run_wave(runs, engine, session, args)
+                except Exception as e:
+                    for run in runs:
+                        run.stage.status = "failed"
+                    logging.exception(f"Wave {num_waves} failed: {e!r}")
+                    continue
+                for run in runs:
+                    try:
+                        finish_stage(run, dialogues, args)
+                        run.stage.status = "done"
+                    except Exception as e:
+                        run.stage.status = "failed"
+                        logging.exception(f"{run.stage.name} failed: {e!r}")
+                logging.warning(f"Wave {num_waves} finished in {time.time() - start_time:.0f}s")
+    finally:
+        engine.unload()
+    return num_loads
+
+
+def main(args):
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    stages = build_stages(args)
+    num_loads = asyncio.run(run_pipeline(stages, args))
+    statuses = [stage.status for stage in stages.values()]
+    logging.warning(
+        f"Pipeline finished with {num_loads} model loads: {statuses.count('done')} stages done, "
+        f"{statuses.count('failed')} failed, {statuses.count('skipped')} skipped"
+    )
+    return 1 if statuses.count("done") < len(statuses) else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="run the vLLM dialogue generation in one process, with dialogues kept in memory between stages"
+    )
+    parser.add_argument("--model_owner", required=True, help="owner of the assistant model")
+    parser.add_argument("--model", required=True, help="assistant model")
+    parser.add_argument("--tensor_parallel_size", type=int, default=4)
+    parser.add_argument("--pipeline_parallel_size", type=int, default=1)
+    parser.add_argument("--util", type=float, default=0.9)
+    parser.add_argument("--user_owner", default="google")
+    parser.add_argument("--user", default="gemma-3-27b-it", help="model simulating the user")
+    parser.add_argument("--original_dataset", default="ATOMIC10X_persona_1k_3")
+    parser.add_argument("--langs", nargs="+", default=LANGUAGES)
+    parser.add_argument("--turns", type=int, default=4, help="user/assistant turns after turn 0")
+    parser.add_argument("--max_starter_regenerations", type=int, default=10)
+    parser.add_argument("--max_regenerations", type=int, default=5, help="regenerations of failed user turns")
+    parser.add_argument("--eval_url", default=GEMINI_URL, help="chat completions URL for evaluation")
+    parser.add_argument("--eval_api_key", default=os.getenv("GEMENI_KEY"), help="API key for evaluation")
+    parser.add_argument("--max_concurrent_evaluations", type=int, default=32)
+    parser.add_argument("--checkpoint_every", type=int, default=1, help="assistant turns between saved dialogues")
+    parser.add_argument("--resume", type=lambda x: x == "True", default=True,
+                        help="Whether to restart each language from its latest saved dialogues")
+    # engine options, as in agents/vllm_batch.py
+    parser.add_argument("--engine", choices=["vllm", "fake"], default="vllm",
+                        help="fake runs a CPU engine that echoes prompts, to test without a GPU")
+    parser.add_argument("--prefix_caching", choices=["auto", "on", "off"], default="auto")
+    parser.add_argument("--sort_by_prefix", type=lambda x: x == "True", default=True)
+    parser.add_argument("--chunk_size", type=int, default=1024)
+    parser.add_argument("--preprocess_workers", type=int, default=min(8, os.cpu_count() or 1))
+    parser.add_argument("--pretokenize", type=lambda x: x == "True", default=True)
+    args = parser.parse_args()
+    sys.exit(main(args))
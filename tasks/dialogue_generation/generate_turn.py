@@ -1,12 +1,23 @@
 import os
 import orjson
 import sys
+import asyncio
+import aiohttp
 import argparse
 import numpy as np
 from datasets import Dataset, load_from_disk
 from typing import List, Dict, Any
 import datetime
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "agents"))
+from chat_client import chat_completion
+
+SERVICE_URLS = {
+    'openai': "https://api.openai.com/v1/chat/completions",
+    'vllm': "http://localhost:8000/v1/chat/completions", # vllm serve <model>
+}
+GEMINI_URL = "https://generativelanguage.googleapis.com/v1beta/openai/chat/completions"
+
 
 USER_PROMPT="""You are role-playing as a human in an online casual conversation. Your task is to generate a natural and authentic response given prior context and an optional feedback from a prior generation attempt.  
 
@@ -50,7 +61,7 @@ Your task is to evaluate ONLY the last message in the conversation against these
 Output: "Yes." if the user response meets all criteria, or "No. <brief explanation>" if it does not."""
 
 class Generator:
-    def __init__(self, args: argparse.Namespace) -> None:
+    def __init__(self, args: argparse.Namespace, data: Dataset = None) -> None:
         self.args = args
         if self.args.role == 'user':
             self.sys_prompt = USER_PROMPT
@@ -65,7 +76,8 @@ class Generator:
         self.eval_file_path =  base_path+'_eval.jsonl'
         self.regen_file_path = base_path+'_regen.jsonl'
         
-        self.data = self.load_context(self.args.context)
+        # dialogues passed in memory (e.g. by run_pipeline.py) instead of loaded from the context path
+        self.data = data if data is not None else self.load_context(self.args.context)
 
     def run(self) -> int:
         """
@@ -75,9 +87,10 @@ class Generator:
         - 'generate': Calls the generate method
         - 'evaluate': Calls the evaluate method
         - 'process': Calls the regenerate method and returns its result
+        - 'pipeline': Calls the pipeline method and returns its result
 
         Returns:
-            int: exit code. 0 (OK) if generate or evaluate is called, otherwise the result of regenerate()
+            int: exit code. 0 (OK) if generate or evaluate is called, otherwise the result of regenerate() or pipeline()
         """
         if self.args.type == 'generate':
             self.generate()
@@ -85,6 +98,8 @@ class Generator:
             self.evaluate()
         elif self.args.type == 'process':
             return self.regenerate()
+        elif self.args.type == 'pipeline':
+            return asyncio.run(self.pipeline())
         return 0
             
     def generate(self) -> None:
@@ -98,29 +113,40 @@ class Generator:
         Returns:
             None
         """
-        newline = '\n'
         with open(f"batches_to_process/{self.gen_file_path}", 'w') as f:
-            for current_idx, data_input in enumerate(self.data):
-                if data_input['ended']:
-                    continue 
-                idx = f"{self.args.lang}_{self.args.run_id}_{self.args.model.split('/')[-1]}_turn-{self.args.turn}-{current_idx}"
-                if self.args.role == 'user':
-                    message = [{'role': 'system', 'content': self.sys_prompt}]
-                    message += [
-                        {
-                        'role':'user',
-                        'content': f"The scene is as follows: {data_input['scene']}\nThe Dialogue is as follows:\n"+'\n'.join([f"{x['role']}: {x['content'].replace(newline,'')}" for x in data_input['dialogue']])+"\n\n.The next user response is?"
-                        }
-                    ]
-                else:
-                    message = [{'role': 'system', 'content': self.sys_prompt}]
-                    message += data_input['dialogue']
-                
-                call = self.build_call(idx, self.args.model, self.args.temperature, message)
+            for call in self.generation_requests():
                 f.write(orjson.dumps(call).decode('utf-8') + '\n')
         
         print(f"Generated requests saved to {self.gen_file_path}")
 
+    def generation_requests(self) -> List[Dict[str, Any]]:
+        """
+        Build the generation requests of the turn, one per ongoing dialogue (those not marked as ended).
+
+        Returns:
+            List of generation requests
+        """
+        newline = '\n'
+        requests = []
+        for current_idx, data_input in enumerate(self.data):
+            if data_input['ended']:
+                continue 
+            idx = f"{self.args.lang}_{self.args.run_id}_{self.args.model.split('/')[-1]}_turn-{self.args.turn}-{current_idx}"
+            if self.args.role == 'user':
+                message = [{'role': 'system', 'content': self.sys_prompt}]
+                message += [
+                    {
+                    'role':'user',
+                    'content': f"The scene is as follows: {data_input['scene']}\nThe Dialogue is as follows:\n"+'\n'.join([f"{x['role']}: {x['content'].replace(newline,'')}" for x in data_input['dialogue']])+"\n\n.The next user response is?"
+                    }
+                ]
+            else:
+                message = [{'role': 'system', 'content': self.sys_prompt}]
+                message += data_input['dialogue']
+            
+            requests.append(self.build_call(idx, self.args.model, self.args.temperature, message))
+        return requests
+
     def evaluate(self) -> None:
         """
         Evaluate generated dialogue responses and write evaluation results to the output file.
@@ -159,7 +185,6 @@ class Generator:
         """
         regens_needed = 0
         edits = 0
-        newline = '\n'
         gen_data = self.load_jsonl(f"completed_batches/{self.gen_file_path}")
         #since we will be updating gen_data, we will map it to a dict
         gen_data_dict = {x['custom_id']: x for x in gen_data}
@@ -195,21 +220,11 @@ class Generator:
                     else:
                         #No prior regeneration, so construct regeneration request from scratch
                         regen_res = gen_data_dict[data_input["custom_id"]]['response']['body']['choices'][0]['message']['content']
-                        regen_request_message = [{'role': 'system', 'content': self.sys_prompt}]
-                        regen_request_message += [
-                                {
-                                'role':'user',
-                                'content': f"The scene is as follows: {dialogue_data['scene']}\nThe Dialogue is as follows:\n"+'\n'.join([f"{x['role']}: {x['content'].replace(newline,'')}" for x in dialogue_data['dialogue']])+f"\n\n"
-                                }
-                            ]
+                        regen_request_message = self.regen_message(dialogue_data)
                     regens_needed += 1
                     if not dialogue_data['ended']:
                         idx = data_input["custom_id"]
-                        message = regen_request_message
-                        #append latest feedback to the message
-                        message[-1]['content'] +=f"Prior failed generation attempt was:\nuser:{regen_res}\nFeedback from this previous generation:{eval}\n"
-
-                        call = self.build_call(idx, self.args.model, self.args.temperature, message)
+                        call = self.feedback_call(idx, regen_request_message, regen_res, eval)
                         f.write(orjson.dumps(call).decode('utf-8') + '\n')
                         gen_data_dict[data_input["custom_id"]]['response']['body']['choices'][0]['message']['content'] = "END_OF_DIALOGUE" # mark as ended to avoid continuation of dialogue with bad user response
                         edits += 1
@@ -229,6 +244,99 @@ class Generator:
         #print(f"INFO: Examples that will be regenerated: {regens_needed}.")
         return regens_needed
     
+    async def pipeline(self) -> int:
+        """
+        Generate, evaluate and regenerate every response on its own, instead of in whole-file rounds.
+
+        Each request of the generation file flows through generation, evaluation (user role only) and
+        feedback-driven regeneration, up to max_regenerations times, without waiting for the other requests.
+        Concurrency is bounded per stage, so a slow request only holds up its own dialogue. The completed
+        generation file (and the last evaluation of each response) are written in the same format as the batch
+        steps, so the turn is then processed as usual. A response whose requests fail for good (after the retries
+        of chat_completion) is written as END_OF_DIALOGUE, which ends only its own dialogue.
+
+        Returns:
+            int: The number of responses that still failed evaluation after max_regenerations regenerations, or
+            whose requests failed.
+        """
+        self.generate()
+        requests = self.load_jsonl(f"batches_to_process/{self.gen_file_path}")
+        generation_slots = asyncio.Semaphore(self.args.max_concurrent_generations)
+        evaluation_slots = asyncio.Semaphore(self.args.max_concurrent_evaluations)
+        gen_url = self.args.gen_url or SERVICE_URLS[self.args.service]
+
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=600)) as session:
+            async def generate(call):
+                async with generation_slots:
+                    body = await chat_completion(session, gen_url, self.args.gen_api_key, call["body"])
+                return {"custom_id": call["custom_id"], "response": {"body": body}}
+
+            async def evaluate(result):
+                call = self.build_eval_request(result)
+                async with evaluation_slots:
+                    body = await chat_completion(session, self.args.eval_url, self.args.eval_api_key, call["body"])
+                return {"custom_id": call["custom_id"], "response": {"body": body}}
+
+            async def run_item(call):
+                eval_result = None
+                try:
+                    result = await generate(call)
+                    if self.args.role != 'user':
+                        return result, None, True
+                    regen_request_message = None
+                    for regenerations in range(self.args.max_regenerations + 1):
+                        eval_result = await evaluate(result)
+                        eval = eval_result["response"]["body"]["choices"][0]["message"]["content"] or ""
+                        if "Yes" in eval or regenerations == self.args.max_regenerations:
+                            break
+                        if regen_request_message is None:
+                            regen_request_message = self.regen_message(self.data[int(call["custom_id"].split("-")[-1])])
+                        regen_res = result['response']['body']['choices'][0]['message']['content']
+                        result = await generate(self.feedback_call(call["custom_id"], regen_request_message, regen_res, eval))
+                except (RuntimeError, KeyError, IndexError, TypeError) as e:
+                    # a request that failed for good only ends its own dialogue
+                    print(f"WARNING: {call['custom_id']} failed, ending the dialogue: {e!r}")
+                    result = {"custom_id": call["custom_id"], "response": {"body": {"choices": [{"message": {"role": "assistant", "content": "END_OF_DIALOGUE"}}]}}}
+                    if self.args.role == 'user' and eval_result is None:
+                        eval_result = {"custom_id": call["custom_id"], "response": {"body": None}, "error": {"message": str(e)}}
+                    return result, eval_result, False
+                if "Yes" not in eval:
+                    # mark as ended to avoid continuation of dialogue with bad user response
+                    result['response']['body']['choices'][0]['message']['content'] = "END_OF_DIALOGUE"
+                return result, eval_result, "Yes" in eval
+
+            items = await asyncio.gather(*(run_item(call) for call in requests))
+
+        os.makedirs(os.path.dirname(f"completed_batches/{self.gen_file_path}"), exist_ok=True)
+        with open(f"completed_batches/{self.gen_file_path}", 'w') as f:
+            for result, _, _ in items:
+                f.write(orjson.dumps(result).decode('utf-8') + '\n')
+        if self.args.role == 'user':
+            with open(f"completed_batches/{self.eval_file_path}", 'w') as f:
+                for _, eval_result, _ in items:
+                    f.write(orjson.dumps(eval_result).decode('utf-8') + '\n')
+        failed = sum(not passed for _, _, passed in items)
+        print(f"INFO: {len(items) - failed} responses passed, {failed} ended after {self.args.max_regenerations} failed regenerations or a failed request.")
+        return failed
+
+    def regen_message(self, dialogue_data: Dict[str, Any]) -> List[Dict[str, str]]:
+        """Regeneration request for a dialogue, before the feedback of failed attempts is appended."""
+        newline = '\n'
+        regen_request_message = [{'role': 'system', 'content': self.sys_prompt}]
+        regen_request_message += [
+                {
+                'role':'user',
+                'content': f"The scene is as follows: {dialogue_data['scene']}\nThe Dialogue is as follows:\n"+'\n'.join([f"{x['role']}: {x['content'].replace(newline,'')}" for x in dialogue_data['dialogue']])+f"\n\n"
+                }
+            ]
+        return regen_request_message
+
+    def feedback_call(self, idx: str, regen_request_message: List[Dict[str, str]], regen_res: str, eval: str) -> Dict[str, Any]:
+        """Regeneration request with the failed response and its evaluation appended to regen_request_message (in place)."""
+        #append latest feedback to the message
+        regen_request_message[-1]['content'] +=f"Prior failed generation attempt was:\nuser:{regen_res}\nFeedback from this previous generation:{eval}\n"
+        return self.build_call(idx, self.args.model, self.args.temperature, regen_request_message)
+
     def build_call(self, idx: str, model:str, temperature: float, message: List[Dict[str, str]]) -> Dict[str, Any]:
         """
         Helper function for call creation a generation request for a dialogue turn.
@@ -354,7 +462,35 @@ if __name__ == '__main__':
     parser.add_argument('--type',
                         type=str,
                         required=True,
-                        choices=['generate','evaluate','process'],
-                        help='type of operation to perform')
+                        choices=['generate','evaluate','process','pipeline'],
+                        help='type of operation to perform; pipeline generates, evaluates and regenerates each response on its own')
+    parser.add_argument('--gen_url',
+                        type=str,
+                        default=None,
+                        help='chat completions URL for generation in pipeline mode (default: the URL of --service)')
+    parser.add_argument('--gen_api_key',
+                        type=str,
+                        default=os.getenv('OPENAI_KEY'),
+                        help='API key for generation in pipeline mode')
+    parser.add_argument('--eval_url',
+                        type=str,
+                        default=GEMINI_URL,
+                        help='chat completions URL for evaluation in pipeline mode')
+    parser.add_argument('--eval_api_key',
+                        type=str,
+                        default=os.getenv('GEMENI_KEY'),
+                        help='API key for evaluation in pipeline mode')
+    parser.add_argument('--max_regenerations',
+                        type=int,
+                        default=5,
+                        help='regenerations of a response that fails evaluation, in pipeline mode')
+    parser.add_argument('--max_concurrent_generations',
+                        type=int,
+                        default=64,
+                        help='generation requests in flight at once, in pipeline mode')
+    parser.add_argument('--max_concurrent_evaluations',
+                        type=int,
+                        default=32,
+                        help='evaluation requests in flight at once, in pipeline mode')
     args = parser.parse_args()
     main(args)           
\ No newline at end of file
@@ -2,11 +2,18 @@ import os
 import json5
 import orjson
 import sys
+import asyncio
+import aiohttp
 import argparse
 import numpy as np
 from tqdm import tqdm
 from typing import List, Dict, Any
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "agents"))
+from chat_client import chat_completion
+
+GEMINI_URL = "https://generativelanguage.googleapis.com/v1beta/openai/chat/completions"
+
 NARRATE_SYS="""You are a creative writer specializing in crafting human-like casual open-domain interactions with chatbots. Your task is to generate the first message a human user might send to a chatbot, based on the following inputs:  
 
 1. Scene Description: A small social context or event description.  
@@ -119,9 +126,10 @@ class Generator:
         - 'generate': Calls the generate method
         - 'evaluate': Calls the evaluate method
         - 'process': Calls the regenerate method and returns its result
+        - 'pipeline': Calls the pipeline method and returns its result
 
         Returns:
-            int: exit code. 0 (OK) if generate or evaluate is called, otherwise the result of regenerate()
+            int: exit code. 0 (OK) if generate or evaluate is called, otherwise the result of regenerate() or pipeline()
         """
         if self.args.type == 'generate':
             self.generate()
@@ -129,6 +137,8 @@ class Generator:
             self.evaluate()
         elif self.args.type == 'process':
             return self.regenerate()
+        elif self.args.type == 'pipeline':
+            return asyncio.run(self.pipeline())
         return 0
         
     def generate(self) -> None: 
@@ -146,12 +156,22 @@ class Generator:
             None
         """
         with open(self.gen_file_path, 'w') as f:
-            for current_idx, data_input in tqdm(enumerate(self.data)):
-                idx = f"{self.args.run_id}-{self.dataset_name}-{self.args.lang}-{self.args.model.split('/')[-1]}-{current_idx}"
-                scene = data_input
-                call = self.build_request(idx,scene)
+            for call in tqdm(self.generation_requests()):
                 f.write(orjson.dumps(call).decode('utf-8') + '\n')
 
+    def generation_requests(self) -> List[Dict[str, Any]]:
+        """
+        Build one narrative request per data input.
+        Returns:
+            List of generation requests
+        """
+        requests = []
+        for current_idx, data_input in enumerate(self.data):
+            idx = f"{self.args.run_id}-{self.dataset_name}-{self.args.lang}-{self.args.model.split('/')[-1]}-{current_idx}"
+            scene = data_input
+            requests.append(self.build_request(idx,scene))
+        return requests
+
     def evaluate(self) -> None:
         """
         Evaluate generated narratives and write evaluation results to the output file.
@@ -222,6 +242,72 @@ class Generator:
         print(f"INFO:Examples that will be generated: {regens_needed}.")
         return regens_needed
     
+    async def pipeline(self) -> int:
+        """
+        Generate, evaluate and regenerate every narrative on its own, instead of in whole-file rounds.
+
+        Each request of the generation file flows through generation, evaluation and regeneration, up to
+        max_regenerations times, without waiting for the other requests. Concurrency is bounded per stage.
+        As with the batch steps, a narrative that never passes keeps its first generation; so does one whose
+        requests fail for good, without holding up the others (if even its first generation failed, it is written
+        as END_OF_DIALOGUE, which ends its dialogue before it starts).
+        Returns:
+            int: The number of narratives that still failed evaluation after max_regenerations regenerations.
+        Side effects:
+            - Writes the generation requests to self.gen_file_path
+            - Writes the completed generations and their last evaluations under completed_batches/
+        """
+        self.generate()
+        requests = self.load_jsonl(self.gen_file_path)
+        generation_slots = asyncio.Semaphore(self.args.max_concurrent_generations)
+        evaluation_slots = asyncio.Semaphore(self.args.max_concurrent_evaluations)
+
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=600)) as session:
+            async def generate(call):
+                async with generation_slots:
+                    body = await chat_completion(session, self.args.gen_url, self.args.gen_api_key, call["body"])
+                return {"custom_id": call["custom_id"], "response": {"body": body}}
+
+            async def evaluate(result):
+                call = self.build_eval_request(result)
+                async with evaluation_slots:
+                    body = await chat_completion(session, self.args.eval_url, self.args.eval_api_key, call["body"])
+                return {"custom_id": call["custom_id"], "response": {"body": body}}
+
+            async def run_item(call):
+                first_result = eval_result = None
+                try:
+                    first_result = result = await generate(call)
+                    for regenerations in range(self.args.max_regenerations + 1):
+                        eval_result = await evaluate(result)
+                        passed = "No" not in (eval_result["response"]["body"]["choices"][0]["message"]["content"] or "No")
+                        if passed or regenerations == self.args.max_regenerations:
+                            break
+                        result = await generate(call)
+                except (RuntimeError, KeyError, IndexError, TypeError) as e:
+                    # a request that failed for good only affects its own narrative, which keeps its first generation
+                    print(f"WARNING: {call['custom_id']} failed: {e!r}")
+                    if eval_result is None:
+                        eval_result = {"custom_id": call["custom_id"], "response": {"body": None}, "error": {"message": str(e)}}
+                    if first_result is None or "choices" not in (first_result["response"]["body"] or {}):
+                        # nothing to keep: the dialogue of this starter is created already ended
+                        first_result = {"custom_id": call["custom_id"], "response": {"body": {"choices": [{"message": {"role": "assistant", "content": "END_OF_DIALOGUE"}}]}}}
+                    return first_result, eval_result, False
+                return (result if passed else first_result), eval_result, passed
+
+            items = await asyncio.gather(*(run_item(call) for call in requests))
+
+        os.makedirs(os.path.dirname(f"completed_batches/{self.gen_file_path}"), exist_ok=True)
+        with open(f"completed_batches/{self.gen_file_path}", 'w') as f:
+            for result, _, _ in items:
+                f.write(orjson.dumps(result).decode('utf-8') + '\n')
+        with open(f"completed_batches/{self.eval_file_path}", 'w') as f:
+            for _, eval_result, _ in items:
+                f.write(orjson.dumps(eval_result).decode('utf-8') + '\n')
+        failed = sum(not passed for _, _, passed in items)
+        print(f"INFO: Examples that failed after {self.args.max_regenerations} regenerations: {failed}.")
+        return failed
+
     def build_request(self, idx: str, scene: Dict[str, Any]) -> Dict[str, Any]:
         return {
             "custom_id": idx,
@@ -315,7 +401,35 @@ if __name__ == '__main__':
                         help='language to generate in')
     parser.add_argument('--type',
                         type=str,
-                        choices=['generate', 'evaluate', 'process'],
-                        help='type of subtask')
+                        choices=['generate', 'evaluate', 'process', 'pipeline'],
+                        help='type of subtask; pipeline generates, evaluates and regenerates each narrative on its own')
+    parser.add_argument('--gen-url',
+                        type=str,
+                        default="http://localhost:8000/v1/chat/completions",
+                        help='chat completions URL for generation in pipeline mode (e.g. vllm serve <model>)')
+    parser.add_argument('--gen-api-key',
+                        type=str,
+                        default=None,
+                        help='API key for generation in pipeline mode')
+    parser.add_argument('--eval-url',
+                        type=str,
+                        default=GEMINI_URL,
+                        help='chat completions URL for evaluation in pipeline mode')
+    parser.add_argument('--eval-api-key',
+                        type=str,
+                        default=os.getenv('GEMENI_KEY'),
+                        help='API key for evaluation in pipeline mode')
+    parser.add_argument('--max-regenerations',
+                        type=int,
+                        default=10,
+                        help='regenerations of a narrative that fails evaluation, in pipeline mode')
+    parser.add_argument('--max-concurrent-generations',
+                        type=int,
+                        default=64,
+                        help='generation requests in flight at once, in pipeline mode')
+    parser.add_argument('--max-concurrent-evaluations',
+                        type=int,
+                        default=32,
+                        help='evaluation requests in flight at once, in pipeline mode')
     args = parser.parse_args()
     main(args)
@@ -0,0 +1,151 @@
+import asyncio
+import os
+import sys
+
+import orjson
+from aiohttp import web
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "agents"))
+
+from batch_orchestrator import BatchJob, BatchShard, file_fingerprint, run_batches  # noqa: E402
+from batch_router import plan_route  # noqa: E402
+from mock_openai_server import MockServerConfig, make_app  # noqa: E402
+
+
+def write_requests(requests_filepath, prefix, num_requests, max_tokens=5):
+    with open(requests_filepath, "wb") as f:
+        for idx in range(num_requests):
+            request = {
+                "custom_id": f"{prefix}-{idx}",
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": "gpt-4o-mini",
+                    "messages": [{"role": "user", "content": f"{prefix} {idx}"}],
+                    "max_tokens": max_tokens,
+                },
+            }
+            f.write(orjson.dumps(request, option=orjson.OPT_APPEND_NEWLINE))
+
+
+def read_custom_ids(save_filepath):
+    with open(save_filepath, "rb") as f:
+        return [orjson.loads(line)["custom_id"] for line in f]
+
+
+async def start_mock_server():
+    app = make_app(MockServerConfig(latency_distribution="constant", latency_mean=0.0, batch_seconds=0.2, seed=0))
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, app["state"], f"http://127.0.0.1:{port}/v1"
+
+
+async def upload(requests_filepath, stub_filepath, save_filepath, base_url, wait=True, **kwargs):
+    job = BatchJob.for_requests_file(requests_filepath, stub_filepath, save_filepath)
+    await asyncio.wait_for(
+        run_batches([job], api_key="test", base_url=base_url, wait=wait, poll_interval=0.05,
+                    max_poll_interval=0.1, **kwargs),
+        timeout=30,
+    )
+    return job
+
+
+def test_reupload_under_the_same_name_submits_the_new_requests(tmp_path):
+    # as in 3_download_turnX_openAI.sh, every regeneration round is uploaded as turn-X_..._regen.jsonl
+    requests_filepath = str(tmp_path / "turn-1_regen.jsonl")
+    stub_filepath = str(tmp_path / "submitted_batches" / "turn-1_regen.json")
+    save_filepath = str(tmp_path / "completed_batches" / "turn-1_regen.jsonl")
+
+    async def rounds():
+        runner, state, base_url = await start_mock_server()
+        try:
+            write_requests(requests_filepath, "round1", 5)
+            first = await upload(requests_filepath, stub_filepath, save_filepath, base_url)
+            first_results = read_custom_ids(save_filepath)
+            write_requests(requests_filepath, "round2", 3)
+            second = await upload(requests_filepath, stub_filepath, save_filepath, base_url)
+            return first, first_results, second, read_custom_ids(save_filepath), len(state.batches)
+        finally:
+            await runner.cleanup()
+
+    first, first_results, second, second_results, num_batches = asyncio.run(rounds())
+    assert first_results == [f"round1-{idx}" for idx in range(5)]
+    assert second_results == [f"round2-{idx}" for idx in range(3)]
+    assert second.shards[0].id != first.shards[0].id
+    assert num_batches == 2
+
+
+def test_interrupted_upload_reattaches_to_its_batches(tmp_path):
+    requests_filepath = str(tmp_path / "turn-1.jsonl")
+    stub_filepath = str(tmp_path / "submitted_batches" / "turn-1.json")
+    save_filepath = str(tmp_path / "completed_batches" / "turn-1.jsonl")
+    write_requests(requests_filepath, "turn1", 4)
+
+    async def interrupted_then_resumed():
+        runner, state, base_url = await start_mock_server()
+        try:
+            first = await upload(requests_filepath, stub_filepath, save_filepath, base_url, wait=False)
+            resumed = BatchJob.for_requests_file(requests_filepath, stub_filepath, save_filepath)
+            await upload(requests_filepath, stub_filepath, save_filepath, base_url)
+            return first, resumed, len(state.batches)
+        finally:
+            await runner.cleanup()
+
+    first, resumed, num_batches = asyncio.run(interrupted_then_resumed())
+    assert not first.merged
+    assert [shard.id for shard in resumed.shards] == [shard.id for shard in first.shards]
+    assert num_batches == 1
+    assert read_custom_ids(save_filepath) == [f"turn1-{idx}" for idx in range(4)]
+
+
+def test_shards_are_merged_in_request_order(tmp_path):
+    requests_filepath = str(tmp_path / "turn-1.jsonl")
+    stub_filepath = str(tmp_path / "submitted_batches" / "turn-1.json")
+    save_filepath = str(tmp_path / "completed_batches" / "turn-1.jsonl")
+    write_requests(requests_filepath, "turn1", 7)
+
+    async def sharded():
+        runner, state, base_url = await start_mock_server()
+        try:
+            return await upload(requests_filepath, stub_filepath, save_filepath, base_url,
+                                max_requests_per_batch=3, canonical_format=True)
+        finally:
+            await runner.cleanup()
+
+    job = asyncio.run(sharded())
+    assert [shard.num_requests for shard in job.shards] == [3, 3, 1]
+    with open(save_filepath, "rb") as f:
+        records = [orjson.loads(line) for line in f]
+    assert [record["custom_id"] for record in records] == [f"turn1-{idx}" for idx in range(7)]
+    assert all(record["response"]["body"]["choices"] for record in records)
+
+
+def test_plan_route(tmp_path):
+    requests_filepath = str(tmp_path / "turn-1_regen.jsonl")
+    stub_filepath = str(tmp_path / "turn-1_regen.json")
+    save_filepath = str(tmp_path / "turn-1_regen_results.jsonl")
+    write_requests(requests_filepath, "regen", 5)
+
+    assert plan_route(requests_filepath, stub_filepath, save_filepath, min_batch_requests=10).route == "online"
+    plan = plan_route(requests_filepath, stub_filepath, save_filepath, min_batch_requests=5)
+    assert plan.route == "batch" and plan.num_requests == 5
+
+    # batches an interrupted run submitted for this very file keep a small file on the batch route
+    job = BatchJob(requests_filepath, stub_filepath, save_filepath)
+    job.shards = [BatchShard(shard_filepath=requests_filepath, num_requests=5, id="batch_1")]
+    job.requests_sha256 = file_fingerprint(requests_filepath)
+    job.write_stub()
+    plan = plan_route(requests_filepath, stub_filepath, save_filepath, min_batch_requests=10)
+    assert plan.route == "batch" and plan.batch_job.shards[0].id == "batch_1"
+
+    # a merged stub, or one made from other requests, does not
+    job.merged = True
+    job.write_stub()
+    assert plan_route(requests_filepath, stub_filepath, save_filepath, min_batch_requests=10).route == "online"
+    job.merged = False
+    job.write_stub()
+    write_requests(requests_filepath, "next_round", 5)
+    assert plan_route(requests_filepath, stub_filepath, save_filepath, min_batch_requests=10).route == "online"
@@ -0,0 +1,79 @@
+import asyncio
+import os
+import sys
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "agents"))
+
+from chat_client import chat_completion  # noqa: E402
+
+
+def completion(content):
+    return {"choices": [{"message": {"role": "assistant", "content": content}}]}
+
+
+async def call(handler, path="/v1/chat/completions", max_attempts=3):
+    """Send one request through chat_completion to an in-process server; returns its result and the headers seen."""
+    seen_headers = []
+
+    async def record_and_handle(request):
+        seen_headers.append(dict(request.headers))
+        return await handler(request, len(seen_headers))
+
+    app = web.Application()
+    app.router.add_post(path, record_and_handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    try:
+        async with aiohttp.ClientSession() as session:
+            body = await chat_completion(
+                session, f"http://127.0.0.1:{port}{path}", "secret", {"messages": []}, max_attempts=max_attempts
+            )
+        return body, seen_headers
+    finally:
+        await runner.cleanup()
+
+
+def test_retries_rate_limits_after_the_delay_asked_for():
+    async def handler(request, num_calls):
+        if num_calls == 1:
+            return web.json_response({"error": {"message": "slow down"}}, status=429, headers={"Retry-After": "0.1"})
+        return web.json_response(completion("ok"))
+
+    body, seen_headers = asyncio.run(call(handler))
+    assert body == completion("ok")
+    assert len(seen_headers) == 2
+    assert seen_headers[0]["Authorization"] == "Bearer secret"
+
+
+def test_azure_deployments_get_an_api_key_header():
+    async def handler(request, num_calls):
+        return web.json_response(completion("ok"))
+
+    _, seen_headers = asyncio.run(call(handler, path="/openai/deployments/gpt-4.1/chat/completions"))
+    assert seen_headers[0]["api-key"] == "secret"
+    assert "Authorization" not in seen_headers[0]
+
+
+def test_non_retriable_errors_raise_at_once():
+    async def handler(request, num_calls):
+        return web.json_response({"error": {"code": "context_length_exceeded"}}, status=400)
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(call(handler))
+
+
+def test_connection_errors_raise_runtime_error_after_the_last_attempt():
+    async def handler(request, num_calls):
+        # drop the connection without an answer
+        request.transport.close()
+        return web.Response()
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(call(handler, max_attempts=2))
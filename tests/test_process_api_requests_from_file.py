@@ -0,0 +1,197 @@
+import asyncio
+import logging
+import os
+import socket
+import sys
+
+import orjson
+import pytest
+from aiohttp import web
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "agents"))
+
+import process_api_requests_from_file as dispatcher  # noqa: E402
+from mock_openai_server import MockServerConfig, make_app  # noqa: E402
+
+
+class FakeEncoding:
+    """Stands in for a tiktoken encoding, which would have to be downloaded."""
+
+    def encode_batch(self, strings, disallowed_special=()):
+        return [string.split() for string in strings]
+
+
+def write_requests(requests_filepath, lines):
+    with open(requests_filepath, "wb") as f:
+        for line in lines:
+            f.write(line + b"\n")
+
+
+def request_line(idx, **body):
+    return orjson.dumps(
+        {
+            "model": "gpt-4o-mini",
+            "custom_id": f"request-{idx}",
+            "body": {
+                "model": "gpt-4o-mini",
+                "messages": [{"role": "user", "content": f"request {idx}"}],
+                "max_tokens": 5,
+                **body,
+            },
+        }
+    )
+
+
+async def dispatch(requests_filepath, save_filepath, port=0, **kwargs):
+    """Run the dispatcher against an in-process mock server; returns the number of requests the server got."""
+    app = make_app(MockServerConfig(latency_distribution="constant", latency_mean=0.01, seed=0))
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", port)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    try:
+        await asyncio.wait_for(
+            dispatcher.process_api_requests_from_file(
+                requests_filepath,
+                save_filepath,
+                request_url=f"http://127.0.0.1:{port}/v1/chat/completions",
+                api_key="test",
+                max_requests_per_minute=1_000_000,
+                max_tokens_per_minute=1_000_000_000,
+                token_encoding_name="cl100k_base",
+                max_attempts=3,
+                logging_level=logging.WARNING,
+                record_format="batch",
+                ordered_output=True,
+                **kwargs,
+            ),
+            timeout=30,
+        )
+        return app["state"].num_requests
+    finally:
+        await runner.cleanup()
+
+
+@pytest.fixture(autouse=True)
+def fake_token_counter(monkeypatch):
+    monkeypatch.setattr(
+        dispatcher, "get_token_counter", lambda name: dispatcher.TokenCounter(FakeEncoding())
+    )
+
+
+def test_ordered_output_with_blank_lines(tmp_path):
+    requests_filepath = str(tmp_path / "requests.jsonl")
+    save_filepath = str(tmp_path / "results.jsonl")
+    lines = []
+    for idx in range(20):
+        lines.append(request_line(idx))
+        if idx % 3 == 0:
+            lines.append(b"")
+        if idx % 4 == 0:
+            lines.append(b"   \t")
+    write_requests(requests_filepath, lines)
+
+    asyncio.run(dispatch(requests_filepath, save_filepath, max_reorder_buffer=2))
+
+    with open(save_filepath, "rb") as f:
+        records = [orjson.loads(line) for line in f]
+    assert [record["custom_id"] for record in records] == [
+        f"request-{idx}" for idx in range(20)
+    ]
+
+
+def test_resume_sends_only_the_missing_requests(tmp_path):
+    requests_filepath = str(tmp_path / "requests.jsonl")
+    save_filepath = str(tmp_path / "results.jsonl")
+    write_requests(requests_filepath, [request_line(idx) for idx in range(20)])
+    # an interrupted run on the same file answered 5 requests (out of order) and failed one
+    with open(f"{save_filepath}.inprogress", "w") as f:
+        f.write(dispatcher.file_fingerprint(requests_filepath))
+    with open(save_filepath, "wb") as f:
+        for idx in (3, 0, 7, 1, 4):
+            record = {"custom_id": f"request-{idx}", "response": {"body": {"previous_run": True}}}
+            f.write(orjson.dumps(record, option=orjson.OPT_APPEND_NEWLINE))
+        record = {"custom_id": "request-9", "response": {"body": None}, "error": ["server error"]}
+        f.write(orjson.dumps(record, option=orjson.OPT_APPEND_NEWLINE))
+
+    num_requests = asyncio.run(dispatch(requests_filepath, save_filepath, resume=True))
+
+    with open(save_filepath, "rb") as f:
+        records = [orjson.loads(line) for line in f]
+    assert num_requests == 15
+    assert [record["custom_id"] for record in records] == [f"request-{idx}" for idx in range(20)]
+    assert [
+        idx for idx, record in enumerate(records) if record["response"]["body"].get("previous_run")
+    ] == [0, 1, 3, 4, 7]
+    assert not os.path.exists(f"{save_filepath}.inprogress")
+
+
+def test_resume_starts_over_for_another_requests_file(tmp_path):
+    requests_filepath = str(tmp_path / "requests.jsonl")
+    save_filepath = str(tmp_path / "results.jsonl")
+    write_requests(requests_filepath, [request_line(idx) for idx in range(5)])
+    with open(f"{save_filepath}.inprogress", "w") as f:
+        f.write("fingerprint of another file")
+    with open(save_filepath, "wb") as f:
+        record = {"custom_id": "request-0", "response": {"body": {"previous_run": True}}}
+        f.write(orjson.dumps(record, option=orjson.OPT_APPEND_NEWLINE))
+
+    num_requests = asyncio.run(dispatch(requests_filepath, save_filepath, resume=True))
+
+    assert num_requests == 5
+
+
+def test_response_cache_answers_a_rerun(tmp_path):
+    requests_filepath = str(tmp_path / "requests.jsonl")
+    cache_path = str(tmp_path / "cache" / "responses.sqlite")
+    # evaluation-like requests are cached, sampled ones (and a null temperature) are not
+    lines = [request_line(idx, temperature=0.0) for idx in range(250)]
+    lines += [request_line(250, temperature=1.0), request_line(251, temperature=None)]
+    write_requests(requests_filepath, lines)
+
+    # the URL is part of the cache key, so both runs talk to a server on the same port
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    first = asyncio.run(
+        dispatch(requests_filepath, str(tmp_path / "first.jsonl"), port=port, cache_path=cache_path)
+    )
+    second = asyncio.run(
+        dispatch(requests_filepath, str(tmp_path / "second.jsonl"), port=port, cache_path=cache_path)
+    )
+
+    assert (first, second) == (252, 2)
+    with open(tmp_path / "first.jsonl", "rb") as f_first, open(tmp_path / "second.jsonl", "rb") as f_second:
+        first_records = [orjson.loads(line) for line in f_first]
+        second_records = [orjson.loads(line) for line in f_second]
+    assert first_records[:250] == second_records[:250]
+
+
+@pytest.mark.parametrize(
+    "status, response_json, error_class",
+    [
+        (429, {"error": {"message": "Rate limit reached"}}, "rate_limit"),
+        (400, {"error": {"message": "Rate limit reached for requests"}}, "rate_limit"),
+        (500, {"error": {"message": "The server had an error"}}, "retriable"),
+        (503, None, "retriable"),
+        (None, None, "retriable"),  # connection error
+        (408, {}, "retriable"),
+        (400, {"error": {"code": "context_length_exceeded"}}, "non_retriable"),
+        (429, {"error": {"code": "insufficient_quota"}}, "non_retriable"),
+        (404, {"error": {"message": "Not found"}}, "non_retriable"),
+        (200, {"error": {"code": 503, "message": "overloaded"}}, "retriable"),
+        (200, {"error": {"code": 400, "message": "bad request"}}, "non_retriable"),
+        (400, [{"error": "list body from Gemini"}], "non_retriable"),
+    ],
+)
+def test_classify_error(status, response_json, error_class):
+    assert dispatcher.classify_error(status, response_json) == error_class
+
+
+def test_retry_after_from_response():
+    assert dispatcher.retry_after_from_response({"retry-after-ms": "1500"}, None) == 1.5
+    assert dispatcher.retry_after_from_response({"retry-after": "2.5"}, {}) == 2.5
+    gemini_error = {"error": {"details": [{"@type": "type.googleapis.com/google.rpc.RetryInfo", "retryDelay": "23s"}]}}
+    assert dispatcher.retry_after_from_response({}, gemini_error) == 23
+    assert dispatcher.retry_after_from_response({"retry-after": "Wed, 21 Oct 2015 07:28:00 GMT"}, {}) is None